@@ -0,0 +1,257 @@
+import gevent
+import hashlib
+import pytest
+import re
+
+from boto.s3.multidelete import Error, MultiDeleteResult
+from wal_e.exception import UserException
+from wal_e.operator import s3_operator
+from wal_e.worker import s3_worker
+
+
+@pytest.fixture(autouse=True)
+def state_dir(tmpdir, monkeypatch):
+    """Keep caches WAL-E writes out of the home directory"""
+    path = tmpdir.join('state')
+    monkeypatch.setenv('WALE_STATE_DIR', str(path))
+    return path
+
+
+def segment_name(n, tli=1):
+    """The name of the nth WAL segment of a timeline"""
+    return '{0:08X}{1:08X}{2:08X}'.format(tli, n // 0x100, n % 0x100)
+
+
+def sentinel_name(n):
+    return ('prefix/basebackups_005/base_00000001000000000000{0:04X}_'
+            '00000020_backup_stop_sentinel.json'.format(n))
+
+
+def listed_sentinel_name(n):
+    return ('prefix/basebackups_005/sentinels/base_00000001000000000000'
+            '{0:04X}_00000020_00000001000000000000{1:04X}_00000040_'
+            '1234'.format(n, n + 1))
+
+
+class FakeKey(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.etag = bucket.etags.get(name, '"1"')
+        self.last_modified = '2013-01-01T00:00:00.000Z'
+
+    def get_contents_as_string(self, headers=None):
+        self.bucket.fetches.append(self.name)
+        self.bucket.concurrent += 1
+        self.bucket.max_concurrent = max(self.bucket.concurrent,
+                                         self.bucket.max_concurrent)
+        try:
+            gevent.sleep(self.bucket.delays.get(self.name, 0))
+        finally:
+            self.bucket.concurrent -= 1
+
+        contents = self.bucket.objects[self.name]
+        if headers is not None and 'Range' in headers:
+            first, last = re.match(r'bytes=(\d+)-(\d+)$',
+                                   headers['Range']).groups()
+            return contents[int(first):int(last) + 1]
+
+        return contents
+
+    def set_contents_from_string(self, contents):
+        self.bucket.objects[self.name] = contents
+
+    def delete(self):
+        del self.bucket.objects[self.name]
+
+
+class FakeBucket(object):
+    """Holds objects in a dictionary, recording how they are read"""
+
+    name = 'bucket'
+
+    def __init__(self):
+        self.objects = {}
+        self.etags = {}
+        self.delays = {}
+        self.fetches = []
+        self.concurrent = 0
+        self.max_concurrent = 0
+        self.listed = []
+        self.scanned = []
+        self.listings = []
+        self.delete_batches = []
+        self.undeletable = set()
+
+    def list(self, prefix, delimiter=None, marker=''):
+        """List like S3 does, rolling up keys past the delimiter"""
+        self.listed = []
+
+        for name in sorted(self.objects):
+            if not name.startswith(prefix) or name <= marker:
+                continue
+
+            rest = name[len(prefix):]
+            if delimiter is not None and delimiter in rest:
+                name = prefix + rest.split(delimiter, 1)[0] + delimiter
+                if self.listed and self.listed[-1].name == name:
+                    continue
+
+            self.listed.append(FakeKey(self, name))
+
+        # Keys are only counted as scanned once they are iterated over.
+        for key in self.listed:
+            self.scanned.append(key.name)
+            yield key
+
+    def get_all_keys(self, prefix, max_keys, marker=''):
+        self.listings.append(prefix)
+        names = sorted(name for name in self.objects
+                       if name.startswith(prefix) and name > marker)
+        return [FakeKey(self, name) for name in names[:max_keys]]
+
+    def new_key(self, name):
+        return FakeKey(self, name)
+
+    def delete_keys(self, names, quiet=False):
+        self.delete_batches.append(names)
+        result = MultiDeleteResult(self)
+
+        for name in names:
+            if name in self.undeletable:
+                result.errors.append(Error(name, code='AccessDenied',
+                                           message='Access Denied'))
+            else:
+                del self.objects[name]
+
+        return result
+
+
+class FakeConnection(object):
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def get_bucket(self, name):
+        assert name == self.bucket.name
+        return self.bucket
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    """A FakeBucket that objects put by s3:// URL end up in"""
+    bucket = FakeBucket()
+
+    class FakeStorageUri(object):
+        def __init__(self, s3_uri):
+            self.object_name = s3_uri[len('s3://bucket/'):]
+
+        def get_bucket(self):
+            return bucket
+
+    def uri_put_file(s3_uri, fp, content_encoding=None, md5=None):
+        contents = fp.read()
+        if md5 is not None:
+            assert md5[0] == hashlib.md5(contents).hexdigest()
+        bucket.objects[s3_uri[len('s3://bucket/'):]] = contents
+
+        class Key(object):
+            size = len(contents)
+        return Key()
+
+    monkeypatch.setattr(s3_worker, 's3_uri_wrap', FakeStorageUri)
+    monkeypatch.setattr(s3_worker, 'uri_put_file', uri_put_file)
+    return bucket
+
+
+class FakeS3(object):
+    """Stands in for WAL transfers and for starting WAL-E processes"""
+
+    def __init__(self, monkeypatch):
+        self.uploaded = {}
+        self.bundles = {}
+        self.sizes = {}
+        self.md5s = {}
+        self.archived = {}
+        self.indexed = []
+        self.synchronous = []
+        self.fail = ()
+        self.fetched = []
+        self.missing = set()
+        self.bundled = set()
+        self.bundle_lookups = []
+        self.started = []
+
+        monkeypatch.setattr(s3_worker, 'lzop_compress', self.compress)
+        monkeypatch.setattr(s3_worker, 's3_put_compressed', self.put)
+        monkeypatch.setattr(s3_worker, 's3_put_wal_bundle', self.put_bundle)
+        monkeypatch.setattr(s3_worker, 's3_put_wal_index_deltas',
+                            lambda wal_url, names:
+                            self.indexed.append((wal_url, names)))
+        monkeypatch.setattr(s3_worker, 's3_archived_md5', self.archived.get)
+        monkeypatch.setattr(s3_worker, 'do_lzop_s3_get', self.get)
+        monkeypatch.setattr(s3_worker, 'find_in_wal_bundle', self.find)
+        monkeypatch.setattr(s3_worker, 'wal_bundles_used',
+                            lambda wal_url: bool(self.bundled))
+        monkeypatch.setattr(s3_operator.S3Backup, '_wal_s3_upload',
+                            lambda backup, segment, **kwargs:
+                            self.synchronous.append(segment.name))
+        monkeypatch.setattr(s3_operator.S3Backup, '_start_wal_e',
+                            lambda backup, *args: self.started.append(args))
+
+    @property
+    def prefetches(self):
+        return [args[-1] for args in self.started
+                if args[0] == 'wal-prefetch']
+
+    def compress(self, local_path, fp, gpg_key, length=None):
+        with open(local_path) as f:
+            fp.write('compressed ' + f.read(length or -1))
+
+    def put(self, s3_url, fp, segment_size=None, segment_md5=None):
+        if s3_url.endswith(self.fail):
+            raise UserException(msg='could not upload')
+
+        self.uploaded[s3_url] = fp.read()
+        self.sizes[s3_url] = segment_size
+        self.md5s[s3_url] = segment_md5
+        return '1'
+
+    def put_bundle(self, s3_url, segments):
+        self.bundles[s3_url] = [(name, f.read())
+                                for name, f, size, md5 in segments]
+        self.sizes.update((name, size) for name, f, size, md5 in segments)
+        self.md5s.update((name, md5) for name, f, size, md5 in segments)
+        return '1'
+
+    def get(self, s3_url, path, decrypt, byte_range=None, segment_size=None):
+        if byte_range is not None:
+            with open(path, 'wb') as f:
+                f.write('from bundle {0} {1}-{2}'.format(s3_url, *byte_range))
+            return True
+
+        name = s3_url.rsplit('/', 1)[-1][:-len('.lzo')]
+        self.fetched.append(name)
+
+        if name.endswith('missing') or name in self.missing:
+            return False
+
+        if name in self.bundled:
+            return False
+
+        with open(path, 'wb') as f:
+            f.write('from s3 ' + name)
+        return True
+
+    def find(self, wal_url, name):
+        assert wal_url == 's3://bucket/prefix/wal_005'
+        self.bundle_lookups.append(name)
+        if name in self.bundled:
+            return (wal_url + '/bundles/' + name + '.bundle', (4096, 4100),
+                    None, self.md5s.get(name))
+
+        return None
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    return FakeS3(monkeypatch)
@@ -0,0 +1,117 @@
+import json
+
+from conftest import FakeBucket, FakeConnection
+from conftest import listed_sentinel_name, sentinel_name
+from wal_e.cache import ObjectCache
+from wal_e.storage import s3_storage
+from wal_e.worker import s3_worker
+
+
+def sentinel_contents(name):
+    return json.dumps({'expanded_size_bytes': len(name)})
+
+
+def backup_list(names, delays, detail=True, cache=None):
+    bucket = FakeBucket()
+    for name, delay in zip(names, delays):
+        bucket.objects[name] = sentinel_contents(name)
+        bucket.delays[name] = delay
+
+    layout = s3_storage.StorageLayout('s3://bucket/prefix')
+    return bucket, s3_worker.BackupList(FakeConnection(bucket), layout,
+                                        detail, cache=cache)
+
+
+def test_details_fetched_concurrently(monkeypatch):
+    monkeypatch.setattr(s3_worker, 'DETAIL_POOL_SIZE', 4)
+    names = [sentinel_name(n) for n in xrange(10)]
+    names.insert(3, 'prefix/basebackups_005/base_00000001000000000000000'
+                 '3_00000020/tar_partitions/part_0.tar.lzo')
+
+    # Later backups are quicker to fetch, but listed in order.
+    bucket, bl = backup_list(names, [0.01 * (12 - n) for n in xrange(11)])
+    backups = list(bl)
+
+    assert [b.name for b in backups] == [
+        'base_00000001000000000000{0:04X}_00000020'.format(n)
+        for n in xrange(10)]
+    assert all(b.expanded_size_bytes == len(sentinel_name(0))
+               for b in backups)
+    assert bucket.max_concurrent == 4
+
+
+def test_without_detail():
+    bucket, bl = backup_list([sentinel_name(1)], [0], detail=False)
+
+    assert [b.expanded_size_bytes for b in bl] == [None]
+    assert bucket.fetches == []
+
+
+def test_detail_timeout(monkeypatch):
+    monkeypatch.setattr(s3_worker, 'DETAIL_TIMEOUT_SECONDS', 0.01)
+    bucket, bl = backup_list([sentinel_name(1), sentinel_name(2)], [1, 0])
+    backups = list(bl)
+
+    assert backups[0].wal_segment_backup_stop == 'timeout'
+    assert backups[0].expanded_size_bytes == 'timeout'
+    assert backups[1].expanded_size_bytes == len(sentinel_name(2))
+    assert bucket.fetches.count(sentinel_name(1)) == s3_worker.DETAIL_ATTEMPTS
+
+
+def test_volumes_not_listed():
+    names = []
+    for n in (1, 2):
+        names.extend(sentinel_name(n)[:-len('_backup_stop_sentinel.json')] +
+                     '/tar_partitions/part_{0}.tar.lzo'.format(i)
+                     for i in xrange(100))
+        names.append(sentinel_name(n))
+
+    bucket, bl = backup_list(sorted(names), [0] * len(names), detail=False)
+    assert len(list(bl)) == 2
+    assert len(bucket.listed) == 4
+
+
+def test_find_latest():
+    names = [sentinel_name(n) for n in (3, 1, 2)]
+    bucket, bl = backup_list(names, [0] * 3)
+
+    latest, = bl.find_all('LATEST')
+    assert latest.name == 'base_000000010000000000000003_00000020'
+    assert bucket.fetches == [sentinel_name(3)]
+
+    found, = bl.find_all('base_000000010000000000000001_00000020')
+    assert found.expanded_size_bytes == len(sentinel_name(1))
+
+    bucket, bl = backup_list([], [])
+    assert list(bl.find_all('LATEST')) == [None]
+
+
+def test_details_cached():
+    names = [sentinel_name(n) for n in (1, 2)]
+    bucket, bl = backup_list(names, [0] * 2, cache=ObjectCache('test', 60))
+    first = list(bl)
+    assert len(bucket.fetches) == 2
+
+    # Only what is new or rewritten is fetched again.
+    bucket.etags[sentinel_name(2)] = '"2"'
+    bucket.objects[sentinel_name(3)] = sentinel_contents(sentinel_name(3))
+    bucket.fetches = []
+
+    assert list(bl)[:2] == first
+    assert bucket.fetches == [sentinel_name(2), sentinel_name(3)]
+
+
+def test_details_listed():
+    names = [sentinel_name(1), sentinel_name(2), listed_sentinel_name(2)]
+    bucket, bl = backup_list(names, [0] * 3)
+
+    first, second = bl
+    assert first.expanded_size_bytes == len(sentinel_name(1))
+    assert second.expanded_size_bytes == 1234
+    assert second.wal_segment_backup_stop == '000000010000000000000003'
+    assert second.wal_segment_offset_backup_stop == '00000040'
+    assert bucket.fetches == [sentinel_name(1)]
+
+    bucket.fetches = []
+    assert [b.name for b in bl.unlisted()] == [first.name]
+    assert bucket.fetches == [sentinel_name(1)]
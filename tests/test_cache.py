@@ -0,0 +1,92 @@
+import os
+import sqlite3
+import time
+
+from wal_e.cache import JsonCache, ObjectCache
+
+
+def test_round_trip(state_dir):
+    cache = JsonCache('test', ttl=60)
+    assert cache.get('key') is None
+
+    cache.put('key', {'a': [1, 2]})
+    assert cache.get('key') == {'a': [1, 2]}
+    assert state_dir.join('test.json').check()
+
+    # As seen by another process.
+    assert JsonCache('test', ttl=60).get('key') == {'a': [1, 2]}
+
+    cache.discard('key')
+    assert cache.get('key') is None
+
+
+def test_expiry(monkeypatch):
+    cache = JsonCache('test', ttl=60)
+    cache.put('key', 'value')
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 61)
+    assert cache.get('key') is None
+
+    # Expired entries are dropped as others are added.
+    cache.put('other', 'value')
+    assert cache._load().keys() == ['other']
+
+
+def test_corrupt(state_dir):
+    state_dir.ensure(dir=True)
+    state_dir.join('test.json').write('{"key": ')
+
+    cache = JsonCache('test', ttl=60)
+    assert cache.get('key') is None
+
+    cache.put('key', 'value')
+    assert cache.get('key') == 'value'
+
+
+def test_unwritable(tmpdir):
+    if os.getuid() == 0:
+        # Permissions do not stop root, but a file in place of the
+        # directory does.
+        tmpdir.join('not-a-directory').write('')
+        cache = JsonCache('test', ttl=60,
+                          directory=unicode(tmpdir.join('not-a-directory')))
+    else:
+        tmpdir.mkdir('read-only').chmod(0500)
+        cache = JsonCache('test', ttl=60,
+                          directory=unicode(tmpdir.join('read-only')))
+
+    cache.put('key', 'value')
+    assert cache.get('key') is None
+
+
+def test_object_cache(state_dir, monkeypatch):
+    cache = ObjectCache('test', ttl=60)
+    assert cache.get('s3://bucket/key', '"1"') is None
+
+    cache.put('s3://bucket/key', '"1"', '{"a": 1}')
+    assert cache.get('s3://bucket/key', '"1"') == '{"a": 1}'
+    assert state_dir.join('test.sqlite').check()
+
+    # A changed object is a miss.
+    assert cache.get('s3://bucket/key', '"2"') is None
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 61)
+    cache = ObjectCache('test', ttl=60)
+    assert cache.get('s3://bucket/key', '"1"') is None
+    cache.close()
+
+    # Expired entries are dropped once, on opening the cache.
+    conn = sqlite3.connect(unicode(state_dir.join('test.sqlite')))
+    assert conn.execute('SELECT COUNT(*) FROM objects').fetchall() == [(0,)]
+    conn.close()
+
+
+def test_object_cache_unusable(tmpdir):
+    tmpdir.join('not-a-directory').write('')
+    cache = ObjectCache('test', ttl=60,
+                        directory=unicode(tmpdir.join('not-a-directory')))
+
+    cache.put('s3://bucket/key', '"1"', 'contents')
+    assert cache.get('s3://bucket/key', '"1"') is None
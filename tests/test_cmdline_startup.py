@@ -0,0 +1,119 @@
+import os
+import pytest
+import sys
+import time
+
+from os import path
+
+from wal_e import cmd
+from wal_e import piper
+from wal_e import subprocess
+
+
+def no_benchmarks():
+    return os.getenv('WALE_BENCHMARKS') is None
+
+
+def python_env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = path.dirname(path.dirname(cmd.__file__))
+    return env
+
+
+def test_import_is_light():
+    """Importing the command line loads neither gevent nor boto"""
+    proc = subprocess.Popen(
+        [sys.executable, '-c',
+         'import sys, wal_e.cmd\n'
+         'print " ".join(sorted(sys.modules))'],
+        stdout=subprocess.PIPE, env=python_env())
+    modules = proc.communicate()[0].split()
+
+    assert proc.returncode == 0
+    for heavy in ('boto', 'gevent', 'wal_e.daemon', 'wal_e.piper'):
+        assert heavy not in modules
+
+
+@pytest.fixture
+def program(tmpdir):
+    program = tmpdir.join('program')
+    program.write('#!/bin/sh\nexit 0\n')
+    program.chmod(0755)
+    return program
+
+
+@pytest.fixture
+def spawned(monkeypatch):
+    spawned = []
+    popen_sp = piper.popen_sp
+
+    def counting_popen_sp(args, *rest, **kwargs):
+        spawned.append(args[0])
+        return popen_sp(args, *rest, **kwargs)
+
+    monkeypatch.setattr(piper, 'popen_sp', counting_popen_sp)
+    return spawned
+
+
+def test_program_check_remembered(program, spawned):
+    cmd.external_program_check([unicode(program)])
+    cmd.external_program_check([unicode(program)])
+    assert spawned == [unicode(program)]
+
+    # A replaced program is checked again.
+    past = time.time() - 60
+    os.utime(unicode(program), (past, past))
+    cmd.external_program_check([unicode(program)])
+    assert len(spawned) == 2
+
+
+def test_missing_program(tmpdir, spawned):
+    missing = unicode(tmpdir.join('missing'))
+
+    for i in (1, 2):
+        with pytest.raises(cmd.UserException):
+            cmd.external_program_check([missing])
+
+    assert spawned == [missing, missing]
+
+
+def test_find_program(program, monkeypatch):
+    assert cmd.find_program(unicode(program)) == unicode(program)
+
+    monkeypatch.setenv('PATH', str(program.dirpath()))
+    assert cmd.find_program('program') == unicode(program)
+    assert cmd.find_program('missing') is None
+
+
+# Commands run straight against S3 import all of boto and gevent, then
+# fail on the missing gpg before they get as far as the network.
+DIRECT = ['--s3-prefix', 's3://nonexistent/prefix',
+          '--gpg-key-id', 'nonexistent']
+
+
+@pytest.mark.skipif("no_benchmarks()")
+@pytest.mark.parametrize('name,argv', [
+    ('version', ['version']),
+    ('wal-push via daemon',
+     ['--daemon-socket', '/nonexistent/wal-e.sock', 'wal-push', 'segment']),
+    ('wal-push', DIRECT + ['wal-push', '/nonexistent/segment']),
+    ('wal-fetch', DIRECT + ['wal-fetch', 'segment', '/nonexistent/segment']),
+    ('backup-list', DIRECT + ['backup-list'])])
+def test_startup_time(name, argv, tmpdir):
+    """Report the time to run a quick subcommand from scratch
+
+    Set WALE_BENCHMARKS to run this, and pass -s to see the output.
+    """
+    env = python_env()
+    env['PATH'] = str(tmpdir)
+    env['AWS_ACCESS_KEY_ID'] = 'id'
+    env['AWS_SECRET_ACCESS_KEY'] = 'secret'
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for i in xrange(10):
+            start = time.time()
+            subprocess.call([sys.executable, '-m', 'wal_e.cmd'] + argv,
+                            stdout=devnull, stderr=devnull, env=env)
+            timings.append(time.time() - start)
+
+    print '{0}: {1:.1f} ms'.format(name, min(timings) * 1000)
@@ -0,0 +1,144 @@
+import gevent
+import gevent.event
+import os
+import pytest
+import stat
+import subprocess
+import sys
+
+from wal_e import daemon
+from wal_e.exception import UserException
+
+
+class FakeBackup(object):
+    """Records what it is asked to archive, instead of uploading it"""
+
+    def __init__(self):
+        self.archived = []
+        self.release = gevent.event.Event()
+        self.release.set()
+
+    def wal_s3_archive(self, wal_path, concurrency=1, **kwargs):
+        self.release.wait()
+
+        if os.path.basename(wal_path) == 'bad':
+            raise UserException(msg='could not upload',
+                                detail='Something\nwent wrong.')
+        elif os.path.basename(wal_path) == 'buggy':
+            raise ValueError('a bug')
+
+        # Connections are served concurrently already.
+        assert concurrency == 1
+        self.archived.append(wal_path)
+
+
+def push(socket_path, wal_path):
+    """Run the client in a thread, as it does not cooperate with gevent"""
+    return gevent.get_hub().threadpool.spawn(daemon.push, socket_path,
+                                             wal_path)
+
+
+@pytest.fixture
+def server(request, tmpdir):
+    s = daemon.WalPushServer(FakeBackup(), unicode(tmpdir.join('sock')))
+    s.start()
+    request.addfinalizer(s.stop)
+    return s
+
+
+def test_push(server, tmpdir):
+    push(server.socket_path, '/wal/000000010000000000000001').get()
+    assert server.backup_cxt.archived == ['/wal/000000010000000000000001']
+
+
+def test_socket_private(server):
+    assert stat.S_IMODE(os.stat(server.socket_path).st_mode) == 0600
+
+
+def test_relative_path(server, tmpdir):
+    push(server.socket_path, 'pg_xlog/000000010000000000000001').get()
+    assert server.backup_cxt.archived == [
+        os.path.abspath('pg_xlog/000000010000000000000001')]
+
+
+def test_push_blocks_until_archived(server):
+    server.backup_cxt.release.clear()
+    result = push(server.socket_path, '/wal/000000010000000000000001')
+
+    gevent.sleep(0.05)
+    assert not result.ready()
+
+    server.backup_cxt.release.set()
+    result.get()
+    assert len(server.backup_cxt.archived) == 1
+
+
+@pytest.mark.parametrize('name, detail', [
+    ('bad', 'could not upload: Something went wrong.'),
+    ('buggy', "ValueError('a bug',)")])
+def test_failure_reported(server, name, detail):
+    with pytest.raises(UserException) as e:
+        push(server.socket_path, '/wal/' + name).get()
+
+    assert e.value.detail == detail
+    assert server.backup_cxt.archived == []
+
+
+def test_no_daemon(tmpdir):
+    with pytest.raises(UserException) as e:
+        daemon.push(unicode(tmpdir.join('sock')), '/wal/whatever')
+
+    assert 'daemon' in e.value.hint
+
+
+def test_stale_socket_replaced(tmpdir):
+    socket_path = unicode(tmpdir.join('sock'))
+
+    first = daemon.WalPushServer(FakeBackup(), socket_path)
+    first.start()
+    with pytest.raises(UserException):
+        daemon.WalPushServer(FakeBackup(), socket_path).start()
+
+    # Leave the socket file behind, as a crashed daemon would.
+    first._server.close()
+    assert os.path.exists(socket_path)
+
+    second = daemon.WalPushServer(FakeBackup(), socket_path)
+    second.start()
+    try:
+        push(socket_path, '/wal/000000010000000000000001').get()
+        assert len(second.backup_cxt.archived) == 1
+    finally:
+        second.stop()
+
+
+def test_stop_finishes_accepted(server):
+    server.backup_cxt.release.clear()
+    result = push(server.socket_path, '/wal/000000010000000000000001')
+    gevent.sleep(0.05)
+
+    stopper = gevent.spawn(server.stop)
+    gevent.sleep(0.05)
+    assert not os.path.exists(server.socket_path)
+    assert not stopper.ready()
+
+    server.backup_cxt.release.set()
+    stopper.get()
+    result.get()
+    assert len(server.backup_cxt.archived) == 1
+
+
+def test_push_options_rejected(tmpdir):
+    """Options the daemon would ignore are refused by wal-push"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(daemon.__file__))
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'wal_e.cmd',
+         '--daemon-socket', unicode(tmpdir.join('sock')),
+         'wal-push', '--skip-archived', '/wal/000000010000000000000001'],
+        stderr=subprocess.PIPE, env=env)
+    stderr = proc.communicate()[1]
+
+    assert proc.returncode == 1
+    assert '--skip-archived' in stderr
+    assert 'could not hand' not in stderr
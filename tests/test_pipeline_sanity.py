@@ -1,5 +1,13 @@
+import errno
+import os
+import pytest
+import time
+
 import wal_e.pipeline as pipeline
 
+from wal_e import libc
+from wal_e.exception import UserCritical
+
 
 def create_bogus_payload(dirname):
     payload = 'abcd' * 1048576
@@ -46,8 +54,41 @@ def test_upload_download_pipeline(tmpdir, rate_limit):
     assert round_trip == payload
 
 
+def finish_time(command):
+    with open(os.devnull) as devnull_in:
+        with open(os.devnull, 'w') as devnull_out:
+            pl = pipeline.PipelineCommand(command, stdin=devnull_in,
+                                          stdout=devnull_out)
+            start = time.time()
+            pl.start()
+            pl.finish()
+            return time.time() - start
+
+
+def test_finish_latency(pidfd):
+    """Finishing returns soon after the process exits, without polling"""
+    assert finish_time(['sleep', '0.05']) < 0.09
+
+
+def test_finish_failure(pidfd):
+    with pytest.raises(UserCritical):
+        finish_time(['false'])
+
+
 def pytest_generate_tests(metafunc):
     # Test both with and without rate limiting if there is rate_limit
     # parameter.
     if "rate_limit" in metafunc.funcargnames:
         metafunc.parametrize("rate_limit", [None, int(2 ** 25)])
+
+
+@pytest.fixture(params=['pidfd', 'polling'])
+def pidfd(request, monkeypatch):
+    """Run a test both with and without pidfd support"""
+    if request.param == 'polling':
+        def enosys(pid):
+            raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+        monkeypatch.setattr(libc, 'pidfd_open', enosys)
+
+    return request.param
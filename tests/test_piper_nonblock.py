@@ -0,0 +1,135 @@
+import gevent
+import os
+import pytest
+import time
+
+from wal_e import piper
+
+
+def no_benchmarks():
+    return os.getenv('WALE_BENCHMARKS') is None
+
+
+def make_pipe(chunk_size=None):
+    r, w = os.pipe()
+    return (piper.NonBlockPipeFileWrap(os.fdopen(r, 'rb'), chunk_size,
+                                       grow=True),
+            piper.NonBlockPipeFileWrap(os.fdopen(w, 'wb'), chunk_size,
+                                       grow=True))
+
+
+def write_and_close(writer, payloads):
+    for payload in payloads:
+        writer.write(payload)
+    writer.close()
+
+
+def test_grow_pipe():
+    r, w = os.pipe()
+    try:
+        capacity = piper.grow_pipe(w)
+        if capacity is None:
+            pytest.skip('pipe capacity is not available on this platform')
+
+        assert capacity >= 4096
+    finally:
+        os.close(r)
+        os.close(w)
+
+
+def test_not_grown_by_default():
+    reader, writer = [os.fdopen(fd, mode)
+                      for fd, mode in zip(os.pipe(), ('rb', 'wb'))]
+    try:
+        capacity = piper.pipe_size(writer.fileno())
+        if capacity is None:
+            pytest.skip('pipe capacity is not available on this platform')
+
+        wrapped = piper.NonBlockPipeFileWrap(writer)
+        assert wrapped.chunk_size == capacity
+        assert piper.pipe_size(writer.fileno()) == capacity
+    finally:
+        reader.close()
+        writer.close()
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4096, None])
+def test_round_trip(chunk_size):
+    """Data exceeding the pipe's capacity makes it through intact"""
+    reader, writer = make_pipe(chunk_size)
+    payload = ''.join(chr(i % 251) for i in xrange(3 * 1024 * 1024 + 7))
+
+    if chunk_size == 1:
+        payload = payload[:65536 * 3]
+
+    g = gevent.spawn(write_and_close, writer, [payload])
+    assert reader.read() == payload
+    g.get()
+
+
+def test_sized_reads():
+    reader, writer = make_pipe()
+    g = gevent.spawn(write_and_close, writer, ['abc', 'defgh', 'ij'])
+
+    assert reader.read(4) == 'abcd'
+    assert reader.read(5) == 'efghi'
+
+    # Short at the end of the stream, and then empty.
+    assert reader.read(100) == 'j'
+    assert reader.read(100) == ''
+    g.get()
+
+
+def test_readinto():
+    reader, writer = make_pipe()
+    g = gevent.spawn(write_and_close, writer, ['hello', ' ', 'world'])
+
+    buf = bytearray(8)
+    assert reader.readinto(buf) == 8
+    assert buf == bytearray('hello wo')
+
+    view = memoryview(buf)
+    assert reader.readinto(view[2:]) == 3
+    assert buf[2:5] == bytearray('rld')
+    g.get()
+
+
+def test_write_buffers():
+    """Anything supporting the buffer protocol can be written"""
+    reader, writer = make_pipe()
+    g = gevent.spawn(write_and_close, writer,
+                     [bytearray('one'), memoryview('two'), buffer('three')])
+
+    assert reader.read() == 'onetwothree'
+    g.get()
+
+
+@pytest.mark.skipif("no_benchmarks()")
+@pytest.mark.parametrize('chunk_size', [4096, None])
+def test_throughput(chunk_size):
+    """Report throughput through a pipe pair
+
+    Set WALE_BENCHMARKS to run this, and pass -s to see the output:
+    the 4096 case approximates the old 4 KiB-at-a-time behavior.
+    """
+    total = 1024 ** 3
+    payload = '\0' * (8 * 1024 * 1024)
+    reader, writer = make_pipe(chunk_size)
+
+    g = gevent.spawn(write_and_close, writer,
+                     [payload] * (total // len(payload)))
+
+    start = time.time()
+    buf = bytearray(len(payload))
+    received = 0
+    while True:
+        n = reader.readinto(buf)
+        received += n
+        if n < len(buf):
+            break
+    elapsed = time.time() - start
+    g.get()
+
+    assert received == total
+    print 'chunk size {0}: {1:.2f} GiB/s'.format(
+        reader.chunk_size, total / elapsed / 1024 ** 3)
@@ -0,0 +1,166 @@
+import errno
+import os
+import pytest
+import resource
+import signal
+import time
+
+from wal_e import libc
+from wal_e import piper
+from wal_e import subprocess
+
+# Print the mask of ignored signals of a child, and its working
+# directory.  This avoids Python, which sets up its own SIGPIPE
+# disposition at startup.
+REPORT = ['sh', '-c', 'grep "^SigIgn:" /proc/self/status | cut -f2; pwd']
+
+
+def sigpipe_ignored(sigign):
+    return bool(int(sigign, 16) & (1 << (signal.SIGPIPE - 1)))
+
+
+def no_benchmarks():
+    return os.getenv('WALE_BENCHMARKS') is None
+
+
+def no_close_range(*args):
+    raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+
+def use_spawn(method, monkeypatch):
+    if method.startswith('spawn'):
+        if not libc.can_posix_spawn(chdir=True):
+            pytest.skip('posix_spawn is not usable on this platform')
+    else:
+        monkeypatch.setattr(libc, 'can_posix_spawn', lambda **kwargs: False)
+
+    if method == 'spawn':
+        if not libc.can_posix_spawn(closefrom=True):
+            pytest.skip('posix_spawn cannot close descriptors from one up')
+    elif method == 'spawn-listing':
+        # As with glibc before 2.34.
+        can_posix_spawn = libc.can_posix_spawn
+        monkeypatch.setattr(libc, 'can_posix_spawn',
+                            lambda closefrom=False, **kwargs:
+                            not closefrom and can_posix_spawn(**kwargs))
+
+    if method == 'fork-listing':
+        monkeypatch.setattr(libc, 'close_range', no_close_range)
+
+
+@pytest.fixture(params=['spawn', 'fork'])
+def spawn(request, monkeypatch):
+    """Exercise both posix_spawn and the fork fallback"""
+    use_spawn(request.param, monkeypatch)
+    return request.param
+
+
+@pytest.fixture(params=['spawn', 'spawn-listing', 'fork', 'fork-listing'])
+def close_fds_method(request, monkeypatch):
+    """Exercise every way close_fds=True can be carried out"""
+    use_spawn(request.param, monkeypatch)
+    return request.param
+
+
+def test_sigpipe_restored(spawn, tmpdir):
+    if not os.path.exists('/proc/self/status'):
+        pytest.skip('no /proc to inspect signal dispositions with')
+
+    # Python itself ignores SIGPIPE, and children inherit that unless
+    # it is reset.
+    assert signal.getsignal(signal.SIGPIPE) == signal.SIG_IGN
+
+    proc = piper.popen_sp(REPORT, stdout=subprocess.PIPE,
+                          cwd=unicode(tmpdir))
+    sigign, cwd = proc.communicate()[0].split()
+
+    assert proc.returncode == 0
+    assert not sigpipe_ignored(sigign)
+    assert cwd == unicode(tmpdir)
+
+
+def test_signals_inherited_by_default(spawn):
+    if not os.path.exists('/proc/self/status'):
+        pytest.skip('no /proc to inspect signal dispositions with')
+
+    proc = subprocess.Popen(REPORT, stdout=subprocess.PIPE)
+    sigign = proc.communicate()[0].split()[0]
+
+    assert sigpipe_ignored(sigign)
+
+
+def test_descriptors(close_fds_method):
+    """Standard streams are wired up, and nothing else leaks"""
+    r, w = os.pipe()
+    try:
+        proc = piper.popen_sp(
+            ['sh', '-c', 'cat; ls /proc/self/fd >&2'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, close_fds=True)
+        out, err = proc.communicate('hello')
+    finally:
+        os.close(r)
+        os.close(w)
+
+    assert out == 'hello'
+
+    # The directory listing itself holds one more descriptor open.
+    assert sorted(int(fd) for fd in err.split()) == [0, 1, 2, 3]
+
+
+def test_high_descriptors_closed(close_fds_method):
+    """Descriptors far above the lowest free one are closed, too"""
+    r, w = os.pipe()
+    high = 1000
+    os.dup2(w, high)
+    try:
+        proc = piper.popen_sp(['ls', '/proc/self/fd'],
+                              stdout=subprocess.PIPE, close_fds=True)
+        out = proc.communicate()[0]
+    finally:
+        os.close(high)
+        os.close(r)
+        os.close(w)
+
+    assert proc.returncode == 0
+    fds = [int(fd) for fd in out.split()]
+    assert high not in fds
+    assert r not in fds
+    assert w not in fds
+
+
+def test_missing_program(spawn):
+    with pytest.raises(OSError) as e:
+        piper.popen_sp(['wal-e-test-no-such-program'])
+
+    assert e.value.errno == errno.ENOENT
+
+
+@pytest.mark.skipif("no_benchmarks()")
+def test_spawn_latency(close_fds_method, monkeypatch):
+    """Report how long starting a program takes as the nofile limit grows
+
+    Set WALE_BENCHMARKS to run this, and pass -s to see the output.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    limits = [1024, 65536, 1024 ** 2]
+    if hard != resource.RLIM_INFINITY:
+        limits = [l for l in limits if l <= hard] + [hard]
+
+    n = 100
+    try:
+        for limit in limits:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+
+            # As seen by a process started with this limit.
+            monkeypatch.setattr(subprocess, 'MAXFD', limit)
+
+            start = time.time()
+            for i in xrange(n):
+                piper.popen_sp(['true'], close_fds=True).wait()
+            elapsed = time.time() - start
+
+            print '{0}, nofile {1}: {2:.2f} ms per program'.format(
+                close_fds_method, limit, elapsed / n * 1000)
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
@@ -0,0 +1,206 @@
+import os
+import pytest
+import time
+
+from conftest import segment_name
+from wal_e.operator import s3_operator
+from wal_e.worker import prefetch
+
+
+@pytest.fixture
+def xlog(tmpdir):
+    return tmpdir.mkdir('pg_xlog')
+
+
+@pytest.fixture
+def pd(xlog):
+    return prefetch.Dirs(unicode(xlog))
+
+
+def prefetched(pd, name, content='prefetched'):
+    path = pd.download_path(name)
+    with open(path, 'wb') as f:
+        f.write(content)
+    assert pd.complete(name, path)
+
+
+def make_stale(path):
+    past = time.time() - prefetch.STALE_SECONDS - 1
+    os.utime(path, (past, past))
+
+
+def test_promote(pd, xlog):
+    destination = unicode(xlog.join('RECOVERYXLOG'))
+    assert not pd.promote(segment_name(1), destination)
+
+    prefetched(pd, segment_name(1))
+    assert pd.contains(segment_name(1))
+    assert pd.promote(segment_name(1), destination)
+
+    assert not pd.contains(segment_name(1))
+    assert open(destination).read() == 'prefetched'
+
+
+def test_running(pd):
+    assert pd.running_size(segment_name(1)) is None
+
+    path = pd.download_path(segment_name(1))
+    with open(path, 'wb') as f:
+        f.write('partial')
+    assert pd.running_size(segment_name(1)) == len('partial')
+    assert not pd.contains(segment_name(1))
+
+    make_stale(path)
+    assert not pd.is_running(segment_name(1))
+
+
+def test_clear_before(pd):
+    for n in (1, 2, 3):
+        prefetched(pd, segment_name(n))
+
+    running = pd.download_path(segment_name(1))
+    stale = pd.download_path(segment_name(4))
+    make_stale(stale)
+    fresh = pd.download_path(segment_name(5))
+
+    # Prefetches from other timelines only count by their position.
+    prefetched(pd, '00000002' + segment_name(1)[8:])
+    prefetched(pd, '00000002' + segment_name(2)[8:])
+
+    pd.clear_before(segment_name(2))
+
+    assert not pd.contains(segment_name(1))
+    assert pd.contains(segment_name(2))
+    assert pd.contains(segment_name(3))
+    assert not pd.contains('00000002' + segment_name(1)[8:])
+    assert pd.contains('00000002' + segment_name(2)[8:])
+
+    assert not os.path.exists(running)
+    assert not os.path.exists(stale)
+    assert os.path.exists(fresh)
+
+    pd.clear_through(segment_name(2))
+    assert not pd.contains(segment_name(2))
+    assert pd.contains(segment_name(3))
+    assert not pd.contains('00000002' + segment_name(2)[8:])
+
+
+def restore(xlog, name, prefetch_max, miss_ttl=0):
+    backup = s3_operator.S3Backup('id', 'secret', 's3://bucket/prefix', None)
+    destination = unicode(xlog.join('RECOVERYXLOG'))
+    assert backup.wal_s3_restore(name, destination, prefetch_max=prefetch_max,
+                                 miss_ttl=miss_ttl)
+    return open(destination).read()
+
+
+def test_restore_starts_prefetches(xlog, s3):
+    assert restore(xlog, segment_name(1), 3) == 'from s3 ' + segment_name(1)
+    assert s3.prefetches == [segment_name(n) for n in (2, 3, 4)]
+
+
+def test_restore_without_prefetch(xlog, s3):
+    restore(xlog, segment_name(1), 0)
+    assert s3.prefetches == []
+    assert not xlog.join('.wal-e').check()
+
+
+def test_restore_prefetched(xlog, pd, s3):
+    prefetched(pd, segment_name(1))
+    prefetched(pd, segment_name(3))
+    pd.download_path(segment_name(4))
+
+    assert restore(xlog, segment_name(1), 4) == 'prefetched'
+    assert s3.fetched == []
+
+    # Only what is neither downloaded nor being downloaded is started.
+    assert s3.prefetches == [segment_name(2), segment_name(5)]
+
+
+def test_restore_clears_prefetched(xlog, pd, s3):
+    for n in (1, 2, 3):
+        prefetched(pd, segment_name(n))
+
+    assert restore(xlog, segment_name(2), 0) == 'from s3 ' + segment_name(2)
+    assert not pd.contains(segment_name(1))
+    assert not pd.contains(segment_name(2))
+    assert pd.contains(segment_name(3))
+
+
+def test_history_not_prefetched(xlog, pd, s3):
+    prefetched(pd, segment_name(1))
+
+    restore(xlog, '00000002.history', 4)
+    assert s3.prefetches == []
+    assert pd.contains(segment_name(1))
+
+
+def test_prefetch(xlog, pd, s3):
+    backup = s3_operator.S3Backup('id', 'secret', 's3://bucket/prefix', None)
+
+    backup.wal_s3_prefetch(unicode(xlog), segment_name(1))
+    assert pd.contains(segment_name(1))
+    assert os.listdir(pd.running) == []
+
+    # Already there, so not downloaded again.
+    backup.wal_s3_prefetch(unicode(xlog), segment_name(1))
+    assert s3.fetched == [segment_name(1)]
+
+    backup.wal_s3_prefetch(unicode(xlog), 'missing')
+    assert not pd.contains('missing')
+    assert os.listdir(pd.running) == []
+
+
+@pytest.mark.parametrize('miss_ttl', [0, 60])
+def test_miss_remembered(xlog, s3, miss_ttl):
+    backup = s3_operator.S3Backup('id', 'secret', 's3://bucket/prefix', None)
+    destination = unicode(xlog.join('RECOVERYXLOG'))
+    s3.missing.add('00000003.history')
+
+    for i in (1, 2):
+        assert not backup.wal_s3_restore('00000003.history', destination,
+                                         miss_ttl=miss_ttl)
+
+    if miss_ttl:
+        assert s3.fetched == ['00000003.history']
+    else:
+        assert s3.fetched == ['00000003.history'] * 2
+
+    # Other archives have misses of their own.
+    other = s3_operator.S3Backup('id', 'secret', 's3://bucket/other', None)
+    assert not other.wal_s3_restore('00000003.history', destination,
+                                    miss_ttl=miss_ttl)
+    assert s3.fetched[-1] == '00000003.history'
+    assert len(s3.fetched) == (2 if miss_ttl else 3)
+
+
+def test_missing_not_prefetched(xlog, s3):
+    backup = s3_operator.S3Backup('id', 'secret', 's3://bucket/prefix', None)
+    s3.missing.add(segment_name(3))
+
+    backup.wal_s3_prefetch(unicode(xlog), segment_name(3), miss_ttl=60)
+    backup.wal_s3_prefetch(unicode(xlog), segment_name(3), miss_ttl=60)
+    assert s3.fetched == [segment_name(3)]
+
+    restore(xlog, segment_name(1), 3, miss_ttl=60)
+    assert s3.prefetches == [segment_name(2), segment_name(4)]
+
+
+def test_restore_from_bundle(xlog, s3):
+    s3.bundled.add(segment_name(1))
+
+    assert restore(xlog, segment_name(1), 0) == (
+        'from bundle s3://bucket/prefix/wal_005/bundles/{0}.bundle '
+        '4096-4100'.format(segment_name(1)))
+
+
+def test_bundles_only_looked_in_when_used(xlog, s3):
+    backup = s3_operator.S3Backup('id', 'secret', 's3://bucket/prefix', None)
+    destination = unicode(xlog.join('RECOVERYXLOG'))
+
+    s3.missing.add(segment_name(1))
+    assert not backup.wal_s3_restore(segment_name(1), destination)
+    assert s3.bundle_lookups == []
+
+    s3.bundled.add(segment_name(2))
+    assert not backup.wal_s3_restore(segment_name(1), destination)
+    assert s3.bundle_lookups == [segment_name(1)]
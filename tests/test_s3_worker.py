@@ -1,6 +1,9 @@
 import os
 import pytest
 
+from conftest import FakeConnection
+from conftest import listed_sentinel_name, segment_name, sentinel_name
+from wal_e.storage import s3_storage
 from wal_e.worker import s3_worker
 
 
@@ -74,3 +77,344 @@ def test_ordinary_calling_format_upcase():
     expected = 's3.amazonaws.com'
     result = s3_worker.s3_endpoint_for_uri(uri)
     assert result == expected
+
+
+@pytest.fixture
+def cat_pipeline(monkeypatch):
+    """Have uploads pass through cat, rather than lzop"""
+    from wal_e import pipeline
+
+    def get_upload_pipeline(in_fd, out_fd, rate_limit=None, gpg_key=None):
+        return pipeline.Pipeline([pipeline.PipelineCommand(['cat'])],
+                                 in_fd, out_fd)
+
+    monkeypatch.setattr(s3_worker, 'get_upload_pipeline',
+                        get_upload_pipeline)
+
+
+class FakePut(object):
+    def __init__(self, monkeypatch):
+        monkeypatch.setattr(s3_worker, 's3_put_compressed', self)
+
+    def __call__(self, s3_url, fp, md5=None, segment_size=None,
+                 segment_md5=None):
+        self.s3_url = s3_url
+        self.in_memory = not fp._rolled
+        self.md5 = md5
+        self.segment_size = segment_size
+
+        fp.seek(0)
+        self.contents = fp.read()
+        return '1'
+
+
+@pytest.mark.parametrize('max_size', [s3_worker.WAL_BUFFER_MAX_SZ, 1024])
+def test_lzop_s3_put_buffer(tmpdir, cat_pipeline, monkeypatch, max_size):
+    import hashlib
+
+    monkeypatch.setattr(s3_worker, 'WAL_BUFFER_MAX_SZ', max_size)
+    put = FakePut(monkeypatch)
+
+    contents = os.urandom(3 * 1024 * 1024 + 7)
+    segment = tmpdir.join('000000010000000000000001')
+    segment.write(contents, mode='wb')
+
+    s3_worker.do_lzop_s3_put('s3://bucket/wal/000000010000000000000001',
+                             unicode(segment), None)
+
+    assert put.s3_url == 's3://bucket/wal/000000010000000000000001.lzo'
+    assert put.contents == contents
+    assert put.md5[0] == hashlib.md5(contents).hexdigest()
+    assert put.md5[1] == hashlib.md5(contents).digest().encode('base64')[:-1]
+
+    # Only files larger than the buffer go to disk.
+    assert put.in_memory == (max_size > len(contents))
+
+
+def test_trimmed_size(tmpdir, monkeypatch):
+    monkeypatch.setattr(s3_worker, 'ZERO_SCAN_CHUNK_SZ', 1000)
+    monkeypatch.setattr(s3_worker, 'ZERO_TAIL_MIN_SZ', 1500)
+    monkeypatch.setattr(s3_worker, '_ZEROS', '\0' * 1000)
+
+    def trimmed_size(contents):
+        path = tmpdir.join('segment')
+        path.write(contents, mode='wb')
+        return s3_worker.trimmed_size(unicode(path))
+
+    assert trimmed_size('x' * 10 + '\0' * 3000) == (10, 3010)
+    assert trimmed_size('x' * 2500 + '\0' * 1500) == (2500, 4000)
+    assert trimmed_size('x' * 3000 + '\0' * 1499) is None
+    assert trimmed_size('\0' * 2000) == (0, 2000)
+    assert trimmed_size('') is None
+
+
+def test_lzop_s3_put_trimmed(tmpdir, cat_pipeline, monkeypatch):
+    put = FakePut(monkeypatch)
+
+    contents = os.urandom(1024 * 1024 + 7)
+    segment = tmpdir.join('000000010000000000000001')
+    segment.write(contents + '\0' * (s3_worker.ZERO_TAIL_MIN_SZ + 3),
+                  mode='wb')
+
+    s3_worker.do_lzop_s3_put('s3://bucket/wal/000000010000000000000001',
+                             unicode(segment), None, trim_zero_tail=True)
+
+    assert put.contents == contents
+    assert put.segment_size == segment.size()
+
+    # Not without being asked to.
+    s3_worker.do_lzop_s3_put('s3://bucket/wal/000000010000000000000001',
+                             unicode(segment), None)
+    assert put.contents == segment.read(mode='rb')
+    assert put.segment_size is None
+
+
+def test_copy_of_shrunk_file(tmpdir):
+    from StringIO import StringIO
+
+    class Stream(StringIO):
+        def close(self):
+            self.closed_at = self.getvalue()
+
+    path = tmpdir.join('segment')
+    path.write('x' * 10)
+    stream = Stream()
+
+    with open(unicode(path), 'rb') as f:
+        with pytest.raises(s3_worker.UserException):
+            s3_worker._copy_and_close(f, stream, 20)
+
+    assert stream.closed_at == 'x' * 10
+
+
+class FakeLocationConnection(object):
+    """Answers get_bucket(...).get_location(), counting the requests"""
+
+    def __init__(self, location):
+        self.location = location
+        self.lookups = 0
+
+    def get_bucket(self, bucket_name):
+        self.lookups += 1
+        return self
+
+    def get_location(self):
+        return self.location
+
+
+def test_s3_endpoint_remembered(monkeypatch):
+    monkeypatch.setattr(s3_worker.s3_endpoint_for_uri, 'cache', {})
+    conn = FakeLocationConnection('us-west-1')
+
+    uri = 's3://wal-e-test-bucket/prefix'
+    assert (s3_worker.s3_endpoint_for_uri(uri, connection=conn) ==
+            's3-us-west-1.amazonaws.com')
+    assert conn.lookups == 1
+
+    # As in a new invocation.
+    s3_worker.s3_endpoint_for_uri.cache.clear()
+    assert (s3_worker.s3_endpoint_for_uri(uri, connection=conn) ==
+            's3-us-west-1.amazonaws.com')
+    assert conn.lookups == 1
+
+
+def test_s3_endpoint_forgotten_when_wrong(monkeypatch):
+    from boto.exception import S3ResponseError
+
+    monkeypatch.setattr(s3_worker.s3_endpoint_for_uri, 'cache', {})
+    uri = 's3://wal-e-test-bucket/prefix'
+    s3_worker.s3_endpoint_for_uri(
+        uri, connection=FakeLocationConnection('eu-west-1'))
+
+    with pytest.raises(S3ResponseError):
+        with s3_worker.forgetting_wrong_endpoint(uri):
+            raise S3ResponseError(404, 'Not Found')
+
+    s3_worker.s3_endpoint_for_uri.cache.clear()
+    conn = FakeLocationConnection('us-west-2')
+    assert (s3_worker.s3_endpoint_for_uri(uri, connection=conn) ==
+            's3-eu-west-1.amazonaws.com')
+
+    with pytest.raises(S3ResponseError):
+        with s3_worker.forgetting_wrong_endpoint(uri):
+            raise S3ResponseError(301, 'Moved Permanently')
+
+    assert (s3_worker.s3_endpoint_for_uri(uri, connection=conn) ==
+            's3-us-west-2.amazonaws.com')
+    assert conn.lookups == 1
+
+
+class FakeResponse(object):
+    def __init__(self, status, body='', headers={}):
+        self.status = status
+        self.reason = 'Fake'
+        self.body = body
+        self.msg = dict(headers, **{'content-length': str(len(body))})
+
+    def read(self, amt=None):
+        if amt is None:
+            amt = len(self.body)
+        chunk, self.body = self.body[:amt], self.body[amt:]
+        return chunk
+
+    def getheader(self, name, default=None):
+        return self.msg.get(name, default)
+
+    def getheaders(self):
+        return self.msg.items()
+
+
+class FakeS3Connection(object):
+    """Serves objects from a dictionary, recording the requests made"""
+
+    def __init__(self, objects):
+        import boto.provider
+
+        self.objects = objects
+        self.headers = {}
+        self.requests = []
+        self.debug = 0
+        self.provider = boto.provider.Provider(
+            'aws', access_key='id', secret_key='secret')
+
+    def make_request(self, method, bucket, key, headers=None, **kwargs):
+        self.requests.append((method, key))
+        if key in self.objects:
+            return FakeResponse(200, self.objects[key],
+                                self.headers.get(key, {}))
+
+        return FakeResponse(404, '<Error><Code>NoSuchKey</Code></Error>')
+
+
+@pytest.fixture
+def fake_s3(monkeypatch):
+    from boto.s3.bucket import Bucket
+    from wal_e import pipeline
+
+    conn = FakeS3Connection({'prefix/wal_005/segment.lzo': 'contents'})
+
+    class FakeStorageUri(object):
+        def get_bucket(self):
+            return Bucket(conn, 'bucket')
+
+    def get_download_pipeline(in_fd, out_fd, gpg=False):
+        return pipeline.Pipeline([pipeline.PipelineCommand(['cat'])],
+                                 in_fd, out_fd)
+
+    monkeypatch.setattr(s3_worker, 's3_uri_wrap',
+                        lambda s3_uri: FakeStorageUri())
+    monkeypatch.setattr(s3_worker, 'get_download_pipeline',
+                        get_download_pipeline)
+    return conn
+
+
+def test_lzop_s3_get_single_request(tmpdir, fake_s3):
+    path = unicode(tmpdir.join('segment'))
+
+    assert s3_worker.do_lzop_s3_get(
+        's3://bucket/prefix/wal_005/segment.lzo', path, False)
+    assert open(path).read() == 'contents'
+    assert fake_s3.requests == [('GET', 'prefix/wal_005/segment.lzo')]
+
+
+def test_lzop_s3_get_missing(tmpdir, fake_s3):
+    path = unicode(tmpdir.join('segment'))
+
+    assert not s3_worker.do_lzop_s3_get(
+        's3://bucket/prefix/wal_005/missing.lzo', path, False)
+    assert fake_s3.requests == [('GET', 'prefix/wal_005/missing.lzo')]
+
+
+def test_lzop_s3_get_trimmed(tmpdir, fake_s3):
+    path = unicode(tmpdir.join('segment'))
+    fake_s3.headers['prefix/wal_005/segment.lzo'] = {
+        'x-amz-meta-' + s3_worker.SEGMENT_SIZE_METADATA: '20'}
+
+    assert s3_worker.do_lzop_s3_get(
+        's3://bucket/prefix/wal_005/segment.lzo', path, False)
+    assert open(path, 'rb').read() == 'contents' + '\0' * 12
+    assert fake_s3.requests == [('GET', 'prefix/wal_005/segment.lzo')]
+
+
+def test_s3_archived_md5(fake_s3):
+    fake_s3.objects['prefix/wal_005/recorded.lzo'] = 'contents'
+    fake_s3.headers['prefix/wal_005/recorded.lzo'] = {
+        'x-amz-meta-' + s3_worker.SEGMENT_MD5_METADATA: 'abc'}
+
+    assert (s3_worker.s3_archived_md5(
+        's3://bucket/prefix/wal_005/recorded.lzo') == 'abc')
+    assert (s3_worker.s3_archived_md5(
+        's3://bucket/prefix/wal_005/segment.lzo') == '')
+    assert (s3_worker.s3_archived_md5(
+        's3://bucket/prefix/wal_005/missing.lzo') is None)
+
+    assert [method for method, key in fake_s3.requests] == ['HEAD'] * 3
+
+
+def delete_context(bucket, dry_run=False):
+    layout = s3_storage.StorageLayout('s3://bucket/prefix')
+    return s3_worker.DeleteFromContext(FakeConnection(bucket), layout,
+                                       dry_run=dry_run)
+
+
+def test_delete_before_listed_sentinels(bucket):
+    for n in (1, 5):
+        bucket.objects[listed_sentinel_name(n)] = ''
+
+    delete_context(bucket).delete_before(
+        s3_storage.SegmentNumber(log='00000000', seg='00000003'))
+
+    assert bucket.objects.keys() == [listed_sentinel_name(5)]
+
+
+@pytest.mark.parametrize('dry_run', [True, False])
+def test_delete_in_batches(bucket, monkeypatch, dry_run):
+    monkeypatch.setattr(s3_worker, 'DELETE_BATCH_SIZE', 2)
+    names = [sentinel_name(n) for n in xrange(5)]
+    for name in names:
+        bucket.objects[name] = ''
+
+    delete_context(bucket, dry_run=dry_run).delete_everything()
+
+    if dry_run:
+        assert bucket.delete_batches == []
+        assert len(bucket.objects) == 5
+    else:
+        assert bucket.delete_batches == [names[:2], names[2:4], names[4:]]
+        assert bucket.objects == {}
+
+
+def test_delete_errors(bucket):
+    for n in xrange(3):
+        bucket.objects[sentinel_name(n)] = ''
+    bucket.undeletable.add(sentinel_name(1))
+
+    with pytest.raises(s3_worker.UserException):
+        delete_context(bucket).delete_everything()
+
+    assert bucket.objects.keys() == [sentinel_name(1)]
+
+
+def test_delete_before_lists_only_what_qualifies(bucket):
+    for tli in (1, 2):
+        bucket.objects['prefix/wal_005/{0:08X}.history'.format(tli)] = ''
+        for n in xrange(1, 200):
+            bucket.objects['prefix/wal_005/{0}.lzo'.format(
+                segment_name(n, tli=tli))] = ''
+            bucket.objects['prefix/basebackups_005/base_{0}_00000020/'
+                           'tar_partitions/part_1.tar.lzo'.format(
+                               segment_name(n, tli=tli))] = ''
+    bucket.objects['prefix/wal_005/bundles/{0}_{1}.bundle'.format(
+        segment_name(4), segment_name(1))] = ''
+
+    delete_context(bucket).delete_before(
+        s3_storage.SegmentNumber(log='00000000', seg='00000003'))
+
+    assert len(bucket.objects) == 2 * (1 + 197 * 2) + 1
+    assert 'prefix/wal_005/{0}.lzo'.format(segment_name(2)) not in \
+        bucket.objects
+    assert 'prefix/wal_005/{0}.lzo'.format(segment_name(3)) in bucket.objects
+
+    # Each timeline is listed up to the first key that does not
+    # qualify, and no further.
+    assert len(bucket.scanned) < 20
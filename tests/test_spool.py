@@ -0,0 +1,288 @@
+import gevent
+import os
+import pytest
+import time
+
+from conftest import segment_name
+from wal_e.exception import UserException
+from wal_e.operator import s3_operator
+from wal_e.worker import s3_worker
+from wal_e.worker import spool as spool_module
+from wal_e.worker.spool import Spool
+
+
+@pytest.fixture
+def spool(tmpdir):
+    return Spool(unicode(tmpdir.join('spool')), max_bytes=100)
+
+
+@pytest.fixture
+def xlog(tmpdir):
+    xlog = tmpdir.mkdir('pg_xlog')
+    xlog.mkdir('archive_status')
+
+    for n in (1, 2, 3):
+        xlog.join(segment_name(n)).write('x' * 40)
+
+    return xlog
+
+
+def test_spool(spool):
+    assert spool.pending() == []
+    assert spool.usage() == 0
+
+    spool.add(segment_name(2), lambda f: f.write('two'))
+    spool.add(segment_name(1), lambda f: f.write('one'))
+    assert spool.pending() == [segment_name(1), segment_name(2)]
+    assert spool.usage() == 6
+
+    with spool.open(segment_name(2) + '.lzo') as f:
+        assert f.read() == 'two'
+
+    spool.remove(segment_name(2) + '.lzo')
+    assert spool.pending() == [segment_name(1)]
+
+
+def test_failed_add_leaves_nothing(spool):
+    def fail(f):
+        f.write('partial')
+        raise UserException(msg='could not compress')
+
+    with pytest.raises(UserException):
+        spool.add(segment_name(1), fail)
+
+    assert os.listdir(spool.directory) == []
+
+
+def test_drain_lock(spool):
+    lock = spool.try_lock_drain()
+    assert lock is not None
+    assert spool.try_lock_drain() is None
+
+    lock.close()
+    spool.try_lock_drain().close()
+
+
+class FakeClock(object):
+    """Lets time pass in a drain without waiting for it"""
+
+    def __init__(self, monkeypatch):
+        self.slept = []
+
+        monkeypatch.setattr(gevent, 'sleep', self.sleep)
+        monkeypatch.setattr(spool_module, 'time', self)
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+
+    def time(self):
+        return time.time() + sum(self.slept)
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    return FakeClock(monkeypatch)
+
+
+def backup():
+    return s3_operator.S3Backup('id', 'secret', 's3://bucket/prefix', None)
+
+
+def test_push_spooled(xlog, spool, s3):
+    backup().wal_s3_archive(unicode(xlog.join(segment_name(1))), spool=spool)
+
+    assert spool.pending() == [segment_name(1)]
+    with spool.open(segment_name(1) + '.lzo') as f:
+        assert f.read() == 'compressed ' + 'x' * 40
+
+    assert s3.synchronous == []
+    assert s3.started == [('wal-spool-drain', '--spool-dir', spool.directory,
+                           '--pool-size', '1')]
+
+
+def test_full_spool_synchronous(xlog, spool, s3):
+    for n in (1, 2, 3):
+        backup().wal_s3_archive(unicode(xlog.join(segment_name(n))),
+                                spool=spool)
+
+    # The third would take the spool past its maximum.
+    assert spool.pending() == [segment_name(1), segment_name(2)]
+    assert s3.synchronous == [segment_name(3)]
+
+
+def test_drain(spool, s3):
+    for n in (1, 2, 3):
+        spool.add(segment_name(n), lambda f: f.write(str(n)))
+
+    s3.fail = (segment_name(2) + '.lzo',)
+    backup().wal_s3_spool_drain(spool, concurrency=2)
+
+    assert s3.uploaded == {
+        's3://bucket/prefix/wal_005/{0}.lzo'.format(segment_name(1)): '1',
+        's3://bucket/prefix/wal_005/{0}.lzo'.format(segment_name(3)): '3'}
+    assert spool.pending() == [segment_name(2)]
+
+    s3.fail = ()
+    backup().wal_s3_spool_drain(spool, concurrency=2)
+    assert spool.pending() == []
+    assert len(s3.uploaded) == 3
+
+
+def test_drain_lists_once_per_batch(tmpdir, s3, monkeypatch):
+    spool = Spool(unicode(tmpdir.join('spool')), max_bytes=1000)
+    for n in xrange(1, 21):
+        spool.add(segment_name(n), lambda f: f.write(str(n)))
+
+    listings = []
+    listdir = os.listdir
+    monkeypatch.setattr(os, 'listdir',
+                        lambda path: listings.append(path) or listdir(path))
+    backup().wal_s3_spool_drain(spool, concurrency=4)
+
+    # Not once per segment, but for temporary files, for the batch,
+    # to find the spool empty, once unlocked, and just above.
+    assert spool.pending() == []
+    assert len(listings) == 5
+
+
+def test_drain_exclusive(spool, s3):
+    spool.add(segment_name(1), lambda f: f.write('1'))
+
+    lock = spool.try_lock_drain()
+    backup().wal_s3_spool_drain(spool)
+    lock.close()
+
+    assert s3.uploaded == {}
+    assert spool.pending() == [segment_name(1)]
+
+
+def test_drain_bundles(tmpdir, s3, clock):
+    spool = Spool(unicode(tmpdir.join('spool')), max_bytes=100,
+                  bundle_size=2, bundle_max_age=60)
+    for n in (1, 2, 3, 5, 6, 7):
+        spool.add(segment_name(n), lambda f: f.write(str(n)))
+
+    backup().wal_s3_spool_drain(spool)
+
+    # 3 cannot be bundled with anything, and 7 could have been bundled
+    # with 8, had it been spooled within a minute.
+    assert s3.bundles == {
+        's3://bucket/prefix/wal_005/bundles/{0}_{1}.bundle'.format(
+            segment_name(2), segment_name(1)):
+        [(segment_name(1), '1'), (segment_name(2), '2')],
+        's3://bucket/prefix/wal_005/bundles/{0}_{1}.bundle'.format(
+            segment_name(6), segment_name(5)):
+        [(segment_name(5), '5'), (segment_name(6), '6')]}
+    assert sorted(s3.uploaded) == [
+        's3://bucket/prefix/wal_005/{0}.lzo'.format(segment_name(n))
+        for n in (3, 7)]
+    assert spool.pending() == []
+    assert 59 < sum(clock.slept) <= 60
+
+
+def test_drain_waits_for_bundle(tmpdir, s3, clock, monkeypatch):
+    spool = Spool(unicode(tmpdir.join('spool')), max_bytes=100,
+                  bundle_size=2, bundle_max_age=60)
+    spool.add(segment_name(1), lambda f: f.write('1'))
+
+    # The next WAL file is pushed while the drainer is waiting, and
+    # finds the spool still being drained.
+    def sleep(seconds):
+        clock.slept.append(seconds)
+        if len(clock.slept) == 10:
+            spool.add(segment_name(2), lambda f: f.write('2'))
+
+    monkeypatch.setattr(gevent, 'sleep', sleep)
+    backup().wal_s3_spool_drain(spool)
+
+    assert s3.bundles.keys() == [
+        's3://bucket/prefix/wal_005/bundles/{0}_{1}.bundle'.format(
+            segment_name(2), segment_name(1))]
+    assert s3.uploaded == {}
+    assert spool.pending() == []
+    assert len(clock.slept) == 10
+
+
+def test_drain_started_with_bundling(tmpdir, xlog, s3):
+    spool = Spool(unicode(tmpdir.join('spool')), max_bytes=100,
+                  bundle_size=4, bundle_max_age=60)
+    backup().wal_s3_archive(unicode(xlog.join(segment_name(1))), spool=spool)
+
+    assert s3.started == [('wal-spool-drain', '--spool-dir', spool.directory,
+                           '--pool-size', '1', '--bundle-size', '4',
+                           '--bundle-max-age', '60')]
+
+
+def test_history_not_spooled(xlog, spool, s3):
+    xlog.join('00000002.history').write('history')
+    backup().wal_s3_archive(unicode(xlog.join('00000002.history')),
+                            spool=spool)
+
+    assert spool.pending() == []
+    assert s3.synchronous == ['00000002.history']
+
+
+def test_push_spooled_trimmed(xlog, spool, s3, monkeypatch):
+    monkeypatch.setattr(s3_worker, 'ZERO_TAIL_MIN_SZ', 10)
+    xlog.join(segment_name(1)).write('x' * 10 + '\0' * 30)
+
+    backup().wal_s3_archive(unicode(xlog.join(segment_name(1))), spool=spool,
+                            trim_zero_tail=True)
+
+    entry = spool.spooled()[segment_name(1)]
+    assert entry == segment_name(1) + '.40.lzo'
+    assert spool.segment_size(entry) == 40
+    with spool.open(entry) as f:
+        assert f.read() == 'compressed ' + 'x' * 10
+
+    backup().wal_s3_spool_drain(spool)
+    url = 's3://bucket/prefix/wal_005/{0}.lzo'.format(segment_name(1))
+    assert s3.uploaded == {url: 'compressed ' + 'x' * 10}
+    assert s3.sizes == {url: 40}
+
+
+def test_drain_indexed(tmpdir, xlog, s3):
+    spool = Spool(unicode(tmpdir.join('spool')), max_bytes=100,
+                  bundle_size=2, bundle_max_age=60)
+    backup().wal_s3_archive(unicode(xlog.join(segment_name(1))), spool=spool,
+                            index_wal=True)
+    assert s3.started[0][-1] == '--wal-index'
+
+    spool.add(segment_name(2), lambda f: f.write('2'))
+    backup().wal_s3_spool_drain(spool)
+    assert s3.indexed == []
+
+    spool.add(segment_name(4), lambda f: f.write('4'))
+    backup().wal_s3_spool_drain(spool, index_wal=True)
+    assert s3.indexed == [('s3://bucket/prefix/wal_005', [segment_name(4)])]
+
+
+def test_push_spooled_skip_archived(tmpdir, xlog, s3):
+    spool = Spool(unicode(tmpdir.join('spool')), max_bytes=100,
+                  bundle_size=2, bundle_max_age=60)
+    md5 = s3_worker.file_md5(unicode(xlog.join(segment_name(1))))
+    url = 's3://bucket/prefix/wal_005/{0}.lzo'.format(segment_name(1))
+
+    # The MD5 is spooled along with the segment, and recorded with it.
+    backup().wal_s3_archive(unicode(xlog.join(segment_name(1))),
+                            spool=spool, skip_archived=True)
+    assert spool.segment_md5(spool.spooled()[segment_name(1)]) == md5
+    backup().wal_s3_spool_drain(spool)
+    assert s3.md5s == {url: md5}
+
+    s3.archived[url] = md5
+    backup().wal_s3_archive(unicode(xlog.join(segment_name(1))),
+                            spool=spool, skip_archived=True)
+    assert spool.pending() == []
+
+    # Likewise for segments uploaded in bundles.
+    for n in (2, 3):
+        backup().wal_s3_archive(unicode(xlog.join(segment_name(n))),
+                                spool=spool, skip_archived=True)
+    backup().wal_s3_spool_drain(spool)
+    assert s3.md5s[segment_name(3)] == md5
+
+    s3.bundled.update([segment_name(2), segment_name(3)])
+    backup().wal_s3_archive(unicode(xlog.join(segment_name(3))),
+                            spool=spool, skip_archived=True)
+    assert spool.pending() == []
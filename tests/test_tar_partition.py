@@ -0,0 +1,136 @@
+import gevent
+import os
+import pytest
+import tarfile
+
+from cStringIO import StringIO
+
+from wal_e import libc
+from wal_e import piper
+from wal_e import tar_partition
+
+
+def make_cluster(tmpdir, sizes):
+    """Create files in a cluster directory with distinctive contents"""
+    cluster = tmpdir.mkdir('cluster')
+    payloads = {}
+
+    for i, size in enumerate(sizes):
+        name = 'file{0}'.format(i)
+        payload = chr(ord('a') + i) * size
+        payloads[name] = payload
+
+        with open(unicode(cluster.join(name)), 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+    return cluster, payloads
+
+
+def partition(cluster):
+    root = unicode(cluster)
+    paths = sorted(os.path.join(root, name) for name in os.listdir(root))
+    parts = list(tar_partition._segmentation_guts(
+        root, paths, tar_partition.PARTITION_MAX_SZ))
+    assert len(parts) == 1
+    return parts
+
+
+def archive(cluster, direct_io=False):
+    """Archive a cluster into a single tar, returning its members"""
+    parts = partition(cluster)
+
+    out = StringIO()
+    parts[0].tarfile_write(out, direct_io=direct_io)
+
+    out.seek(0)
+    tar = tarfile.open(fileobj=out, mode='r|')
+    return dict((member.name, tar.extractfile(member).read())
+                for member in tar if member.isfile())
+
+
+def write_through_pipe(tpart):
+    """Write a tar partition to a pipe, enabling zero-copy writing"""
+    r, w = os.pipe()
+    reader = gevent.spawn(piper.NonBlockPipeFileWrap(os.fdopen(r, 'rb')).read)
+
+    writer = piper.NonBlockPipeFileWrap(os.fdopen(w, 'wb'))
+    tpart.tarfile_write(writer)
+    writer.close()
+
+    return reader.get()
+
+
+def resident_count(path):
+    with open(path, 'rb') as f:
+        vec = libc.resident_pages(f.fileno(), os.fstat(f.fileno()).st_size)
+    return sum(ord(c) & 1 for c in vec)
+
+
+@pytest.mark.parametrize('direct_io', [False, True])
+def test_round_trip(tmpdir, direct_io):
+    cluster, payloads = make_cluster(tmpdir, [4096, 8192 * 128, 0, 4096 * 3])
+    assert archive(cluster, direct_io=direct_io) == payloads
+
+
+def test_shrunken_member_is_padded(tmpdir):
+    cluster, payloads = make_cluster(tmpdir, [8192])
+    parts = partition(cluster)
+
+    # Truncate the file after its size has been recorded.
+    with open(unicode(cluster.join('file0')), 'r+b') as f:
+        f.truncate(4096)
+
+    out = StringIO()
+    parts[0].tarfile_write(out)
+    out.seek(0)
+    tar = tarfile.open(fileobj=out, mode='r|')
+    member = tar.next()
+    assert tar.extractfile(member).read() == (payloads['file0'][:4096] +
+                                              '\0' * 4096)
+
+
+def test_page_cache_left_as_found(tmpdir):
+    """Cached pages stay cached; pages brought in by the backup do not
+
+    This doubles as a measurement of how much of the page cache a
+    backup disturbs.
+    """
+    npages = 256
+    cluster, payloads = make_cluster(tmpdir, [4096 * npages] * 2)
+    warm = unicode(cluster.join('file0'))
+    cold = unicode(cluster.join('file1'))
+
+    # Warm one file up, and evict the other one.
+    with open(warm, 'rb') as f:
+        f.read()
+    with open(cold, 'rb') as f:
+        libc.posix_fadvise(f.fileno(), 0, 0, libc.POSIX_FADV_DONTNEED)
+
+    if resident_count(warm) != npages or resident_count(cold) != 0:
+        pytest.skip('the page cache of this file system cannot be '
+                    'controlled well enough to test')
+
+    assert archive(cluster) == payloads
+    assert resident_count(warm) == npages
+    assert resident_count(cold) == 0
+
+
+def test_zero_copy_identical(tmpdir):
+    """The zero-copy writer must produce exactly what tarfile would"""
+    cluster, payloads = make_cluster(tmpdir, [4096, 65536 * 3, 0, 1000])
+    cluster.mkdir('empty_directory')
+    cluster.join('x' * 150).write('a file with a long name')
+
+    parts = partition(cluster)
+
+    # Shrink a file after its size has been recorded, to have it
+    # padded out.
+    with open(unicode(cluster.join('file1')), 'r+b') as f:
+        f.truncate(4096)
+
+    expected = StringIO()
+    parts[0].tarfile_write(expected)
+
+    assert write_through_pipe(parts[0]) == expected.getvalue()
@@ -0,0 +1,114 @@
+import hashlib
+import pytest
+
+from conftest import segment_name
+from wal_e.exception import UserException
+from wal_e.worker import s3_worker
+from wal_e.worker import wal_bundle
+
+
+def test_header():
+    header = wal_bundle.header([(segment_name(1), 10, None, None),
+                                (segment_name(2), 20, 16 * 1024 ** 2,
+                                 '0' * 32)])
+    assert len(header) == wal_bundle.HEADER_SZ
+
+    assert (wal_bundle.segment_range(header, segment_name(1)) ==
+            (wal_bundle.HEADER_SZ, wal_bundle.HEADER_SZ + 9))
+    assert (wal_bundle.segment_range(header, segment_name(2)) ==
+            (wal_bundle.HEADER_SZ + 10, wal_bundle.HEADER_SZ + 29))
+    assert wal_bundle.segment_range(header, segment_name(3)) is None
+
+    assert wal_bundle.segment_size(header, segment_name(1)) is None
+    assert wal_bundle.segment_size(header, segment_name(2)) == 16 * 1024 ** 2
+
+    assert wal_bundle.segment_md5(header, segment_name(1)) is None
+    assert wal_bundle.segment_md5(header, segment_name(2)) == '0' * 32
+
+
+def test_header_without_md5s():
+    header = '{"segments":[["%s",10,null],["%s",20,40]]}' % (
+        segment_name(1), segment_name(2))
+
+    assert (wal_bundle.segment_range(header, segment_name(2)) ==
+            (wal_bundle.HEADER_SZ + 10, wal_bundle.HEADER_SZ + 29))
+    assert wal_bundle.segment_size(header, segment_name(2)) == 40
+    assert wal_bundle.segment_md5(header, segment_name(2)) is None
+
+
+def test_largest_header():
+    wal_bundle.header([(segment_name(n), 2 ** 32, 2 ** 32, 'f' * 32)
+                       for n in xrange(wal_bundle.MAX_BUNDLE_SEGMENTS)])
+
+
+def test_bundle_name():
+    names = [segment_name(n) for n in (1, 2, 3)]
+    assert (wal_bundle.parse_bundle_name(wal_bundle.bundle_name(names)) ==
+            (segment_name(1), segment_name(3)))
+    assert wal_bundle.parse_bundle_name(segment_name(1) + '.lzo') is None
+
+
+def test_consecutive_runs_across_logs():
+    names = ['0000000100000000000000FE', '0000000100000000000000FF',
+             '000000010000000100000000']
+    assert wal_bundle.consecutive_runs(names) == [names]
+    assert wal_bundle.consecutive_runs(names[::2]) == [names[::2]]
+    assert wal_bundle.consecutive_runs(names[1:]) == [names[1:]]
+
+
+def put_bundle(tmpdir, numbers):
+    names = [segment_name(n) for n in numbers]
+    segments = []
+    for name in names:
+        path = tmpdir.join(name)
+        path.write('compressed ' + name)
+        segments.append((name, path.open('rb'), len(name),
+                         hashlib.md5(name).hexdigest()))
+
+    s3_worker.s3_put_wal_bundle(
+        's3://bucket/prefix/wal_005/bundles/' + wal_bundle.bundle_name(names),
+        segments)
+
+
+def test_find_in_bundle(tmpdir, bucket):
+    put_bundle(tmpdir, (1, 2, 3))
+    put_bundle(tmpdir, (6, 7))
+
+    for n in (1, 2, 3, 6, 7):
+        url, (first, last), size, md5 = s3_worker.find_in_wal_bundle(
+            's3://bucket/prefix/wal_005', segment_name(n))
+        contents = bucket.objects[url[len('s3://bucket/'):]]
+        assert contents[first:last + 1] == 'compressed ' + segment_name(n)
+        assert size == len(segment_name(n))
+        assert md5 == hashlib.md5(segment_name(n)).hexdigest()
+
+    for n in (0, 4, 5, 8):
+        assert s3_worker.find_in_wal_bundle(
+            's3://bucket/prefix/wal_005', segment_name(n)) is None
+
+
+def test_corrupt_bundle(bucket):
+    for contents in ('', '{"segments": [["x"]]}', '[]'):
+        bucket.objects['prefix/wal_005/bundles/' + wal_bundle.bundle_name(
+            [segment_name(1), segment_name(2)])] = contents
+
+        with pytest.raises(UserException):
+            s3_worker.find_in_wal_bundle('s3://bucket/prefix/wal_005',
+                                         segment_name(1))
+
+
+def test_bundles_used(tmpdir, bucket, monkeypatch):
+    # That there are none is remembered for a while.
+    assert not s3_worker.wal_bundles_used('s3://bucket/other/wal_005')
+    assert not s3_worker.wal_bundles_used('s3://bucket/other/wal_005')
+    assert bucket.listings == ['other/wal_005/bundles/']
+
+    monkeypatch.setattr(s3_worker, 'NO_BUNDLES_TTL', -1)
+    bucket.listings = []
+    wal_url = 's3://bucket/prefix/wal_005'
+    assert not s3_worker.wal_bundles_used(wal_url)
+
+    put_bundle(tmpdir, (1, 2))
+    assert s3_worker.wal_bundles_used(wal_url)
+    assert s3_worker.wal_bundles_used(wal_url)
+    assert bucket.listings == ['prefix/wal_005/bundles/'] * 2
@@ -0,0 +1,86 @@
+import pytest
+
+from conftest import FakeConnection, segment_name
+from wal_e.storage import s3_storage
+from wal_e.worker import s3_worker
+from wal_e.worker import wal_index
+
+
+def merge(bucket, rebuild=False):
+    layout = s3_storage.StorageLayout('s3://bucket/prefix')
+    index_cxt = s3_worker.WalIndexContext(FakeConnection(bucket), layout)
+    return index_cxt.merge(rebuild=rebuild)
+
+
+def test_add():
+    assert wal_index.add([], 3, 3) == [[3, 3]]
+    assert wal_index.add([[1, 2], [4, 5]], 3, 3) == [[1, 5]]
+    assert wal_index.add([[1, 5]], 2, 3) == [[1, 5]]
+
+    # Before PostgreSQL 9.3, no segment ends in FF.
+    assert wal_index.add([[0xF0, 0xFE]], 0x100, 0x101) == [[0xF0, 0x101]]
+    assert wal_index.add([[0xF0, 0xFD]], 0xFF, 0x101) == [[0xF0, 0xFD],
+                                                          [0xFF, 0x101]]
+
+
+def test_merge_deltas(bucket):
+    s3_worker.s3_put_wal_index_deltas(
+        's3://bucket/prefix/wal_005',
+        [segment_name(n) for n in (0xFE, 0xFF, 0x100, 0x102)])
+    s3_worker.s3_put_wal_index_deltas(
+        's3://bucket/prefix/wal_005', [segment_name(5, tli=2)])
+    assert len(bucket.objects) == 3
+
+    assert merge(bucket) == {
+        '00000001': [(segment_name(0xFE), segment_name(0x100)),
+                     (segment_name(0x102), segment_name(0x102))],
+        '00000002': [(segment_name(5, tli=2), segment_name(5, tli=2))]}
+    assert sorted(bucket.objects) == ['prefix/wal_005/index/00000001.json',
+                                      'prefix/wal_005/index/00000002.json']
+
+    s3_worker.s3_put_wal_index_deltas('s3://bucket/prefix/wal_005',
+                                      [segment_name(0x101)])
+    assert merge(bucket)['00000001'] == [(segment_name(0xFE),
+                                          segment_name(0x102))]
+
+
+def test_rebuild(bucket):
+    for n in (1, 2, 5):
+        bucket.objects['prefix/wal_005/{0}.lzo'.format(segment_name(n))] = ''
+    bucket.objects['prefix/wal_005/00000002.history'] = ''
+    bucket.objects['prefix/wal_005/bundles/{0}_{1}.bundle'.format(
+        segment_name(4), segment_name(3))] = ''
+    bucket.objects['prefix/wal_005/index/00000003.json'] = wal_index.dumps(
+        '00000003', [[1, 1]])
+
+    # Indexing is not yet turned on.
+    assert merge(bucket) == {'00000003': [(segment_name(1, tli=3),
+                                           segment_name(1, tli=3))]}
+
+    assert merge(bucket, rebuild=True) == {
+        '00000001': [(segment_name(1), segment_name(5))]}
+    assert 'prefix/wal_005/index/00000003.json' not in bucket.objects
+
+
+@pytest.mark.parametrize('dry_run', [True, False])
+def test_delete_before_trims(bucket, dry_run):
+    s3_worker.s3_put_wal_index_deltas(
+        's3://bucket/prefix/wal_005', [segment_name(n) for n in (1, 2, 3)])
+    merge(bucket)
+    s3_worker.s3_put_wal_index_deltas('s3://bucket/prefix/wal_005',
+                                      [segment_name(1)])
+    s3_worker.s3_put_wal_index_deltas('s3://bucket/prefix/wal_005',
+                                      [segment_name(4)])
+    before = dict(bucket.objects)
+
+    layout = s3_storage.StorageLayout('s3://bucket/prefix')
+    delete_cxt = s3_worker.DeleteFromContext(FakeConnection(bucket), layout,
+                                             dry_run)
+    delete_cxt.delete_before(s3_storage.SegmentNumber(log='00000000',
+                                                      seg='00000003'))
+
+    if dry_run:
+        assert bucket.objects == before
+    else:
+        assert merge(bucket) == {
+            '00000001': [(segment_name(3), segment_name(4))]}
@@ -0,0 +1,162 @@
+import gevent
+import os
+import pytest
+
+from conftest import segment_name
+from wal_e.exception import UserException
+from wal_e.operator import s3_operator
+from wal_e.worker import s3_worker
+from wal_e.worker.wal_transfer import WalSegment
+
+
+@pytest.fixture
+def xlog(tmpdir):
+    """A pg_xlog directory with segments 1 to 10 awaiting archiving"""
+    xlog = tmpdir.mkdir('pg_xlog')
+    status = xlog.mkdir('archive_status')
+
+    for n in xrange(1, 11):
+        xlog.join(segment_name(n)).write('')
+        status.join(segment_name(n) + '.ready').write('')
+
+    # Other files awaiting archiving are left alone.
+    status.join('00000002.history.ready').write('')
+
+    return xlog
+
+
+def statuses(xlog):
+    return sorted(os.listdir(unicode(xlog.join('archive_status'))))
+
+
+class FakeUploads(object):
+    def __init__(self, fail=()):
+        self.uploaded = []
+        self.concurrent = 0
+        self.max_concurrent = 0
+        self.fail = fail
+
+    def __call__(self, backup, segment):
+        self.concurrent += 1
+        self.max_concurrent = max(self.concurrent, self.max_concurrent)
+        gevent.sleep(0.01)
+        self.concurrent -= 1
+
+        if segment.name in self.fail:
+            raise UserException(msg='could not upload')
+
+        self.uploaded.append(segment.name)
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    uploads = FakeUploads()
+    monkeypatch.setattr(s3_operator.S3Backup, '_wal_s3_upload',
+                        lambda backup, segment, **kwargs:
+                        uploads(backup, segment))
+    return uploads
+
+
+def archive(xlog, n, concurrency):
+    backup = s3_operator.S3Backup('id', 'secret', 's3://bucket/prefix', None)
+    backup.wal_s3_archive(unicode(xlog.join(segment_name(n))),
+                          concurrency=concurrency)
+
+
+def test_serial(xlog, uploads):
+    archive(xlog, 1, concurrency=1)
+    assert uploads.uploaded == [segment_name(1)]
+
+    # Postgres marks the explicit segment done itself.
+    assert segment_name(1) + '.ready' in statuses(xlog)
+
+
+def test_drains_ready(xlog, uploads):
+    archive(xlog, 1, concurrency=4)
+
+    assert sorted(uploads.uploaded) == [segment_name(n) for n in (1, 2, 3, 4)]
+    assert uploads.max_concurrent == 4
+
+    assert statuses(xlog) == sorted(
+        ['00000002.history.ready', segment_name(1) + '.ready'] +
+        [segment_name(n) + '.done' for n in (2, 3, 4)] +
+        [segment_name(n) + '.ready' for n in xrange(5, 11)])
+
+    # Asking for a segment uploaded ahead of time does nothing.
+    archive(xlog, 3, concurrency=4)
+    assert len(uploads.uploaded) == 4
+
+
+def test_ahead_failure_tolerated(xlog, uploads):
+    uploads.fail = [segment_name(2)]
+    archive(xlog, 1, concurrency=3)
+
+    assert sorted(uploads.uploaded) == [segment_name(1), segment_name(3)]
+    assert segment_name(2) + '.ready' in statuses(xlog)
+    assert segment_name(3) + '.done' in statuses(xlog)
+
+
+def test_explicit_failure_raised(xlog, uploads):
+    uploads.fail = [segment_name(1)]
+
+    with pytest.raises(UserException):
+        archive(xlog, 1, concurrency=3)
+
+    # The others made it nevertheless.
+    assert sorted(uploads.uploaded) == [segment_name(2), segment_name(3)]
+
+
+def test_no_archive_status(tmpdir):
+    assert list(WalSegment.from_ready_archive_status(unicode(tmpdir))) == []
+
+
+def test_explicit_not_marked(xlog):
+    with pytest.raises(UserException):
+        WalSegment(unicode(xlog.join(segment_name(1))),
+                   explicit=True).mark_done()
+
+
+class FakeArchive(object):
+    """Stands in for looking up and uploading WAL files in S3"""
+
+    def __init__(self, monkeypatch):
+        self.md5s = {}
+        self.uploaded = []
+        self.uploaded_md5s = []
+
+        monkeypatch.setattr(s3_worker, 's3_archived_md5',
+                            lambda s3_url: self.md5s.get(s3_url))
+        monkeypatch.setattr(s3_worker, 'do_lzop_s3_put', self.put)
+
+    def put(self, s3_url, local_path, gpg_key, trim_zero_tail=False,
+            segment_md5=None):
+        assert segment_md5 in (None, s3_worker.file_md5(local_path))
+        self.uploaded.append(s3_url)
+        self.uploaded_md5s.append(segment_md5)
+        return '1'
+
+
+def test_skip_archived(xlog, monkeypatch):
+    s3 = FakeArchive(monkeypatch)
+    url = 's3://bucket/prefix/wal_005/{0}'.format(segment_name(1))
+    backup = s3_operator.S3Backup('id', 'secret', 's3://bucket/prefix', None)
+    wal_path = unicode(xlog.join(segment_name(1)))
+
+    # Archived by an older version of WAL-E, without an MD5.
+    s3.md5s[url + '.lzo'] = ''
+    backup.wal_s3_archive(wal_path, skip_archived=True)
+    assert s3.uploaded == [url]
+
+    s3.md5s[url + '.lzo'] = s3_worker.file_md5(wal_path)
+    backup.wal_s3_archive(wal_path, skip_archived=True)
+    assert s3.uploaded == [url]
+
+    xlog.join(segment_name(1)).write('other contents')
+    with pytest.raises(UserException):
+        backup.wal_s3_archive(wal_path, skip_archived=True)
+    assert s3.uploaded == [url]
+
+    # Neither looked up nor hashed without being asked to.
+    backup.wal_s3_archive(wal_path)
+    assert s3.uploaded == [url, url]
+    assert s3.uploaded_md5s[-1] is None
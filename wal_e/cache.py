@@ -0,0 +1,229 @@
+"""
+Small caches kept across invocations of WAL-E
+
+wal-push and wal-fetch run as a fresh process for every WAL file, so
+anything they learn is forgotten immediately unless it is written
+down.  These caches are kept as files in a state directory:
+WALE_STATE_DIR if set, and otherwise a wal-e directory in the user's
+cache directory.
+
+Caches are only ever an optimization: a cache that cannot be read or
+written behaves as if it were empty.
+
+"""
+import errno
+import json
+import logging
+import os
+import tempfile
+import time
+
+import wal_e.log_help as log_help
+
+logger = log_help.WalELogger(__name__, level=logging.INFO)
+
+
+def _make_directory(path):
+    try:
+        os.makedirs(path, 0700)
+    except EnvironmentError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def state_dir():
+    """The directory to keep caches in"""
+    configured = os.getenv('WALE_STATE_DIR')
+    if configured:
+        return configured
+
+    cache_home = (os.getenv('XDG_CACHE_HOME') or
+                  os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'wal-e')
+
+
+class JsonCache(object):
+    """A mapping of strings to JSON values, with entries that expire
+
+    The whole cache is one file, replaced atomically on every change,
+    so it is meant for a small number of entries.  Concurrent writers
+    can lose each other's changes, which only costs a cache miss.
+    """
+
+    def __init__(self, name, ttl, directory=None):
+        self.name = name
+        self.ttl = ttl
+        self._directory = directory
+
+    @property
+    def path(self):
+        return os.path.join(self._directory or state_dir(),
+                            self.name + '.json')
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                self._complain('could not read a cache', e)
+            return {}
+        except ValueError, e:
+            self._complain('could not parse a cache', e)
+            return {}
+
+        if not isinstance(entries, dict):
+            return {}
+
+        return entries
+
+    def _store(self, entries):
+        directory = os.path.dirname(self.path)
+
+        try:
+            _make_directory(directory)
+
+            fd, tmp_path = tempfile.mkstemp(prefix='.' + self.name + '.',
+                                            dir=directory)
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(entries, f)
+                os.rename(tmp_path, self.path)
+            except:
+                os.unlink(tmp_path)
+                raise
+        except EnvironmentError, e:
+            self._complain('could not write a cache', e)
+
+    def _complain(self, msg, e):
+        logger.debug(msg=msg,
+                     detail='The cache is "{0}": {1}'.format(self.path, e))
+
+    def get(self, key):
+        """Return the value of key, or None if absent or expired"""
+        entry = self._load().get(key)
+
+        try:
+            expires, value = entry
+        except (TypeError, ValueError):
+            return None
+
+        if not isinstance(expires, (int, float)) or expires < time.time():
+            return None
+
+        return value
+
+    def put(self, key, value, ttl=None):
+        """Store value for key, for ttl seconds if not the cache's"""
+        entries = self._load()
+        now = time.time()
+
+        # Take the opportunity to drop expired entries.
+        entries = dict((k, v) for k, v in entries.iteritems()
+                       if isinstance(v, list) and len(v) == 2 and
+                       isinstance(v[0], (int, float)) and v[0] >= now)
+        entries[key] = [now + (self.ttl if ttl is None else ttl), value]
+
+        self._store(entries)
+
+    def discard(self, key):
+        entries = self._load()
+
+        if key in entries:
+            del entries[key]
+            self._store(entries)
+
+
+class ObjectCache(object):
+    """The contents of S3 objects, by their URLs and ETags
+
+    Objects are looked up by the ETag they are listed with, so one
+    that has changed since it was stored is merely a miss, and no
+    request is needed to revalidate an entry.  Entries are kept in an
+    SQLite database, which holds many more of them than a JsonCache
+    would, and expire ttl seconds after they are stored.
+    """
+
+    def __init__(self, name, ttl, directory=None):
+        self.name = name
+        self.ttl = ttl
+        self._directory = directory
+
+        # Connected on first use, and False once that has failed.
+        self._conn = None
+
+    @property
+    def path(self):
+        return os.path.join(self._directory or state_dir(),
+                            self.name + '.sqlite')
+
+    def _complain(self, msg, e):
+        logger.debug(msg=msg,
+                     detail='The cache is "{0}": {1}'.format(self.path, e))
+
+    def _connect(self):
+        # Imported here, as most invocations of WAL-E never get here.
+        import sqlite3
+
+        _make_directory(os.path.dirname(self.path))
+
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS objects ('
+                             'url TEXT PRIMARY KEY, '
+                             'etag TEXT NOT NULL, '
+                             'contents BLOB NOT NULL, '
+                             'expires REAL NOT NULL)')
+
+                # Take the opportunity to drop expired entries.
+                conn.execute('DELETE FROM objects WHERE expires < ?',
+                             (time.time(),))
+        except:
+            conn.close()
+            raise
+
+        return conn
+
+    def _execute(self, sql, parameters):
+        """Run a statement, returning its rows, or None on failure"""
+        if self._conn is False:
+            return None
+
+        try:
+            import sqlite3
+        except ImportError, e:
+            self._complain('could not use a cache', e)
+            self._conn = False
+            return None
+
+        try:
+            if self._conn is None:
+                self._conn = self._connect()
+
+            with self._conn:
+                return self._conn.execute(sql, parameters).fetchall()
+        except (sqlite3.Error, EnvironmentError), e:
+            self._complain('could not use a cache', e)
+            self.close()
+            self._conn = False
+            return None
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+        self._conn = None
+
+    def get(self, url, etag):
+        """Return the contents of url, or None if absent or changed"""
+        rows = self._execute('SELECT contents FROM objects '
+                             'WHERE url = ? AND etag = ? AND expires >= ?',
+                             (url, etag, time.time()))
+        if not rows:
+            return None
+
+        return str(rows[0][0])
+
+    def put(self, url, etag, contents):
+        self._execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)',
+                      (url, etag, buffer(contents), time.time() + self.ttl))
@@ -4,19 +4,6 @@ archiving on S3: it handles pushing and fetching of WAL segments and
 base backups of the PostgreSQL data directory.
 
 """
-
-
-def gevent_monkey(*args, **kwargs):
-    import gevent.monkey
-    gevent.monkey.patch_socket(dns=True, aggressive=True)
-    gevent.monkey.patch_ssl()
-    gevent.monkey.patch_time()
-
-# Monkey-patch procedures early.  If it doesn't work with gevent,
-# sadly it cannot be used (easily) in WAL-E.
-gevent_monkey()
-
-
 import argparse
 import logging
 import os
@@ -27,22 +14,49 @@ import traceback
 
 import wal_e.log_help as log_help
 
-from wal_e import subprocess
 from wal_e.exception import UserException
-from wal_e.operator import s3_operator
-from wal_e.pipeline import LZOP_BIN, PV_BIN, GPG_BIN
-from wal_e.piper import popen_sp
-from wal_e.worker.pg_controldata_worker import CONFIG_BIN, PgControlDataParser
-from wal_e.worker.psql_worker import PSQL_BIN, psql_csv_run
-
-log_help.configure(
-    format='%(name)-12s %(levelname)-8s %(message)s')
 
 logger = log_help.WalELogger('wal_e.main', level=logging.INFO)
 
+# The options of wal-push that the daemon has its own of, or does not
+# support, by their destinations.
+DAEMON_IGNORED_OPTIONS = (('spool_dir', '--spool-dir'),
+                          ('spool_max_bytes', '--spool-max-bytes'),
+                          ('bundle_size', '--bundle-size'),
+                          ('bundle_max_age', '--bundle-max-age'),
+                          ('trim_zero_tail', '--trim-zero-tail'),
+                          ('skip_archived', '--skip-archived'),
+                          ('wal_index', '--wal-index'),
+                          ('pool_size', '--pool-size'))
+
+# How long a program that ran fine is assumed to still be there, unless
+# it is replaced.
+PROGRAM_CHECK_TTL = 7 * 24 * 60 * 60
+
 
-def external_program_check(
-    to_check=frozenset([PSQL_BIN, LZOP_BIN, PV_BIN])):
+def gevent_monkey(*args, **kwargs):
+    import gevent.monkey
+    gevent.monkey.patch_socket(dns=True, aggressive=True)
+    gevent.monkey.patch_ssl()
+    gevent.monkey.patch_time()
+
+
+def find_program(program):
+    """The path wal-e would run program from, or None if not found"""
+    if os.sep in program:
+        candidates = [program]
+    else:
+        candidates = [os.path.join(directory, program) for directory in
+                      os.getenv('PATH', os.defpath).split(os.pathsep)]
+
+    for candidate in candidates:
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return os.path.abspath(candidate)
+
+    return None
+
+
+def external_program_check(to_check=None):
     """
     Validates the existence and basic working-ness of other programs
 
@@ -53,8 +67,22 @@ def external_program_check(
     saving measure.  This problem has confused The Author in practice
     when switching rapidly between machines.
 
+    Programs other than psql that have run fine are remembered, by
+    their path and modification time, so that they are not run again
+    on every wal-push and wal-fetch.  Whether psql can connect to the
+    database is always checked afresh.
+
     """
+    from wal_e import subprocess
+    from wal_e.cache import JsonCache
+    from wal_e.pipeline import LZOP_BIN, PV_BIN
+    from wal_e.piper import popen_sp
+    from wal_e.worker.psql_worker import PSQL_BIN, psql_csv_run
 
+    if to_check is None:
+        to_check = [PSQL_BIN, LZOP_BIN, PV_BIN]
+
+    checked = JsonCache('programs', ttl=PROGRAM_CHECK_TTL)
     could_not_run = []
     error_msgs = []
 
@@ -70,11 +98,20 @@ def external_program_check(
 
     with open(os.devnull, 'w') as nullf:
         for program in to_check:
+            path = find_program(program)
+            try:
+                mtime = path and os.path.getmtime(path)
+            except EnvironmentError:
+                mtime = None
+
+            if program != PSQL_BIN and mtime and checked.get(path) == mtime:
+                continue
+
             try:
-                if program is PSQL_BIN:
+                if program == PSQL_BIN:
                     psql_csv_run('SELECT 1', error_handler=psql_err_handler)
                 else:
-                    if program is PV_BIN:
+                    if program == PV_BIN:
                         extra_args = ['--quiet']
                     else:
                         extra_args = []
@@ -88,6 +125,9 @@ def external_program_check(
                     # of this kind will terminate in this case.
                     proc.stdin.close()
                     proc.wait()
+
+                    if mtime:
+                        checked.put(path, mtime)
             except EnvironmentError:
                 could_not_run.append(program)
 
@@ -116,6 +156,33 @@ def extract_segment(text_with_extractable_segment):
         return SegmentNumber(log=groupdict['log'], seg=groupdict['seg'])
 
 
+def configure_spool(args):
+    from wal_e.worker.spool import Spool
+
+    from wal_e.worker.wal_bundle import MAX_BUNDLE_SEGMENTS
+
+    if not 1 <= args.bundle_size <= MAX_BUNDLE_SEGMENTS:
+        raise UserException(
+            msg='invalid bundle size',
+            detail='The bundle size given is {0}.'.format(args.bundle_size),
+            hint=('Bundles hold from 1 to {0} WAL files.'
+                  .format(MAX_BUNDLE_SEGMENTS)))
+
+    spool_dir = args.spool_dir or os.getenv('WALE_SPOOL_DIR')
+    if spool_dir is None:
+        if args.bundle_size > 1:
+            raise UserException(
+                msg='bundling WAL files needs a spool directory',
+                hint=('Either set the --spool-dir option or define the '
+                      'environment variable WALE_SPOOL_DIR.'))
+
+        return None
+
+    return Spool(os.path.abspath(spool_dir), args.spool_max_bytes,
+                 bundle_size=args.bundle_size,
+                 bundle_max_age=args.bundle_max_age)
+
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv
@@ -141,6 +208,21 @@ def main(argv=None):
         'Can also be defined via environment variable '
         'WALE_GPG_KEY_ID')
 
+    parser.add_argument(
+        '--daemon-socket',
+        help='Path of the Unix socket "wal-e daemon" listens on.  If set, '
+        'wal-push hands segments to the daemon instead of pushing them '
+        'itself, as the daemon\'s own options say to, and takes none '
+        'of its own.  Can also be defined via environment variable '
+        'WALE_DAEMON_SOCKET')
+
+    parser.add_argument(
+        '--state-dir',
+        help='Directory to keep caches in, such as of the S3 endpoint of '
+        'the bucket, so as to not look them up on every invocation.  '
+        'Can also be defined via environment variable WALE_STATE_DIR.  '
+        'Defaults to ~/.cache/wal-e')
+
     subparsers = parser.add_subparsers(title='subcommands',
                                        dest='subcommand')
 
@@ -174,6 +256,10 @@ def main(argv=None):
     backup_list_parser = subparsers.add_parser(
         'backup-list', parents=[backup_list_nodetail_parent],
         help='list backups in S3')
+    subparsers.add_parser(
+        'backup-migrate',
+        help=('add what backup-list needs to detail backups without '
+              'fetching them to backups pushed by earlier versions'))
     backup_push_parser = subparsers.add_parser(
         'backup-push', help='pushing a fresh hot backup to S3',
         parents=[backup_fetchpush_parent])
@@ -183,6 +269,13 @@ def main(argv=None):
         'tunable number of bytes per second', dest='rate_limit',
         metavar='BYTES_PER_SECOND',
         type=int, default=None)
+    backup_push_parser.add_argument(
+        '--cluster-read-direct-io',
+        help=('Read the PostgreSQL cluster directory with O_DIRECT, '
+              'bypassing the page cache, where supported'),
+        dest='direct_io',
+        action='store_true',
+        default=False)
     backup_push_parser.add_argument(
         '--while-offline',
         help=('Backup a Postgres cluster that is in a stopped state '
@@ -195,8 +288,112 @@ def main(argv=None):
     wal_fetch_parser = subparsers.add_parser(
         'wal-fetch', help='fetch a WAL file from S3',
         parents=[wal_fetchpush_parent])
-    subparsers.add_parser('wal-push', help='push a WAL file to S3',
-                          parents=[wal_fetchpush_parent])
+    wal_fetch_parser.add_argument(
+        '--prefetch', type=int, default=0,
+        help=('Download up to this many of the following WAL files in the '
+              'background, each in a process of its own, to have them '
+              'ready for later wal-fetches.  Prefetched files are kept in '
+              'a .wal-e directory next to WAL_DESTINATION'))
+    wal_fetch_parser.add_argument(
+        '--miss-ttl', type=int, default=0, metavar='SECONDS',
+        help=('Remember WAL files found missing for this many seconds, '
+              'and report them missing again without asking S3.  A WAL '
+              'file archived in the meantime is only found after this '
+              'time, which can end recovery early.  Off by default'))
+    # Common arguments for wal-push and wal-spool-drain
+    spool_parent = argparse.ArgumentParser(add_help=False)
+    spool_parent.add_argument(
+        '--spool-dir',
+        help=('Directory on durable local storage to keep compressed WAL '
+              'files in until they are uploaded.  If set, wal-push '
+              'returns as soon as the WAL file is stored there.  '
+              'Can also be defined via environment variable '
+              'WALE_SPOOL_DIR'))
+    spool_parent.add_argument(
+        '--spool-max-bytes', type=int, default=1024 ** 3,
+        help=('Upload WAL files synchronously, rather than spool them, '
+              'once the spool takes up this many bytes'))
+    spool_parent.add_argument(
+        '--bundle-size', type=int, default=1,
+        help=('Upload runs of up to this many consecutive spooled WAL '
+              'files as one S3 object, which saves requests on quiet '
+              'databases.  Needs --spool-dir.  Defaults to 1, which '
+              'uploads every WAL file on its own'))
+    spool_parent.add_argument(
+        '--bundle-max-age', type=int, default=300, metavar='SECONDS',
+        help=('Upload spooled WAL files without waiting to fill a '
+              'bundle once the oldest has been spooled this long'))
+
+    # Common arguments for wal-push and daemon
+    archive_parent = argparse.ArgumentParser(add_help=False)
+    archive_parent.add_argument(
+        '--trim-zero-tail', default=False, action='store_true',
+        help=('Leave out the zeros that WAL segments switched early, as by '
+              'archive_timeout, end in, and record the size to restore '
+              'them to.  WAL-E releases that predate this option fetch '
+              'such segments short, which postgres rejects'))
+    archive_parent.add_argument(
+        '--skip-archived', default=False, action='store_true',
+        help=('Look up every WAL file in S3 before uploading it, skip it '
+              'if it is archived already with the same contents, and '
+              'fail if with different ones.  Speeds up the archiving '
+              'postgres repeats after a crash or failover, at the cost '
+              'of a request per WAL file'))
+
+    # Common arguments for everything that uploads WAL
+    index_parent = argparse.ArgumentParser(add_help=False)
+    index_parent.add_argument(
+        '--wal-index', default=False, action='store_true',
+        help=('Add uploaded WAL segments to the WAL index, at the cost '
+              'of a request per upload.  See "wal-index"'))
+
+    wal_push_parser = subparsers.add_parser(
+        'wal-push', help='push a WAL file to S3',
+        parents=[wal_fetchpush_parent, spool_parent, archive_parent,
+                 index_parent])
+    wal_push_parser.add_argument(
+        '--pool-size', '-p', type=int, default=1,
+        help=('Upload up to this many WAL files at once, including ones '
+              'postgres has yet to ask for, which are then marked as '
+              'archived so that postgres does not ask for them.  With '
+              '--spool-dir, how many spooled WAL files are uploaded at '
+              'once instead'))
+
+    wal_spool_drain_parser = subparsers.add_parser(
+        'wal-spool-drain', parents=[spool_parent, index_parent],
+        help=('upload the WAL files in the spool, which wal-push starts '
+              'in the background'))
+    wal_spool_drain_parser.add_argument(
+        '--pool-size', '-p', type=int, default=8,
+        help='Upload up to this many WAL files at once')
+
+    wal_index_parser = subparsers.add_parser(
+        'wal-index', help=('merge what has been uploaded with --wal-index '
+                           'into the WAL index, and list the runs of WAL '
+                           'segments in it'))
+    wal_index_parser.add_argument(
+        '--rebuild', default=False, action='store_true',
+        help=('Make the WAL index afresh from a listing of all the WAL '
+              'in S3, as is needed once before relying on it'))
+
+    wal_prefetch_parser = subparsers.add_parser(
+        'wal-prefetch', help='used internally by wal-fetch --prefetch')
+    wal_prefetch_parser.add_argument(
+        '--miss-ttl', type=int, default=0, metavar='SECONDS',
+        help='As for wal-fetch')
+    wal_prefetch_parser.add_argument(
+        'XLOG_DIRECTORY', help='Path to the pg_xlog directory to prefetch for')
+    wal_prefetch_parser.add_argument(
+        'WAL_SEGMENT', help='Name of the WAL segment to prefetch')
+
+    daemon_parser = subparsers.add_parser(
+        'daemon', help=('push WAL files to S3 on behalf of wal-push, '
+                        'as they are handed over --daemon-socket'),
+        parents=[archive_parent, index_parent])
+    daemon_parser.add_argument(
+        '--pool-size', '-p', type=int, default=8,
+        help=('Upload up to this many WAL files at once, each handed '
+              'over by a wal-push of its own'))
 
     # backup-fetch operator section
     backup_fetch_parser.add_argument('BACKUP_NAME',
@@ -266,6 +463,58 @@ def main(argv=None):
         print pkgutil.get_data('wal_e', 'VERSION').strip()
         sys.exit(0)
 
+    daemon_socket = args.daemon_socket or os.getenv('WALE_DAEMON_SOCKET')
+
+    # Every other subcommand talks to S3, so monkey-patch before
+    # configuring logging, which opens the syslog socket, but only
+    # then: wal-push via the daemon is run often, and needs neither
+    # gevent nor boto, which are slow to import.  If it doesn't work
+    # with gevent, sadly it cannot be used (easily) in WAL-E.
+    if subcommand != 'wal-push' or daemon_socket is None:
+        gevent_monkey()
+
+    log_help.configure(
+        format='%(name)-12s %(levelname)-8s %(message)s')
+
+    # Set in the environment, to be inherited by WAL-E processes run
+    # in the background, too.
+    if args.state_dir is not None:
+        os.environ['WALE_STATE_DIR'] = args.state_dir
+
+    # Handle wal-push via the daemon specially too, because it is run
+    # for every WAL segment: it needs neither credentials nor boto.
+    if subcommand == 'wal-push' and daemon_socket is not None:
+        from wal_e import daemon
+
+        # How the daemon pushes is up to its own options, and it does
+        # not spool, so these would silently go unused.
+        ignored = [option for dest, option in DAEMON_IGNORED_OPTIONS
+                   if getattr(args, dest) != wal_push_parser.get_default(dest)]
+        if ignored:
+            logger.error(
+                msg='options given that have no effect with a daemon',
+                detail=('wal-push was given {0} along with a daemon socket.'
+                        .format(', '.join(sorted(ignored)))),
+                hint=('Pass options governing how WAL is pushed to "wal-e '
+                      'daemon" instead.  The daemon does not spool.'))
+            sys.exit(1)
+
+        try:
+            daemon.push(daemon_socket, args.WAL_SEGMENT)
+        except UserException, e:
+            logger.log(level=e.severity, msg=e.msg, detail=e.detail,
+                       hint=e.hint)
+            sys.exit(1)
+
+        sys.exit(0)
+
+    if subcommand == 'daemon' and daemon_socket is None:
+        logger.error(
+            msg='no daemon socket defined',
+            hint=('Either set the --daemon-socket option or define the '
+                  'environment variable WALE_DAEMON_SOCKET.'))
+        sys.exit(1)
+
     # Attempt to read a few key parameters from environment variables
     # *or* the command line, enforcing a precedence order and
     # complaining should the required parameter not be defined in
@@ -300,6 +549,15 @@ def main(argv=None):
     # This will be None if we're not encrypting
     gpg_key_id = args.gpg_key_id or os.getenv('WALE_GPG_KEY_ID')
 
+    # Everything from here on talks to S3, and was monkey-patched for
+    # above.
+    from wal_e import daemon
+    from wal_e.operator import s3_operator
+    from wal_e.pipeline import LZOP_BIN, PV_BIN, GPG_BIN
+    from wal_e.worker.pg_controldata_worker import (CONFIG_BIN,
+                                                    PgControlDataParser)
+    from wal_e.worker.psql_worker import PSQL_BIN
+
     backup_cxt = s3_operator.S3Backup(aws_access_key_id, secret_key, s3_prefix,
                                       gpg_key_id)
 
@@ -315,6 +573,8 @@ def main(argv=None):
                 pool_size=args.pool_size)
         elif subcommand == 'backup-list':
             backup_cxt.backup_list(query=args.QUERY, detail=args.detail)
+        elif subcommand == 'backup-migrate':
+            backup_cxt.backup_migrate()
         elif subcommand == 'backup-push':
             if args.while_offline:
                 # we need to query pg_config first for the
@@ -337,16 +597,48 @@ def main(argv=None):
                 args.PG_CLUSTER_DIRECTORY,
                 rate_limit=rate_limit,
                 while_offline=while_offline,
-                pool_size=args.pool_size)
+                pool_size=args.pool_size,
+                direct_io=args.direct_io)
         elif subcommand == 'wal-fetch':
             external_program_check([LZOP_BIN])
             res = backup_cxt.wal_s3_restore(args.WAL_SEGMENT,
-                                            args.WAL_DESTINATION)
+                                            args.WAL_DESTINATION,
+                                            prefetch_max=args.prefetch,
+                                            miss_ttl=args.miss_ttl)
             if not res:
                 sys.exit(1)
+        elif subcommand == 'wal-prefetch':
+            backup_cxt.wal_s3_prefetch(args.XLOG_DIRECTORY, args.WAL_SEGMENT,
+                                       miss_ttl=args.miss_ttl)
         elif subcommand == 'wal-push':
             external_program_check([LZOP_BIN])
-            backup_cxt.wal_s3_archive(args.WAL_SEGMENT)
+            backup_cxt.wal_s3_archive(args.WAL_SEGMENT,
+                                      concurrency=args.pool_size,
+                                      spool=configure_spool(args),
+                                      trim_zero_tail=args.trim_zero_tail,
+                                      skip_archived=args.skip_archived,
+                                      index_wal=args.wal_index)
+        elif subcommand == 'wal-spool-drain':
+            spool = configure_spool(args)
+            if spool is None:
+                logger.error(
+                    msg='no spool directory defined',
+                    hint=('Either set the --spool-dir option or define the '
+                          'environment variable WALE_SPOOL_DIR.'))
+                sys.exit(1)
+
+            backup_cxt.wal_s3_spool_drain(spool, concurrency=args.pool_size,
+                                          index_wal=args.wal_index)
+        elif subcommand == 'wal-index':
+            backup_cxt.wal_index(rebuild=args.rebuild)
+        elif subcommand == 'daemon':
+            external_program_check([LZOP_BIN])
+            daemon.WalPushServer(backup_cxt, daemon_socket,
+                                 pool_size=args.pool_size,
+                                 trim_zero_tail=args.trim_zero_tail,
+                                 skip_archived=args.skip_archived,
+                                 index_wal=args.wal_index
+                                 ).serve_forever()
         elif subcommand == 'delete':
             # Set up pruning precedence, optimizing for *not* deleting data
             #
@@ -361,6 +653,7 @@ def main(argv=None):
                 logger.info(msg='performing dry run of S3 data deletion')
                 is_dry_run_really = True
 
+                import boto.s3.bucket
                 import boto.s3.key
 
                 # This is not necessary, but "just in case" to find bugs.
@@ -369,6 +662,7 @@ def main(argv=None):
                                    'dry-run mode.  Please report a bug.')
 
                 boto.s3.key.Key.delete = just_error
+                boto.s3.bucket.Bucket.delete_keys = just_error
 
             # Handle the subcommands and route them to the right
             # implementations.
@@ -404,6 +698,12 @@ def main(argv=None):
                    .fmt_logline(e.msg, e.detail, e.hint))
         sys.exit(1)
     except Exception, e:
+        from wal_e.worker import s3_worker
+
+        # Don't keep going to an endpoint that turned out to be wrong.
+        if s3_worker.is_wrong_endpoint_error(e):
+            s3_worker.forget_s3_endpoint(s3_prefix)
+
         logger.critical(
             msg='An unprocessed exception has avoided all error handling',
             detail=''.join(traceback.format_exception(*sys.exc_info())))
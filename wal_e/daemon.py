@@ -0,0 +1,233 @@
+"""
+A long-lived process to push WAL segments on behalf of archive_command
+
+Every "wal-e wal-push" pays for starting Python, importing boto,
+checking for external programs and resolving the bucket's endpoint
+before any of the segment is sent.  "wal-e daemon" pays for these
+once, and keeps its S3 connections open between segments, while
+"wal-e wal-push --daemon-socket" merely hands the segment's path over
+a Unix socket and waits for the daemon to report on it.
+
+The protocol is one request line per connection, answered by one
+response line once the segment has been stored in S3, or has failed
+to be:
+
+    wal-push /path/to/segment\n
+    ok\n | error <message>\n
+
+"""
+import errno
+import gevent
+import gevent.event
+import gevent.pool
+import gevent.server
+import gevent.socket
+import logging
+import os
+import signal
+import socket
+import sys
+import traceback
+
+import wal_e.log_help as log_help
+
+from wal_e.exception import UserException
+
+logger = log_help.WalELogger(__name__, level=logging.INFO)
+
+# The longest request line that is accepted, which is the longest
+# path Linux supports and then some.
+MAX_REQUEST_SZ = 8192
+
+
+def _read_line(sock):
+    """Read a line from sock, without its newline
+
+    Returns None if the connection closes, or the line grows too long,
+    before the newline arrives.
+    """
+    buf = ''
+    while '\n' not in buf:
+        chunk = sock.recv(4096)
+        if not chunk or len(buf) + len(chunk) > MAX_REQUEST_SZ:
+            return None
+        buf += chunk
+
+    return buf.split('\n', 1)[0]
+
+
+def push(socket_path, wal_path):
+    """Have the daemon listening on socket_path archive wal_path
+
+    Blocks until the daemon reports the segment archived, and raises
+    a UserException if it reports otherwise, or cannot be reached.
+    """
+    # The daemon need not share a working directory with
+    # archive_command, which passes a path relative to the cluster
+    # directory.
+    wal_path = os.path.abspath(wal_path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socket_path)
+            sock.sendall('wal-push {0}\n'.format(wal_path))
+            response = _read_line(sock)
+        except EnvironmentError, e:
+            raise UserException(
+                msg='could not hand the WAL segment to the daemon',
+                detail=('The socket is "{0}": {1}.'
+                        .format(socket_path, e.strerror)),
+                hint='Check that "wal-e daemon" is running.')
+    finally:
+        sock.close()
+
+    if response == 'ok':
+        return
+    elif response is not None and response.startswith('error '):
+        raise UserException(
+            msg='the daemon could not archive the WAL segment',
+            detail=response[len('error '):])
+    else:
+        raise UserException(
+            msg='the daemon hung up without archiving the WAL segment',
+            detail=('The segment is "{0}", and the socket "{1}".'
+                    .format(wal_path, socket_path)),
+            hint='Check the daemon\'s log for the cause.')
+
+
+def _bind_private(sock, path):
+    """Bind sock to path, which only its owner is to connect to
+
+    The socket is created with the umask's permissions, so they are
+    restricted for as long as it takes to bind, rather than changed
+    once anyone could already have connected.
+    """
+    old_umask = os.umask(0177)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(old_umask)
+
+
+def _one_line(text):
+    return ' '.join(text.split())
+
+
+class WalPushServer(object):
+    """Archive the segments named by clients with a backup context"""
+
+    def __init__(self, backup_cxt, socket_path, pool_size=8,
+                 trim_zero_tail=False, skip_archived=False, index_wal=False):
+        self.backup_cxt = backup_cxt
+        self.socket_path = socket_path
+        self.pool_size = pool_size
+        self.trim_zero_tail = trim_zero_tail
+        self.skip_archived = skip_archived
+        self.index_wal = index_wal
+        self._pool = gevent.pool.Pool(pool_size)
+        self._server = None
+
+    def _bind(self):
+        listener = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            _bind_private(listener, self.socket_path)
+        except EnvironmentError, e:
+            if e.errno != errno.EADDRINUSE:
+                raise
+
+            # Find out if the socket is a left-over from a daemon that
+            # is no longer running, and take its place if so.
+            probe = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except EnvironmentError, e:
+                if e.errno != errno.ECONNREFUSED:
+                    raise
+
+                os.unlink(self.socket_path)
+                _bind_private(listener, self.socket_path)
+            else:
+                raise UserException(
+                    msg='another daemon is already running',
+                    detail=('It is listening on "{0}".'
+                            .format(self.socket_path)))
+            finally:
+                probe.close()
+
+        listener.listen(128)
+        return listener
+
+    def handle(self, sock, address):
+        try:
+            request = _read_line(sock)
+            if request is None or not request.startswith('wal-push '):
+                sock.sendall('error malformed request\n')
+                return
+
+            wal_path = request[len('wal-push '):]
+            try:
+                # Up to pool_size connections are served at once, so
+                # each only pushes its own segment.
+                self.backup_cxt.wal_s3_archive(
+                    wal_path, concurrency=1,
+                    trim_zero_tail=self.trim_zero_tail,
+                    skip_archived=self.skip_archived,
+                    index_wal=self.index_wal)
+            except UserException, e:
+                logger.log(level=e.severity, msg=e.msg, detail=e.detail,
+                           hint=e.hint)
+                if e.detail is None:
+                    reason = e.msg
+                else:
+                    reason = '{0}: {1}'.format(e.msg, e.detail)
+                sock.sendall('error {0}\n'.format(_one_line(reason)))
+            except Exception, e:
+                logger.critical(
+                    msg='An unprocessed exception has avoided all error '
+                    'handling',
+                    detail=''.join(traceback.format_exception(
+                        *sys.exc_info())))
+                sock.sendall('error {0}\n'.format(_one_line(repr(e))))
+            else:
+                sock.sendall('ok\n')
+        except EnvironmentError, e:
+            # The client went away, and it is up to archive_command to
+            # try again.
+            logger.warning(msg='lost a connection to a wal-push client',
+                           detail=e.strerror)
+        finally:
+            sock.close()
+
+    def start(self):
+        self._server = gevent.server.StreamServer(
+            self._bind(), self.handle, spawn=self._pool)
+        self._server.start()
+
+        logger.info(msg='daemon listening for WAL segments to push',
+                    detail='The socket is "{0}".'.format(self.socket_path))
+
+    def stop(self, timeout=None):
+        """Stop accepting segments, and finish with the ones accepted"""
+        self._server.close()
+
+        try:
+            os.unlink(self.socket_path)
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        self._pool.join(timeout=timeout)
+
+    def serve_forever(self):
+        stopping = gevent.event.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            gevent.signal(signum, stopping.set)
+
+        self.start()
+        stopping.wait()
+
+        logger.info(msg='daemon shutting down',
+                    detail='Waiting for segments being pushed to finish.')
+        self.stop()
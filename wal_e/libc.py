@@ -0,0 +1,340 @@
+"""
+Bindings to a few system calls not otherwise reachable from Python
+
+Python 2 does not expose things like posix_fadvise, so they are bound
+here via ctypes.  Every wrapper raises an EnvironmentError in the same
+way the os module would, using ENOSYS when the C library (or the
+platform) does not have the function at all.  Callers are expected to
+treat these as optimizations and fall back to plain Python I/O when
+they fail.
+
+"""
+import ctypes
+import ctypes.util
+import errno
+import mmap
+import os
+import signal
+import sys
+
+POSIX_FADV_NORMAL = 0
+POSIX_FADV_RANDOM = 1
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+
+PAGE_SIZE = mmap.PAGESIZE
+
+# posix_spawnattr_setflags flag, as defined by glibc.
+POSIX_SPAWN_SETSIGDEF = 0x04
+
+# Generous upper bounds on the sizes of opaque C library types, which
+# are used as storage for them: glibc's are 80, 336 and 128 bytes
+# respectively on 64-bit platforms.
+_SPAWN_FILE_ACTIONS_SZ = 512
+_SPAWNATTR_SZ = 1024
+_SIGSET_SZ = 256
+
+
+def _load_libc():
+    # The C library is already loaded into Python, and can be reached
+    # through the program itself, which saves find_library running
+    # ldconfig on every start.
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.getpid
+        return libc
+    except (EnvironmentError, AttributeError):
+        pass
+
+    name = ctypes.util.find_library('c')
+
+    if name is None:
+        return None
+
+    try:
+        return ctypes.CDLL(name, use_errno=True)
+    except EnvironmentError:
+        return None
+
+_libc = _load_libc()
+
+
+def _function(name, restype, argtypes):
+    """Look up a C library function, or return None if it is missing."""
+    if _libc is None:
+        return None
+
+    try:
+        f = getattr(_libc, name)
+    except AttributeError:
+        return None
+
+    f.restype = restype
+    f.argtypes = argtypes
+    return f
+
+_posix_fadvise = _function(
+    'posix_fadvise', ctypes.c_int,
+    [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int])
+
+_mmap = _function(
+    'mmap', ctypes.c_void_p,
+    [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int,
+     ctypes.c_int, ctypes.c_int64])
+
+_munmap = _function(
+    'munmap', ctypes.c_int, [ctypes.c_void_p, ctypes.c_size_t])
+
+_mincore = _function(
+    'mincore', ctypes.c_int,
+    [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p])
+
+_sendfile = _function(
+    'sendfile', ctypes.c_ssize_t,
+    [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+     ctypes.c_size_t])
+
+_pidfd_open = _function(
+    'pidfd_open', ctypes.c_int, [ctypes.c_int, ctypes.c_uint])
+
+_close_range = _function(
+    'close_range', ctypes.c_int, [ctypes.c_uint, ctypes.c_uint, ctypes.c_int])
+
+_syscall = _function('syscall', ctypes.c_long, None)
+
+_posix_spawnp = _function(
+    'posix_spawnp', ctypes.c_int,
+    [ctypes.POINTER(ctypes.c_int), ctypes.c_char_p, ctypes.c_void_p,
+     ctypes.c_void_p, ctypes.POINTER(ctypes.c_char_p),
+     ctypes.POINTER(ctypes.c_char_p)])
+
+_fa_init = _function('posix_spawn_file_actions_init', ctypes.c_int,
+                     [ctypes.c_void_p])
+_fa_destroy = _function('posix_spawn_file_actions_destroy', ctypes.c_int,
+                        [ctypes.c_void_p])
+_fa_adddup2 = _function('posix_spawn_file_actions_adddup2', ctypes.c_int,
+                        [ctypes.c_void_p, ctypes.c_int, ctypes.c_int])
+_fa_addclose = _function('posix_spawn_file_actions_addclose', ctypes.c_int,
+                         [ctypes.c_void_p, ctypes.c_int])
+_fa_addclosefrom = _function('posix_spawn_file_actions_addclosefrom_np',
+                             ctypes.c_int, [ctypes.c_void_p, ctypes.c_int])
+_fa_addchdir = _function('posix_spawn_file_actions_addchdir_np',
+                         ctypes.c_int, [ctypes.c_void_p, ctypes.c_char_p])
+
+_attr_init = _function('posix_spawnattr_init', ctypes.c_int,
+                       [ctypes.c_void_p])
+_attr_destroy = _function('posix_spawnattr_destroy', ctypes.c_int,
+                          [ctypes.c_void_p])
+_attr_setflags = _function('posix_spawnattr_setflags', ctypes.c_int,
+                           [ctypes.c_void_p, ctypes.c_short])
+_attr_setsigdefault = _function('posix_spawnattr_setsigdefault',
+                                ctypes.c_int,
+                                [ctypes.c_void_p, ctypes.c_void_p])
+
+_sigemptyset = _function('sigemptyset', ctypes.c_int, [ctypes.c_void_p])
+_sigaddset = _function('sigaddset', ctypes.c_int,
+                       [ctypes.c_void_p, ctypes.c_int])
+
+# System call numbers that are the same on every Linux architecture,
+# for use where the C library does not wrap them yet.
+SYS_pidfd_open = 434
+SYS_close_range = 436
+
+# The largest file descriptor number there can be.
+MAX_FD = 2 ** 32 - 1
+
+# (void *) -1, as returned by a failing mmap.
+_MAP_FAILED = ctypes.c_void_p(-1).value
+
+
+def _raise_errno(err, *args):
+    raise OSError(err, os.strerror(err), *args)
+
+
+def _check(ret):
+    if ret == -1:
+        _raise_errno(ctypes.get_errno())
+
+    return ret
+
+
+def posix_fadvise(fd, offset, length, advice):
+    """Announce an intention to access file data in a specific pattern
+
+    A length of zero means "until the end of the file".
+    """
+    if _posix_fadvise is None:
+        _raise_errno(errno.ENOSYS)
+
+    # Unlike most calls, posix_fadvise returns the error number
+    # rather than setting errno.
+    err = _posix_fadvise(fd, offset, length, advice)
+    if err != 0:
+        _raise_errno(err)
+
+
+def resident_pages(fd, length):
+    """Report which pages of the first "length" bytes of fd are cached
+
+    Returns a string with one byte per page, the lowest bit of which
+    is set if that page is resident in the page cache.
+
+    """
+    if _mmap is None or _munmap is None or _mincore is None:
+        _raise_errno(errno.ENOSYS)
+
+    npages = (length + PAGE_SIZE - 1) // PAGE_SIZE
+    if npages == 0:
+        return ''
+
+    addr = _mmap(None, length, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+    if addr is None or addr == _MAP_FAILED:
+        _raise_errno(ctypes.get_errno())
+
+    try:
+        vec = ctypes.create_string_buffer(npages)
+        _check(_mincore(addr, length, vec))
+        return vec.raw
+    finally:
+        _munmap(addr, length)
+
+
+def sendfile(out_fd, in_fd, offset, count):
+    """Copy up to count bytes from in_fd at offset to out_fd in-kernel
+
+    Returns the number of bytes copied, which is zero at the end of
+    in_fd.  The file position of in_fd is left untouched.
+    """
+    if _sendfile is None:
+        _raise_errno(errno.ENOSYS)
+
+    return _check(_sendfile(out_fd, in_fd,
+                            ctypes.byref(ctypes.c_int64(offset)), count))
+
+
+def pidfd_open(pid):
+    """Obtain a file descriptor that becomes readable when pid exits
+
+    Requires Linux 5.3 or later.
+    """
+    if _pidfd_open is not None:
+        return _check(_pidfd_open(pid, 0))
+    elif _syscall is not None:
+        return _check(_syscall(ctypes.c_long(SYS_pidfd_open),
+                               ctypes.c_long(pid), ctypes.c_long(0)))
+    else:
+        _raise_errno(errno.ENOSYS)
+
+
+def close_range(first, last=MAX_FD):
+    """Close every open file descriptor from first to last, inclusive
+
+    This takes one system call, however many descriptors a process may
+    have open, and is indifferent to how many it could have open.
+    Requires Linux 5.9 or later.
+    """
+    if _close_range is not None:
+        _check(_close_range(first, last, 0))
+    elif _syscall is not None:
+        _check(_syscall(ctypes.c_long(SYS_close_range),
+                        ctypes.c_uint(first), ctypes.c_uint(last),
+                        ctypes.c_int(0)))
+    else:
+        _raise_errno(errno.ENOSYS)
+
+
+def can_posix_spawn(closefrom=False, chdir=False):
+    """Check if posix_spawnp is usable with the given file actions"""
+    required = [_posix_spawnp, _fa_init, _fa_destroy, _fa_adddup2,
+                _fa_addclose, _attr_init, _attr_destroy, _attr_setflags,
+                _attr_setsigdefault, _sigemptyset, _sigaddset]
+
+    if closefrom:
+        required.append(_fa_addclosefrom)
+    if chdir:
+        required.append(_fa_addchdir)
+
+    return None not in required
+
+
+def _check_spawn(err):
+    # Like posix_fadvise, the posix_spawn family returns an error
+    # number rather than setting errno.
+    if err != 0:
+        _raise_errno(err)
+
+
+def _fs_encode(s):
+    if isinstance(s, unicode):
+        return s.encode(sys.getfilesystemencoding() or 'utf-8')
+    return s
+
+
+def _c_string_array(strings):
+    encoded = [_fs_encode(s) for s in strings]
+    return (ctypes.c_char_p * (len(encoded) + 1))(*(encoded + [None]))
+
+
+def posix_spawnp(executable, args, env=None, dup2s=(), closes=(),
+                 closefrom=None, cwd=None,
+                 default_signals=(signal.SIGPIPE,)):
+    """Start a program without fork()-ing this process
+
+    The C library implements posix_spawn with vfork or clone(CLONE_VM),
+    so the cost of starting a program does not grow with the size of
+    this process, and no memory is committed for a copy of it.
+
+    In the child, the file descriptor pairs in dup2s are duplicated,
+    the descriptors in closes are closed, every descriptor from
+    closefrom up is closed, the working directory is changed to cwd,
+    and the signals in default_signals are reset to their default
+    dispositions, in that order.  The executable is searched for in
+    the $PATH of this process, even if env is passed.  Returns the
+    child's process id.
+
+    Check can_posix_spawn first: the result of calling this when it
+    returns False is an ENOSYS error.
+    """
+    if not can_posix_spawn(closefrom=closefrom is not None,
+                           chdir=cwd is not None):
+        _raise_errno(errno.ENOSYS)
+
+    file_actions = ctypes.create_string_buffer(_SPAWN_FILE_ACTIONS_SZ)
+    attr = ctypes.create_string_buffer(_SPAWNATTR_SZ)
+    sigset = ctypes.create_string_buffer(_SIGSET_SZ)
+
+    _check_spawn(_fa_init(file_actions))
+    try:
+        _check_spawn(_attr_init(attr))
+        try:
+            for fd, target in dup2s:
+                _check_spawn(_fa_adddup2(file_actions, fd, target))
+            for fd in closes:
+                _check_spawn(_fa_addclose(file_actions, fd))
+            if closefrom is not None:
+                _check_spawn(_fa_addclosefrom(file_actions, closefrom))
+            if cwd is not None:
+                _check_spawn(_fa_addchdir(file_actions, _fs_encode(cwd)))
+
+            _check(_sigemptyset(sigset))
+            for signum in default_signals:
+                _check(_sigaddset(sigset, signum))
+            _check_spawn(_attr_setsigdefault(attr, sigset))
+            _check_spawn(_attr_setflags(attr, POSIX_SPAWN_SETSIGDEF))
+
+            if env is None:
+                env = os.environ
+            envp = _c_string_array(['{0}={1}'.format(k, v)
+                                    for k, v in env.iteritems()])
+            argv = _c_string_array(args)
+
+            pid = ctypes.c_int()
+            _check_spawn(_posix_spawnp(ctypes.byref(pid),
+                                       _fs_encode(executable),
+                                       file_actions, attr, argv, envp))
+            return pid.value
+        finally:
+            _attr_destroy(attr)
+    finally:
+        _fa_destroy(file_actions)
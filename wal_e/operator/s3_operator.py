@@ -5,7 +5,9 @@ import itertools
 import json
 import logging
 import os
+import re
 import sys
+import traceback
 
 import wal_e.worker.s3_worker as s3_worker
 import wal_e.tar_partition as tar_partition
@@ -13,11 +15,16 @@ import wal_e.log_help as log_help
 
 from cStringIO import StringIO
 
+from wal_e import piper
 from wal_e import worker
+from wal_e.cache import JsonCache, ObjectCache
 from wal_e.exception import UserException, UserCritical
 from wal_e.storage import s3_storage
 from wal_e.worker import PgBackupStatements
 from wal_e.worker import PgControlDataParser
+from wal_e.worker import prefetch
+from wal_e.worker import wal_bundle
+from wal_e.worker.wal_transfer import WalSegment, WalTransferGroup
 
 
 logger = log_help.WalELogger(__name__, level=logging.INFO)
@@ -27,6 +34,13 @@ logger = log_help.WalELogger(__name__, level=logging.INFO)
 # structure.
 FILE_STRUCTURE_VERSION = s3_storage.CURRENT_VERSION
 
+# How long the details of a backup are kept in the state directory.
+BACKUP_DETAIL_TTL = 30 * 24 * 60 * 60
+
+# How often a drainer waiting for a run of WAL files to fill a bundle
+# looks for more of them.
+SPOOL_POLL_SECONDS = 1
+
 
 class S3Backup(object):
     """
@@ -74,9 +88,10 @@ class S3Backup(object):
 
         s3_conn = self.new_connection()
 
+        cache = ObjectCache('backup-details', ttl=BACKUP_DETAIL_TTL)
         bl = s3_worker.BackupList(s3_conn,
                                   s3_storage.StorageLayout(self.s3_prefix),
-                                  detail)
+                                  detail, cache=cache)
 
         # If there is no query, return an exhaustive list, otherwise
         # find a backup instad.
@@ -89,13 +104,17 @@ class S3Backup(object):
         w_csv = csv.writer(sys.stdout, dialect='excel-tab')
         w_csv.writerow(BackupInfo._fields)
 
-        for backup_info in bl_iter:
-            w_csv.writerow(backup_info)
+        try:
+            for backup_info in bl_iter:
+                w_csv.writerow(backup_info)
+        finally:
+            cache.close()
 
         sys.stdout.flush()
 
     def _s3_upload_pg_cluster_dir(self, start_backup_info, pg_cluster_dir,
-                                  version, pool_size, rate_limit=None):
+                                  version, pool_size, rate_limit=None,
+                                  direct_io=False):
         """
         Upload to s3_url_prefix from pg_cluster_dir
 
@@ -122,6 +141,10 @@ class S3Backup(object):
         (which occupy /tmp space and page cache) and number of uploads
         (which affect upload throughput) would help.
 
+        Cluster files themselves are read so as to leave the page
+        cache as it was found, or, with direct_io, read bypassing the
+        page cache altogether.
+
         """
         parts = tar_partition.partition(pg_cluster_dir)
 
@@ -153,7 +176,8 @@ class S3Backup(object):
 
         uploader = s3_worker.PartitionUploader(backup_s3_prefix,
                                                per_process_limit,
-                                               self.gpg_key_id)
+                                               self.gpg_key_id,
+                                               direct_io=direct_io)
 
         pool = worker.TarUploadPool(uploader, pool_size)
 
@@ -318,10 +342,9 @@ class S3Backup(object):
             # segments are needed to get to consistency.
             sentinel_content = StringIO()
             json.dump(
-                {'wal_segment_backup_stop':
-                     stop_backup_info['file_name'],
+                {'wal_segment_backup_stop': stop_backup_info['file_name'],
                  'wal_segment_offset_backup_stop':
-                     stop_backup_info['file_offset'],
+                 stop_backup_info['file_offset'],
                  'expanded_size_bytes': expanded_size_bytes},
                 sentinel_content)
 
@@ -334,23 +357,212 @@ class S3Backup(object):
             s3_worker.uri_put_file(
                 uploaded_to + '_backup_stop_sentinel.json',
                 sentinel_content, content_encoding='application/json')
+
+            self._put_listed_sentinel(s3_storage.BackupInfo(
+                name='base_{file_name}_{file_offset}'.format(
+                    **start_backup_info),
+                last_modified=None,
+                expanded_size_bytes=expanded_size_bytes,
+                wal_segment_backup_start=start_backup_info['file_name'],
+                wal_segment_offset_backup_start=(
+                    start_backup_info['file_offset']),
+                wal_segment_backup_stop=stop_backup_info['file_name'],
+                wal_segment_offset_backup_stop=(
+                    stop_backup_info['file_offset'])))
         else:
             # NB: Other exceptions should be raised before this that
             # have more informative results, it is intended that this
             # exception never will get raised.
             raise UserCritical('could not complete backup process')
 
-    def wal_s3_archive(self, wal_path):
+    def _put_listed_sentinel(self, backup_info):
+        # The backup is complete without it, only slower to list in
+        # detail, so do not fail the backup for want of it.
+        try:
+            s3_worker.s3_put_listed_sentinel(
+                s3_storage.StorageLayout(self.s3_prefix), backup_info)
+        except Exception, e:
+            logger.warning(
+                msg='could not add the listing-only sentinel of a backup',
+                detail=('Adding it for {name} failed: {error}'
+                        .format(name=backup_info.name, error=e)),
+                hint='Run "wal-e backup-migrate" to add it later.')
+
+    def backup_migrate(self):
+        """
+        Adds listing-only sentinels to backups that lack them
+
+        Backups pushed by earlier versions of WAL-E only have
+        sentinels that backup-list --detail must fetch one by one.
+
+        """
+        bl = s3_worker.BackupList(self.new_connection(),
+                                  s3_storage.StorageLayout(self.s3_prefix),
+                                  detail=True)
+
+        for backup_info in bl.unlisted():
+            if 'timeout' in (backup_info.expanded_size_bytes,
+                             backup_info.wal_segment_backup_stop):
+                logger.warning(
+                    msg='could not fetch the details of a backup',
+                    detail=('Skipping {name}, which can be migrated by '
+                            'running backup-migrate again.'
+                            .format(name=backup_info.name)))
+                continue
+
+            self._put_listed_sentinel(backup_info)
+            logger.info(msg='added the listing-only sentinel of a backup',
+                        detail='Migrated {name}.'.format(
+                            name=backup_info.name))
+
+    def wal_s3_archive(self, wal_path, concurrency=1, spool=None,
+                       trim_zero_tail=False, skip_archived=False,
+                       index_wal=False):
         """
         Uploads a WAL file to S3
 
         This code is intended to typically be called from Postgres's
         archive_command feature.
+
+        Postgres asks for one WAL file at a time, so to keep up with
+        bursts of writes, up to concurrency - 1 other WAL files
+        awaiting archiving are uploaded at the same time, and marked
+        as archived in Postgres's archive_status directory.
+
+        With a spool, a WAL segment is instead stored there, and
+        uploaded in the background, unless the spool is full.  Other
+        WAL files, such as timeline history files, are rare, and
+        uploaded at once.
+
+        With trim_zero_tail, the zeros a WAL segment ends in, as
+        segments closed early do, are left out and recreated when the
+        segment is fetched.
+
+        With skip_archived, a WAL file is first looked up in S3, as
+        Postgres pushes WAL files again after a crash or failover, and
+        not uploaded again if archived already with the same contents.
+
+        With index_wal, uploaded segments are added to the WAL index.
         """
-        wal_file_name = os.path.basename(wal_path)
+        segment = WalSegment(wal_path, explicit=True)
+
+        # A previous wal-push may have uploaded this file along with
+        # the one it was asked to.
+        if segment.is_done():
+            logger.info(msg='skipping a WAL file archived already',
+                        detail=('"{wal_path}" is marked as archived.'
+                                .format(wal_path=wal_path)),
+                        structured={'action': 'push-wal',
+                                    'seg': segment.name,
+                                    'prefix': self.s3_prefix,
+                                    'state': 'skip'})
+            return
+
+        is_segment = re.match(s3_storage.SEGMENT_REGEXP + '$',
+                              segment.name) is not None
+
+        if spool is not None and is_segment:
+            if spool.has_room(os.path.getsize(wal_path)):
+                # As in _wal_s3_upload, the MD5 is spooled along with
+                # the segment, for the drainer to record.
+                segment_md5 = None
+                if skip_archived:
+                    segment_md5 = s3_worker.file_md5(wal_path)
+                    if self._wal_s3_archived(segment, segment_md5):
+                        return
+
+                self._wal_spool(spool, segment, trim_zero_tail,
+                                segment_md5)
+                self._start_wal_spool_drain(spool, concurrency, index_wal)
+                return
+
+            logger.warning(
+                msg='WAL spool is full, uploading synchronously',
+                detail=('The spool "{0}" holds {1} bytes of its maximum '
+                        'of {2}.'.format(spool.directory, spool.usage(),
+                                         spool.max_bytes)),
+                hint=('Check that WAL files are being uploaded from the '
+                      'spool.'))
+
+        group = WalTransferGroup(functools.partial(
+            self._wal_s3_upload, trim_zero_tail=trim_zero_tail,
+            skip_archived=skip_archived, index_wal=index_wal))
+        group.start(segment)
+
+        started = 1
+        ready = WalSegment.from_ready_archive_status(
+            os.path.dirname(wal_path))
+        for other_segment in ready:
+            if started >= concurrency:
+                break
+
+            if other_segment.name != segment.name:
+                group.start(other_segment)
+                started += 1
+
+        group.join()
+
+    def _wal_s3_archived(self, segment, segment_md5=None):
+        """Whether segment is archived already, with the same contents
+
+        Raises a UserException if it is archived with other contents,
+        which Postgres must not be told are archived.  A WAL file
+        archived without its MD5 cannot be compared, so is taken to be
+        absent.  Segments are looked for in bundles, too.
+        """
+        wal_url = '{0}/wal_{1}'.format(self.s3_prefix, FILE_STRUCTURE_VERSION)
+        s3_url = '{0}/{1}.lzo'.format(wal_url, segment.name)
+        archived_md5 = s3_worker.s3_archived_md5(s3_url)
+
+        if (archived_md5 is None and
+                re.match(s3_storage.SEGMENT_REGEXP + '$',
+                         segment.name) is not None and
+                s3_worker.wal_bundles_used(wal_url)):
+            found = s3_worker.find_in_wal_bundle(wal_url, segment.name)
+            if found is not None:
+                s3_url, archived_md5 = found[0], found[3]
+
+        if not archived_md5:
+            return False
+
+        if segment_md5 is None:
+            segment_md5 = s3_worker.file_md5(segment.path)
+
+        if archived_md5 != segment_md5:
+            raise UserException(
+                msg='WAL file archived already with different contents',
+                detail=('"{0}" has the MD5 {1}, but "{2}" was archived '
+                        'from a file with the MD5 {3}.'
+                        .format(segment.path, segment_md5, s3_url,
+                                archived_md5)),
+                hint=('Check that no other database archives to the '
+                      'same prefix.'))
+
+        logger.info(msg='skipping a WAL file archived already',
+                    detail=('"{0}" is archived as "{1}" with the same '
+                            'contents.'.format(segment.path, s3_url)),
+                    structured={'action': 'push-wal',
+                                'key': s3_url,
+                                'seg': segment.name,
+                                'prefix': self.s3_prefix,
+                                'state': 'skip'})
+        return True
+
+    def _wal_s3_upload(self, segment, trim_zero_tail=False,
+                       skip_archived=False, index_wal=False):
+        wal_path = segment.path
+        wal_file_name = segment.name
         s3_url = '{0}/wal_{1}/{2}'.format(
             self.s3_prefix, FILE_STRUCTURE_VERSION, wal_file_name)
 
+        # The MD5 costs reading the WAL file once more, so it is only
+        # computed, and recorded, when it is to be compared.
+        segment_md5 = None
+        if skip_archived:
+            segment_md5 = s3_worker.file_md5(wal_path)
+            if self._wal_s3_archived(segment, segment_md5):
+                return
+
         logger.info(msg='begin archiving a file',
                     detail=('Uploading "{wal_path}" to "{s3_url}".'
                             .format(wal_path=wal_path, s3_url=s3_url)),
@@ -361,22 +573,221 @@ class S3Backup(object):
                                 'state': 'begin'})
 
         # Upload and record the rate at which it happened.
-        kib_per_second = s3_worker.do_lzop_s3_put(s3_url, wal_path,
-                                                  self.gpg_key_id)
+        #
+        # Only segments have a fixed size to extend them back to.
+        is_segment = re.match(s3_storage.SEGMENT_REGEXP + '$',
+                              wal_file_name) is not None
+        kib_per_second = s3_worker.do_lzop_s3_put(
+            s3_url, wal_path, self.gpg_key_id,
+            trim_zero_tail=trim_zero_tail and is_segment,
+            segment_md5=segment_md5)
+
+        if index_wal and is_segment:
+            s3_worker.s3_put_wal_index_deltas(
+                '{0}/wal_{1}'.format(self.s3_prefix, FILE_STRUCTURE_VERSION),
+                [wal_file_name])
 
         logger.info(
             msg='completed archiving to a file ',
             detail=('Archiving to "{s3_url}" complete at '
-                    '{kib_per_second}KiB/s. ')
-            .format(s3_url=s3_url, kib_per_second=kib_per_second),
+                    '{kib_per_second}KiB/s. '
+                    .format(s3_url=s3_url, kib_per_second=kib_per_second)),
+            structured={'action': 'push-wal',
+                        'key': s3_url,
+                        'rate': kib_per_second,
+                        'seg': wal_file_name,
+                        'prefix': self.s3_prefix,
+                        'state': 'complete'})
+
+    def _wal_spool(self, spool, segment, trim_zero_tail=False,
+                   segment_md5=None):
+        length = segment_size = None
+        if trim_zero_tail:
+            length, segment_size = (s3_worker.trimmed_size(segment.path) or
+                                    (None, None))
+
+        spool.add(segment.name,
+                  lambda f: s3_worker.lzop_compress(segment.path, f,
+                                                    self.gpg_key_id,
+                                                    length=length),
+                  segment_size=segment_size, segment_md5=segment_md5)
+
+        logger.info(msg='spooled a WAL file for archiving',
+                    detail=('"{wal_path}" is stored in "{spool}" until it '
+                            'is uploaded.'.format(wal_path=segment.path,
+                                                  spool=spool.directory)),
                     structured={'action': 'push-wal',
-                                'key': s3_url,
-                                'rate': kib_per_second,
-                                'seg': wal_file_name,
+                                'seg': segment.name,
                                 'prefix': self.s3_prefix,
-                                'state': 'complete'})
+                                'state': 'spooled'})
+
+    def _start_wal_spool_drain(self, spool, concurrency, index_wal=False):
+        args = ['wal-spool-drain', '--spool-dir', spool.directory,
+                '--pool-size', str(concurrency)]
+        if spool.bundle_size > 1:
+            args.extend(['--bundle-size', str(spool.bundle_size),
+                         '--bundle-max-age', str(spool.bundle_max_age)])
+        if index_wal:
+            args.append('--wal-index')
+
+        self._start_wal_e(*args)
+
+    def _spooled_batches(self, spool, spooled):
+        """Group the WAL files in a spool into uploads to start now
+
+        spooled is the spool's listing, as from Spool.spooled().  Each
+        upload is a list of the names of the WAL files in it.  Without
+        bundling, each WAL file is uploaded on its own.
+
+        Returns the uploads and the number of seconds until the run
+        held back to fill a bundle is to be uploaded anyway, or None
+        if there is no such run.
+        """
+        if spool.bundle_size <= 1:
+            return [[name] for name in sorted(spooled)], None
+
+        batches = []
+        for run in wal_bundle.consecutive_runs(sorted(spooled)):
+            for start in xrange(0, len(run), spool.bundle_size):
+                batches.append(run[start:start + spool.bundle_size])
+
+        # The last run may yet grow into a full bundle, unless it has
+        # been waiting for too long.
+        if batches and len(batches[-1]) < spool.bundle_size:
+            age = spool.age(spooled[batches[-1][0]])
+            if age < spool.bundle_max_age:
+                batches.pop()
+                return batches, spool.bundle_max_age - age
+
+        return batches, None
+
+    def wal_s3_spool_drain(self, spool, concurrency=1, index_wal=False):
+        """
+        Uploads the WAL files in a spool
+
+        Only one process drains a spool at a time, and this returns at
+        once if another is doing so.  Otherwise, it returns once the
+        spool is empty or some uploads have failed: those WAL files
+        are left for the next drain.
+
+        WAL files waiting to fill a bundle are waited for, rather than
+        left for the next drain, which may not come for as long as the
+        database is idle.  They are uploaded once the oldest of them
+        has been spooled for bundle_max_age seconds, if no more WAL
+        files have filled the bundle by then.
+        """
+        spool.remove_stale_temporary()
+
+        while True:
+            lock = spool.try_lock_drain()
+            if lock is None:
+                return
+
+            try:
+                while True:
+                    spooled = spool.spooled()
+                    batches, wait = self._spooled_batches(spool, spooled)
+                    if not batches:
+                        if wait is None:
+                            break
+
+                        # Keep the lock while waiting, so that the
+                        # wal-pushes filling the bundle leave it to
+                        # this process.
+                        gevent.sleep(min(wait, SPOOL_POLL_SECONDS))
+                        continue
+
+                    pool = gevent.pool.Pool(concurrency)
+                    uploads = [pool.spawn(self._wal_s3_upload_spooled,
+                                          spool, spooled, names, index_wal)
+                               for names in batches]
+                    pool.join()
+
+                    if not all(g.value for g in uploads):
+                        return
+            finally:
+                lock.close()
+
+            # A WAL file spooled just before the lock was released may
+            # have been left for this process to upload, because its
+            # wal-push found this process still draining the spool.
+            batches, wait = self._spooled_batches(spool, spool.spooled())
+            if not batches and wait is None:
+                return
+
+    def _wal_s3_upload_spooled(self, spool, spooled, names, index_wal=False):
+        if len(names) == 1:
+            s3_url = '{0}/wal_{1}/{2}.lzo'.format(
+                self.s3_prefix, FILE_STRUCTURE_VERSION, names[0])
+        else:
+            s3_url = '{0}/wal_{1}/bundles/{2}'.format(
+                self.s3_prefix, FILE_STRUCTURE_VERSION,
+                wal_bundle.bundle_name(names))
+
+        files = []
+        try:
+            files.extend(spool.open(spooled[name]) for name in names)
+
+            sizes = [spool.segment_size(spooled[name]) for name in names]
+            md5s = [spool.segment_md5(spooled[name]) for name in names]
 
-    def wal_s3_restore(self, wal_name, wal_destination):
+            if len(files) == 1:
+                kib_per_second = s3_worker.s3_put_compressed(
+                    s3_url, files[0], segment_size=sizes[0],
+                    segment_md5=md5s[0])
+            else:
+                kib_per_second = s3_worker.s3_put_wal_bundle(
+                    s3_url, zip(names, files, sizes, md5s))
+
+            if index_wal:
+                s3_worker.s3_put_wal_index_deltas(
+                    '{0}/wal_{1}'.format(self.s3_prefix,
+                                         FILE_STRUCTURE_VERSION),
+                    names)
+        except UserException, e:
+            logger.warning(
+                msg='could not upload a spooled WAL file',
+                detail=log_help.WalELogger.fmt_logline(e.msg, e.detail,
+                                                       e.hint))
+            return False
+        except Exception:
+            logger.warning(
+                msg='could not upload a spooled WAL file',
+                detail=''.join(traceback.format_exception(*sys.exc_info())))
+            return False
+        finally:
+            for f in files:
+                f.close()
+
+        for name in names:
+            spool.remove(spooled[name])
+
+        logger.info(
+            msg='completed archiving a spooled file',
+            detail=('Archiving to "{s3_url}" complete at '
+                    '{kib_per_second}KiB/s. ')
+            .format(s3_url=s3_url, kib_per_second=kib_per_second),
+            structured={'action': 'push-wal',
+                        'key': s3_url,
+                        'rate': kib_per_second,
+                        'seg': names[-1],
+                        'prefix': self.s3_prefix,
+                        'state': 'complete'})
+        return True
+
+    def _wal_misses(self, miss_ttl):
+        """The WAL files recently found missing, if remembered at all
+
+        Keys are the S3 URLs of the files, so that archives in other
+        prefixes do not mix.
+        """
+        if miss_ttl > 0:
+            return JsonCache('wal-misses', ttl=miss_ttl)
+
+        return None
+
+    def wal_s3_restore(self, wal_name, wal_destination, prefetch_max=0,
+                       miss_ttl=0):
         """
         Downloads a WAL file from S3
 
@@ -386,11 +797,39 @@ class S3Backup(object):
         NB: Postgres doesn't guarantee that wal_name ==
         basename(wal_path), so both are required.
 
+        With prefetch_max, downloads of up to that many of the WAL
+        files following wal_name are started in the background, for
+        later calls to find in place.
+
+        With miss_ttl, WAL files found missing are remembered as such
+        for that many seconds, and asked for again, as Postgres does
+        at the end of the archive and when looking for timelines, are
+        reported missing without asking S3.  A file archived in the
+        meantime is only found once that time is up.
+
         """
+        misses = self._wal_misses(miss_ttl)
+
+        if prefetch_max > 0:
+            if self._wal_s3_restore_prefetched(wal_name, wal_destination,
+                                               prefetch_max, misses):
+                return True
 
         s3_url = '{0}/wal_{1}/{2}.lzo'.format(
             self.s3_prefix, FILE_STRUCTURE_VERSION, wal_name)
 
+        if misses is not None and misses.get(s3_url):
+            logger.info(
+                msg='wal file was recently found missing',
+                detail=('The absolute URI that could not be located '
+                        'is {0}.'.format(s3_url)),
+                structured={'action': 'wal-fetch',
+                            'key': s3_url,
+                            'seg': wal_name,
+                            'prefix': self.s3_prefix,
+                            'state': 'miss-cached'})
+            return False
+
         logger.info(
             msg='begin wal restore',
             structured={'action': 'wal-fetch',
@@ -399,8 +838,18 @@ class S3Backup(object):
                         'prefix': self.s3_prefix,
                         'state': 'begin'})
 
-        ret = s3_worker.do_lzop_s3_get(
-            s3_url, wal_destination, self.gpg_key_id is not None)
+        ret = self._wal_s3_get(wal_name, s3_url, wal_destination)
+
+        if not ret and misses is not None:
+            misses.put(s3_url, True)
+
+        # Recovery has moved on to this WAL file, so prefetched copies
+        # of it, as from a download that finished too late, and of the
+        # files before it only take up space, whether or not this
+        # wal-fetch prefetches.
+        if re.match(s3_storage.SEGMENT_REGEXP + '$', wal_name) is not None:
+            xlog_dir = os.path.dirname(os.path.realpath(wal_destination))
+            prefetch.Dirs(xlog_dir).clear_through(wal_name)
 
         logger.info(
             msg='complete wal restore',
@@ -412,6 +861,169 @@ class S3Backup(object):
 
         return ret
 
+    def _wal_s3_get(self, wal_name, s3_url, destination):
+        """Download a WAL file, whether on its own or in a bundle"""
+        decrypt = self.gpg_key_id is not None
+
+        if s3_worker.do_lzop_s3_get(s3_url, destination, decrypt):
+            return True
+
+        # Only WAL segments are bundled.
+        if re.match(s3_storage.SEGMENT_REGEXP + '$', wal_name) is None:
+            return False
+
+        wal_url = '{0}/wal_{1}'.format(self.s3_prefix, FILE_STRUCTURE_VERSION)
+        if not s3_worker.wal_bundles_used(wal_url):
+            return False
+
+        found = s3_worker.find_in_wal_bundle(wal_url, wal_name)
+        if found is None:
+            return False
+
+        bundle_url, byte_range, segment_size = found[:3]
+        return s3_worker.do_lzop_s3_get(bundle_url, destination, decrypt,
+                                        byte_range=byte_range,
+                                        segment_size=segment_size)
+
+    def _wal_s3_restore_prefetched(self, wal_name, wal_destination,
+                                   prefetch_max, misses=None):
+        future = list(itertools.islice(
+            prefetch.future_segment_names(wal_name), prefetch_max))
+
+        # Only WAL segments are prefetched, and not timeline history
+        # files.
+        if not future:
+            return False
+
+        # Prefetched files are renamed into place, so they are kept in
+        # the destination's file system.
+        xlog_dir = os.path.dirname(os.path.realpath(wal_destination))
+        pd = prefetch.Dirs(xlog_dir)
+        pd.clear_before(wal_name)
+
+        for name in future:
+            if pd.contains(name) or pd.is_running(name):
+                continue
+
+            if misses is None:
+                self._start_wal_prefetch(xlog_dir, name)
+            elif not misses.get('{0}/wal_{1}/{2}.lzo'.format(
+                    self.s3_prefix, FILE_STRUCTURE_VERSION, name)):
+                self._start_wal_prefetch(xlog_dir, name,
+                                         miss_ttl=misses.ttl)
+
+        # Wait on a download of wal_name that is already under way,
+        # for as long as it makes progress.
+        last_size = -1
+        while not pd.contains(wal_name):
+            size = pd.running_size(wal_name)
+            if size is None or size <= last_size:
+                break
+
+            last_size = size
+            gevent.sleep(0.5)
+
+        if not pd.promote(wal_name, wal_destination):
+            return False
+
+        logger.info(
+            msg='complete wal restore from a prefetched file',
+            structured={'action': 'wal-fetch',
+                        'seg': wal_name,
+                        'prefix': self.s3_prefix,
+                        'state': 'prefetch-hit'})
+        return True
+
+    def _start_wal_e(self, *args):
+        """Start a WAL-E subcommand in the background
+
+        The process is not waited on, and may well outlive this one.
+        """
+        # The secret key is passed on in the environment, and the
+        # rest on the command line.
+        command = [sys.executable, '-m', 'wal_e.cmd',
+                   '--aws-access-key-id', self.aws_access_key_id,
+                   '--s3-prefix', self.s3_prefix]
+        if self.gpg_key_id is not None:
+            command.extend(['--gpg-key-id', self.gpg_key_id])
+        command.extend(args)
+
+        with open(os.devnull, 'r+') as devnull:
+            piper.popen_sp(command, stdin=devnull, stdout=devnull,
+                           close_fds=True)
+
+    def _start_wal_prefetch(self, xlog_dir, wal_name, miss_ttl=0):
+        self._start_wal_e('wal-prefetch', '--miss-ttl', str(miss_ttl),
+                          xlog_dir, wal_name)
+
+    def wal_s3_prefetch(self, xlog_dir, wal_name, miss_ttl=0):
+        """
+        Downloads a WAL file from S3 for a later wal_s3_restore
+
+        A WAL file found missing is remembered as such for miss_ttl
+        seconds, as by wal_s3_restore.
+
+        """
+        pd = prefetch.Dirs(xlog_dir)
+        if pd.contains(wal_name) or pd.is_running(wal_name):
+            return
+
+        s3_url = '{0}/wal_{1}/{2}.lzo'.format(
+            self.s3_prefix, FILE_STRUCTURE_VERSION, wal_name)
+
+        misses = self._wal_misses(miss_ttl)
+        if misses is not None and misses.get(s3_url):
+            return
+
+        logger.info(
+            msg='begin wal prefetch',
+            structured={'action': 'wal-prefetch',
+                        'key': s3_url,
+                        'seg': wal_name,
+                        'prefix': self.s3_prefix,
+                        'state': 'begin'})
+
+        download_path = pd.download_path(wal_name)
+        try:
+            found = self._wal_s3_get(wal_name, s3_url, download_path)
+        except:
+            os.unlink(download_path)
+            raise
+
+        if found and pd.complete(wal_name, download_path):
+            logger.info(
+                msg='complete wal prefetch',
+                structured={'action': 'wal-prefetch',
+                            'key': s3_url,
+                            'seg': wal_name,
+                            'prefix': self.s3_prefix,
+                            'state': 'complete'})
+        elif not found:
+            os.unlink(download_path)
+
+            if misses is not None:
+                misses.put(s3_url, True)
+
+    def wal_index(self, rebuild=False):
+        """
+        Merges the WAL index, and lists the runs of segments in it
+
+        """
+        import csv
+
+        index_cxt = s3_worker.WalIndexContext(
+            self.new_connection(), s3_storage.StorageLayout(self.s3_prefix))
+        timelines = index_cxt.merge(rebuild=rebuild)
+
+        w_csv = csv.writer(sys.stdout, dialect='excel-tab')
+        w_csv.writerow(('first_segment', 'last_segment'))
+
+        for tli in sorted(timelines):
+            for run in timelines[tli]:
+                w_csv.writerow(run)
+
+        sys.stdout.flush()
+
     def delete_old_versions(self, dry_run):
         assert s3_storage.CURRENT_VERSION not in s3_storage.OBSOLETE_VERSIONS
 
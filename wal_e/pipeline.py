@@ -2,10 +2,8 @@
 compression/encryption.
 """
 
-from gevent import sleep
-
 from wal_e.exception import UserCritical
-from wal_e.piper import popen_sp, NonBlockPipeFileWrap, PIPE
+from wal_e.piper import popen_sp, wait_exit, NonBlockPipeFileWrap, PIPE
 
 PV_BIN = 'pv'
 GPG_BIN = 'gpg'
@@ -68,13 +66,15 @@ class Pipeline(object):
         last_command.stdoutSet = out_fd
         last_command.start()
 
+    # The data to compress or decompress flows through these, so they
+    # are grown to move more of it per system call.
     @property
     def stdin(self):
-        return NonBlockPipeFileWrap(self.commands[0].stdin)
+        return NonBlockPipeFileWrap(self.commands[0].stdin, grow=True)
 
     @property
     def stdout(self):
-        return NonBlockPipeFileWrap(self.commands[-1].stdout)
+        return NonBlockPipeFileWrap(self.commands[-1].stdout, grow=True)
 
     def finish(self):
         for command in self.commands:
@@ -142,13 +142,7 @@ class PipelineCommand(object):
             return self._process.returncode
 
     def finish(self):
-        while True:
-            if self._process.poll() is not None:
-                break
-            else:
-                sleep(0.1)
-
-        retcode = self._process.wait()
+        retcode = wait_exit(self._process)
 
         if self.stdout is not None:
             self.stdout.close()
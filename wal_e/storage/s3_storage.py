@@ -25,6 +25,15 @@ COMPLETE_BASE_BACKUP_REGEXP = (
     r'base_' + SEGMENT_REGEXP +
     r'_(?P<offset>[0-9A-F]{8})_backup_stop_sentinel\.json')
 
+# Besides its sentinel, a complete backup has an empty object under
+# the sentinels directory, named after everything in the sentinel, so
+# that a listing is enough to detail backups.
+LISTED_BASE_BACKUP_REGEXP = (
+    BASE_BACKUP_REGEXP +
+    r'_(?P<wal_segment_backup_stop>[0-9A-F]{24})'
+    r'_(?P<wal_segment_offset_backup_stop>[0-9A-F]{8})'
+    r'_(?P<expanded_size_bytes>[0-9]+)')
+
 VOLUME_REGEXP = (r'part_(\d+)\.tar\.lzo')
 
 
@@ -127,6 +136,17 @@ class StorageLayout(object):
         return (self.basebackup_directory(backup_info) +
                 '_backup_stop_sentinel.json')
 
+    def basebackup_listed_sentinels(self):
+        return self.basebackups() + 'sentinels/'
+
+    def basebackup_listed_sentinel(self, backup_info):
+        """The name of the listing-only sentinel of a backup"""
+        self._error_on_unexpected_version()
+        return (self.basebackup_listed_sentinels() +
+                '{0.name}_{0.wal_segment_backup_stop}_'
+                '{0.wal_segment_offset_backup_stop}_'
+                '{0.expanded_size_bytes}'.format(backup_info))
+
     def basebackup_tar_partition_directory(self, backup_info):
         self._error_on_unexpected_version()
         return (self.basebackup_directory(backup_info) +
@@ -34,7 +34,7 @@ class Popen(args, bufsize=0, executable=None,
             stdin=None, stdout=None, stderr=None,
             preexec_fn=None, close_fds=False, shell=False,
             cwd=None, env=None, universal_newlines=False,
-            startupinfo=None, creationflags=0):
+            startupinfo=None, creationflags=0, restore_signals=False):
 
 
 Arguments are:
@@ -106,6 +106,15 @@ underlying CreateProcess() function.  They can specify things such as
 appearance of the main window and priority for the new process.
 (Windows only)
 
+If restore_signals is true, signals that Python sets to SIG_IGN
+(SIGPIPE and SIGXFSZ) are restored to SIG_DFL in the child
+process before the exec.  (POSIX only)
+
+On POSIX, when no preexec_fn or env is given, the child is started
+with posix_spawn() where the C library supports it, rather than
+fork() and exec().  This avoids copying (or, under strict overcommit
+accounting, committing memory for) a large parent process.
+
 
 This module also defines some shortcut functions:
 
@@ -431,6 +440,13 @@ else:
     import fcntl
     import pickle
 
+    from wal_e import libc
+
+    # Signals Python ignores by default, which restore_signals resets.
+    _RESTORED_SIGNALS = tuple(getattr(signal, name)
+                              for name in ('SIGPIPE', 'SIGXFSZ')
+                              if hasattr(signal, name))
+
     # When select or poll has indicated that the file is writable,
     # we can write up to _PIPE_BUF bytes without risk of blocking.
     # POSIX defines PIPE_BUF as >= 512.
@@ -651,7 +667,7 @@ class Popen(object):
                  stdin=None, stdout=None, stderr=None,
                  preexec_fn=None, close_fds=False, shell=False,
                  cwd=None, env=None, universal_newlines=False,
-                 startupinfo=None, creationflags=0):
+                 startupinfo=None, creationflags=0, restore_signals=False):
         """Create new Popen instance."""
         _cleanup()
 
@@ -708,7 +724,7 @@ class Popen(object):
                                 startupinfo, creationflags, shell,
                                 p2cread, p2cwrite,
                                 c2pread, c2pwrite,
-                                errread, errwrite)
+                                errread, errwrite, restore_signals)
         except Exception:
             # Preserve original exception in case os.close raises.
             exc_type, exc_value, exc_trace = sys.exc_info()
@@ -900,7 +916,7 @@ class Popen(object):
                            startupinfo, creationflags, shell,
                            p2cread, p2cwrite,
                            c2pread, c2pwrite,
-                           errread, errwrite):
+                           errread, errwrite, restore_signals=False):
             """Execute program (MS Windows version)"""
 
             if not isinstance(args, types.StringTypes):
@@ -1157,6 +1173,33 @@ class Popen(object):
 
 
         def _close_fds(self, but):
+            # MAXFD is the nofile limit, which may be very high, so
+            # avoid a close() for every possible descriptor when the
+            # open ones can be found some other way.
+            try:
+                if but > 3:
+                    libc.close_range(3, but - 1)
+                libc.close_range(but + 1)
+                return
+            except OSError:
+                pass
+
+            try:
+                open_fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+            except (OSError, ValueError):
+                pass
+            else:
+                # The listing's own descriptor is among open_fds, but
+                # is closed by now.
+                for i in open_fds:
+                    if i < 3 or i == but:
+                        continue
+                    try:
+                        os.close(i)
+                    except:
+                        pass
+                return
+
             if hasattr(os, 'closerange'):
                 os.closerange(3, but)
                 os.closerange(but + 1, MAXFD)
@@ -1170,12 +1213,99 @@ class Popen(object):
                         pass
 
 
+        def _spawn_dup2s(self, p2cread, c2pwrite, errwrite):
+            """Plan the standard fd set-up of a posix_spawn-ed child
+
+            Returns the (fd, target) pairs to dup2, or None if the
+            descriptors are arranged in a way only the fork() path
+            handles: shuffling among the standard descriptors, or
+            inheriting a close-on-exec one in place.
+            """
+            dup2s = []
+            for fd, target in ((p2cread, 0), (c2pwrite, 1), (errwrite, 2)):
+                if fd is None:
+                    continue
+                elif fd == target:
+                    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+                    if flags & getattr(fcntl, 'FD_CLOEXEC', 1):
+                        return None
+                elif fd <= 2:
+                    return None
+                else:
+                    dup2s.append((fd, target))
+
+            return dup2s
+
+
+        def _spawn_closes(self, close_fds, dup2s):
+            """Plan which descriptors a posix_spawn-ed child closes
+
+            Returns the descriptors to close and the one from which all
+            are closed, or None if close_fds cannot be carried out.
+            posix_spawn_file_actions_addclosefrom_np is only in glibc
+            2.34 and later, so without it the descriptors found open
+            and inheritable in /proc/self/fd are closed one by one.
+            """
+            if not close_fds:
+                return sorted(set(fd for fd, target in dup2s)), None
+
+            if libc.can_posix_spawn(closefrom=True):
+                return (), 3
+
+            try:
+                open_fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+            except (OSError, ValueError):
+                return None
+
+            closes = []
+            for fd in sorted(open_fds):
+                if fd < 3:
+                    continue
+
+                # The listing's own descriptor is among open_fds, but
+                # is closed by now.
+                try:
+                    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+                except IOError:
+                    continue
+
+                if not flags & getattr(fcntl, 'FD_CLOEXEC', 1):
+                    closes.append(fd)
+
+            return closes, None
+
+
+        def _spawn_child(self, args, executable, closes, closefrom, cwd,
+                         restore_signals, dup2s,
+                         p2cread, p2cwrite,
+                         c2pread, c2pwrite,
+                         errread, errwrite):
+            """Execute program with posix_spawn"""
+            if restore_signals:
+                default_signals = _RESTORED_SIGNALS
+            else:
+                default_signals = ()
+
+            self.pid = libc.posix_spawnp(
+                executable, args, dup2s=dup2s, closes=closes,
+                closefrom=closefrom, cwd=cwd,
+                default_signals=default_signals)
+            self._child_created = True
+
+            if p2cread is not None and p2cwrite is not None:
+                os.close(p2cread)
+            if c2pwrite is not None and c2pread is not None:
+                os.close(c2pwrite)
+            if errwrite is not None and errread is not None:
+                os.close(errwrite)
+
+
         def _execute_child(self, args, executable, preexec_fn, close_fds,
                            cwd, env, universal_newlines,
                            startupinfo, creationflags, shell,
                            p2cread, p2cwrite,
                            c2pread, c2pwrite,
-                           errread, errwrite):
+                           errread, errwrite, restore_signals=False):
             """Execute program (POSIX version)"""
 
             if isinstance(args, types.StringTypes):
@@ -1191,6 +1321,21 @@ class Popen(object):
             if executable is None:
                 executable = args[0]
 
+            spawn_dup2s = self._spawn_dup2s(p2cread, c2pwrite, errwrite)
+            spawn_closes = None
+            if (preexec_fn is None and env is None and
+                    spawn_dup2s is not None and
+                    libc.can_posix_spawn(chdir=cwd is not None)):
+                spawn_closes = self._spawn_closes(close_fds, spawn_dup2s)
+            if spawn_closes is not None:
+                closes, closefrom = spawn_closes
+                self._spawn_child(args, executable, closes, closefrom, cwd,
+                                  restore_signals, spawn_dup2s,
+                                  p2cread, p2cwrite,
+                                  c2pread, c2pwrite,
+                                  errread, errwrite)
+                return
+
             # For transferring possible exec failure from child to parent
             # The first char specifies the exception type: 0 means
             # OSError, 1 means some other error.
@@ -1256,6 +1401,10 @@ class Popen(object):
                             if cwd is not None:
                                 os.chdir(cwd)
 
+                            if restore_signals:
+                                for sig in _RESTORED_SIGNALS:
+                                    signal.signal(sig, signal.SIG_DFL)
+
                             if preexec_fn:
                                 preexec_fn()
 
@@ -42,9 +42,14 @@ process considerably more complicated.
 """
 import collections
 import errno
+import io
+import mmap
 import os
+import re
+import string
 import tarfile
 
+import wal_e.libc as libc
 import wal_e.log_help as log_help
 
 logger = log_help.WalELogger(__name__)
@@ -77,6 +82,13 @@ class StreamPadFileObj(object):
         ret = self.underlying_fp.read(max_readable)
         lenret = len(ret)
         self.pos += lenret
+
+        # Avoid copying the returned data to append nothing in the
+        # common case where the file did not shrink.
+        if lenret == max_readable:
+            return ret
+
+        self.pos += max_readable - lenret
         return ret + '\0' * (max_readable - lenret)
 
     def close(self):
@@ -89,6 +101,176 @@ class StreamPadFileObj(object):
         return self.close()
 
 
+# How much of the next member to ask the kernel to read ahead while
+# the current one is still being archived.  Asking for whole 1 GiB
+# relation files would itself push out much of the page cache.
+READAHEAD_SZ = 8 * 1024 * 1024
+
+# Size of a single read when bypassing the page cache with O_DIRECT.
+# It must be a multiple of the block size of the underlying device,
+# which a multiple of the page size practically always is.
+DIRECT_IO_CHUNK_SZ = 1024 * 1024
+
+# Translation table mapping a mincore() vector byte to '\1' when the
+# page is resident and '\0' when it is not: only the low bit of every
+# byte is defined.
+_RESIDENCY_TABLE = string.maketrans(
+    ''.join(chr(i) for i in xrange(256)),
+    ''.join(chr(i & 1) for i in xrange(256)))
+
+_NONRESIDENT_RUN = re.compile('\0+')
+
+
+def _advise_quietly(fd, offset, length, advice):
+    """Issue a posix_fadvise hint, ignoring failures
+
+    The advice never changes the result of a read, so a platform or
+    file system that does not support it is not worth complaining
+    about.
+    """
+    try:
+        libc.posix_fadvise(fd, offset, length, advice)
+    except EnvironmentError:
+        pass
+
+
+class DirectFileObj(object):
+    """
+    Read a file with O_DIRECT, bypassing the page cache
+
+    O_DIRECT requires reads into memory aligned to the device block
+    size, at aligned offsets, so data is read a large aligned chunk at
+    a time into a page-aligned anonymous mapping and handed out from
+    there.
+
+    """
+
+    def __init__(self, fd):
+        self._raw = io.FileIO(fd, 'r')
+        self._chunk = mmap.mmap(-1, DIRECT_IO_CHUNK_SZ)
+        self._pending = ''
+        self._eof = False
+
+    def fileno(self):
+        return self._raw.fileno()
+
+    def read(self, size):
+        if not self._pending and not self._eof:
+            n = self._raw.readinto(self._chunk)
+
+            # A short read means the end of the file was reached.
+            # Any growth after that point would have to be read at
+            # an unaligned offset, which O_DIRECT rejects: the
+            # growth ought to be in the WAL anyway.
+            if n < DIRECT_IO_CHUNK_SZ:
+                self._eof = True
+
+            self._pending = self._chunk[:n]
+
+        ret = self._pending[:size]
+        self._pending = self._pending[size:]
+        return ret
+
+    def close(self):
+        self._chunk.close()
+        return self._raw.close()
+
+
+def open_direct(path):
+    """Open a file for reading with O_DIRECT
+
+    Returns None if O_DIRECT is unavailable on this platform or file
+    system, in which case the caller should read the file normally.
+    """
+    o_direct = getattr(os, 'O_DIRECT', None)
+    if o_direct is None:
+        return None
+
+    try:
+        fd = os.open(path, os.O_RDONLY | o_direct)
+    except EnvironmentError, e:
+        if e.errno == errno.EINVAL:
+            return None
+        raise
+
+    return DirectFileObj(fd)
+
+
+class MemberFileObj(object):
+    """
+    A tar member file opened for reading, minding the page cache
+
+    Reading a cluster through the page cache evicts the database's
+    working set, so this notes which pages of the file were already
+    cached when it was opened and, upon closing, evicts only the pages
+    that were brought in by the backup itself.
+
+    Optionally, the file is instead read with O_DIRECT, bypassing the
+    page cache entirely.
+
+    """
+
+    __slots__ = ('fp', 'resident')
+
+    def __init__(self, path, size, direct_io=False):
+        self.resident = None
+        self.fp = None
+
+        if direct_io:
+            self.fp = open_direct(path)
+
+        if self.fp is None:
+            self.fp = open(path, 'rb')
+
+            try:
+                self.resident = libc.resident_pages(self.fp.fileno(), size)
+            except EnvironmentError:
+                # Not knowing what was cached means not knowing what
+                # can be evicted without hurting the database, so do
+                # not evict anything.
+                pass
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def read(self, size):
+        return self.fp.read(size)
+
+    def advise_readahead(self):
+        """Hint that the beginning of the file will be read soon"""
+        if self.resident is not None:
+            _advise_quietly(self.fileno(), 0, READAHEAD_SZ,
+                            libc.POSIX_FADV_WILLNEED)
+
+    def evict_read_pages(self):
+        """Drop pages from the cache that were not there to begin with"""
+        fd = self.fileno()
+        vec = self.resident.translate(_RESIDENCY_TABLE)
+
+        for m in _NONRESIDENT_RUN.finditer(vec):
+            _advise_quietly(fd, m.start() * libc.PAGE_SIZE,
+                            (m.end() - m.start()) * libc.PAGE_SIZE,
+                            libc.POSIX_FADV_DONTNEED)
+
+        # Anything past the pages accounted for at open time was
+        # appended afterwards, and was only read by the backup.
+        _advise_quietly(fd, len(vec) * libc.PAGE_SIZE, 0,
+                        libc.POSIX_FADV_DONTNEED)
+
+    def close(self):
+        try:
+            if self.resident is not None:
+                self.evict_read_pages()
+        finally:
+            self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return self.close()
+
+
 class TarMemberTooBigError(Exception):
     def __init__(self, member_name, limited_to, requested, *args, **kwargs):
         self.member_name = member_name
@@ -142,38 +324,153 @@ class TarPartition(list):
         list.__init__(self, *args, **kwargs)
 
     @staticmethod
-    def _padded_tar_add(tar, et_info):
+    def _open_member(et_info, direct_io):
+        """Open a file member for archiving, or None if it was unlinked"""
         try:
-            with open(et_info.submitted_path, 'rb') as raw_file:
-                with StreamPadFileObj(raw_file,
-                                      et_info.tarinfo.size) as f:
-                    tar.addfile(et_info.tarinfo, f)
-
+            return MemberFileObj(et_info.submitted_path,
+                                 et_info.tarinfo.size, direct_io=direct_io)
         except EnvironmentError, e:
             if (e.errno == errno.ENOENT and
-                e.filename == et_info.submitted_path):
+                    e.filename == et_info.submitted_path):
                 # log a NOTICE/INFO that the file was unlinked.
                 # Ostensibly harmless (such unlinks should be replayed
                 # in the WAL) but good to know.
                 logger.debug(
                     msg='tar member additions skipping an unlinked file',
                     detail='Skipping {0}.'.format(et_info.submitted_path))
+                return None
             else:
                 raise
 
-    def tarfile_write(self, fileobj):
+    def _opened_members(self, direct_io):
+        """Yield every member alongside an opened file, if it has one
+
+        Files are opened one member ahead of the one being yielded
+        and asked to be read ahead, so that the disk can be busy
+        fetching the next file while the current one is archived.
+        """
+        def open_if_file(et_info):
+            if et_info.tarinfo.isfile():
+                raw_file = self._open_member(et_info, direct_io)
+                if raw_file is not None:
+                    raw_file.advise_readahead()
+                return raw_file
+            return None
+
+        members = iter(self)
+        current = next(members, None)
+        current_file = None
+        next_file = None
+
+        try:
+            if current is not None:
+                current_file = open_if_file(current)
+
+            while current is not None:
+                upcoming = next(members, None)
+                if upcoming is not None:
+                    next_file = open_if_file(upcoming)
+
+                yield current, current_file
+
+                if current_file is not None:
+                    current_file.close()
+
+                current, current_file, next_file = upcoming, next_file, None
+        finally:
+            for raw_file in (current_file, next_file):
+                if raw_file is not None:
+                    raw_file.close()
+
+    @staticmethod
+    def _padded_tar_add(tar, et_info, raw_file):
+        f = StreamPadFileObj(raw_file, et_info.tarinfo.size)
+        tar.addfile(et_info.tarinfo, f)
+
+    @staticmethod
+    def _zero_copy_tar_add(fileobj, et_info, raw_file):
+        """Write a file member, moving its contents in-kernel
+
+        Equivalent to _padded_tar_add, but only the header and padding
+        pass through Python: the file body is sent straight from the
+        member's file descriptor to fileobj.  Returns the number of
+        bytes written.
+        """
+        tarinfo = et_info.tarinfo
+        header = tarinfo.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING,
+                               'strict')
+        fileobj.write(header)
+
+        sent = fileobj.sendfile(raw_file.fileno(), 0, tarinfo.size)
+
+        # Zeroes stand in for whatever was truncated from the file
+        # since its size was recorded, and then the body is padded out
+        # to a whole number of blocks.
+        remainder = tarinfo.size % tarfile.BLOCKSIZE
+        padding = tarinfo.size - sent
+        if remainder > 0:
+            padding += tarfile.BLOCKSIZE - remainder
+
+        if padding:
+            fileobj.write('\0' * padding)
+
+        return len(header) + sent + padding
+
+    def _zero_copy_tarfile_write(self, fileobj, members):
+        """Write a tar stream byte-for-byte the same as tarfile_write
+
+        This is used when fileobj supports sendfile: see
+        _zero_copy_tar_add.
+        """
+        offset = 0
+
+        for et_info, raw_file in members:
+            if et_info.tarinfo.isfile():
+                if raw_file is not None:
+                    offset += self._zero_copy_tar_add(fileobj, et_info,
+                                                      raw_file)
+            else:
+                header = et_info.tarinfo.tobuf(tarfile.DEFAULT_FORMAT,
+                                               tarfile.ENCODING, 'strict')
+                fileobj.write(header)
+                offset += len(header)
+
+        # End of archive marker, and then the same padding out to a
+        # whole record as tarfile does.
+        trailer = tarfile.BLOCKSIZE * 2
+        remainder = (offset + trailer) % tarfile.RECORDSIZE
+        if remainder > 0:
+            trailer += tarfile.RECORDSIZE - remainder
+
+        fileobj.write('\0' * trailer)
+
+    def tarfile_write(self, fileobj, direct_io=False):
+        members = self._opened_members(direct_io)
+
+        # Zero-copy writing is not used with O_DIRECT: sendfile would
+        # read the files through the page cache anyway.
+        if hasattr(fileobj, 'sendfile') and not direct_io:
+            try:
+                self._zero_copy_tarfile_write(fileobj, members)
+            finally:
+                members.close()
+            return
+
         tar = None
         try:
             tar = tarfile.open(fileobj=fileobj, mode='w|')
 
-            for et_info in self:
+            for et_info, raw_file in members:
                 # Treat files specially because they may grow, shrink,
                 # or may be unlinked in the meanwhile.
                 if et_info.tarinfo.isfile():
-                    self._padded_tar_add(tar, et_info)
+                    if raw_file is not None:
+                        self._padded_tar_add(tar, et_info, raw_file)
                 else:
                     tar.addfile(et_info.tarinfo)
         finally:
+            members.close()
+
             if tar is not None:
                 tar.close()
 
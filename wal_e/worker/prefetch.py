@@ -0,0 +1,206 @@
+"""
+Local storage of WAL segments downloaded ahead of wal-fetch
+
+Recovery asks for one WAL segment at a time, so without help it waits
+for a full download and decompression of every segment in turn.
+Instead, wal-fetch starts downloads of the next few segments in the
+background, into a directory next to pg_xlog's files so that they can
+be moved into place with a rename:
+
+    pg_xlog/.wal-e/prefetch/SEGMENT              complete downloads
+    pg_xlog/.wal-e/prefetch/running/SEGMENT.*    downloads in progress
+
+Downloads in progress each have a temporary file of their own, and are
+only renamed to their segment's name once complete, so that a failed
+or abandoned download is never mistaken for a complete one.
+
+"""
+import errno
+import os
+import re
+import tempfile
+import time
+
+from wal_e.storage import s3_storage
+
+# How long a download in progress can go without writing anything
+# before it is considered to have died.
+STALE_SECONDS = 60
+
+
+def _segment_number(name):
+    """The position of a segment, regardless of its timeline, or None"""
+    match = re.match(s3_storage.SEGMENT_REGEXP + '$', name)
+    if match is None:
+        return None
+
+    return s3_storage.SegmentNumber(log=match.group('log'),
+                                    seg=match.group('seg')).as_an_integer
+
+
+def future_segment_names(name):
+    """Yield the names of the WAL segments that follow name
+
+    >>> names = future_segment_names('0000000100000001000000FE')
+    >>> next(names)
+    '0000000100000001000000FF'
+    >>> next(names)
+    '000000010000000200000000'
+
+    Before PostgreSQL 9.3, segments ending in FF are never used, so
+    prefetching them only finds them missing.
+
+    Names that are not of a WAL segment have no successors.
+
+    >>> list(future_segment_names('00000002.history'))
+    []
+    """
+    match = re.match(s3_storage.SEGMENT_REGEXP + '$', name)
+    if match is None:
+        return
+
+    tli = match.group('tli')
+    log = int(match.group('log'), 16)
+    seg = int(match.group('seg'), 16)
+
+    while True:
+        seg += 1
+        if seg > 0xFF:
+            seg = 0
+            log += 1
+
+        yield '{0}{1:08X}{2:08X}'.format(tli, log, seg)
+
+
+class Dirs(object):
+    """The prefetch directories of a pg_xlog directory"""
+
+    def __init__(self, xlog_dir):
+        self.prefetched = os.path.join(xlog_dir, '.wal-e', 'prefetch')
+        self.running = os.path.join(self.prefetched, 'running')
+
+    def create(self):
+        try:
+            os.makedirs(self.running)
+        except EnvironmentError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _running_files(self, name):
+        try:
+            entries = os.listdir(self.running)
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
+        return [os.path.join(self.running, entry) for entry in entries
+                if entry.split('.', 1)[0] == name]
+
+    def contains(self, name):
+        return os.path.isfile(os.path.join(self.prefetched, name))
+
+    def running_size(self, name):
+        """The size downloaded so far of name, or None if not running"""
+        sizes = []
+        for path in self._running_files(name):
+            try:
+                st = os.stat(path)
+            except EnvironmentError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+
+            if time.time() - st.st_mtime < STALE_SECONDS:
+                sizes.append(st.st_size)
+
+        if sizes:
+            return max(sizes)
+
+        return None
+
+    def is_running(self, name):
+        return self.running_size(name) is not None
+
+    def download_path(self, name):
+        """Make a temporary file to download name to"""
+        self.create()
+        fd, path = tempfile.mkstemp(prefix=name + '.', dir=self.running)
+        os.close(fd)
+        return path
+
+    def complete(self, name, download_path):
+        """Make a finished download of name available
+
+        Returns False if the download has been cleared away, as a stale
+        one, in the meantime.
+        """
+        try:
+            os.rename(download_path, os.path.join(self.prefetched, name))
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
+        return True
+
+    def promote(self, name, destination):
+        """Move the complete download of name to destination
+
+        Returns False if there is no such download.
+        """
+        try:
+            os.rename(os.path.join(self.prefetched, name), destination)
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
+        return True
+
+    def clear_before(self, name):
+        """Remove downloads of segments older than name
+
+        Recovery moves forward, so those will not be asked for, and
+        only take up space.  Downloads that have died are removed,
+        too.
+        """
+        horizon = _segment_number(name)
+        assert horizon is not None
+        self._clear(horizon)
+
+    def clear_through(self, name):
+        """Remove downloads of name and of segments older than it
+
+        As clear_before, for once name has been restored otherwise.
+        """
+        horizon = _segment_number(name)
+        assert horizon is not None
+        self._clear(horizon + 1)
+
+    def _clear(self, horizon):
+        now = time.time()
+
+        for directory in (self.prefetched, self.running):
+            try:
+                entries = os.listdir(directory)
+            except EnvironmentError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+
+            for entry in entries:
+                path = os.path.join(directory, entry)
+                number = _segment_number(entry.split('.', 1)[0])
+
+                try:
+                    if os.path.isdir(path):
+                        continue
+                    elif number is None or number < horizon:
+                        os.unlink(path)
+                    elif (directory == self.running and
+                          now - os.stat(path).st_mtime >= STALE_SECONDS):
+                        os.unlink(path)
+                except EnvironmentError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
@@ -5,11 +5,17 @@ These are functions that are amenable to be called from other modules,
 with the intention that they are used in forked worker processes.
 
 """
+import base64
 import boto
+import contextlib
 import functools
 import gevent
+import gevent.pool
+import hashlib
+import itertools
 import json
 import logging
+import os
 import re
 import socket
 import sys
@@ -18,6 +24,7 @@ import tempfile
 import time
 import traceback
 
+from cStringIO import StringIO
 from urlparse import urlparse
 from boto.s3.connection import (S3Connection, SubdomainCallingFormat,
                                 OrdinaryCallingFormat)
@@ -25,17 +32,65 @@ from boto.s3.connection import (S3Connection, SubdomainCallingFormat,
 import wal_e.storage.s3_storage as s3_storage
 import wal_e.log_help as log_help
 
+from wal_e.cache import JsonCache
 from wal_e.exception import UserException
 from wal_e.pipeline import get_upload_pipeline, get_download_pipeline
 from wal_e.piper import PIPE
+from wal_e.worker import wal_bundle
+from wal_e.worker import wal_index
 
 logger = log_help.WalELogger(__name__, level=logging.INFO)
 
 
+# The largest a compressed file to upload can be and still be kept in
+# memory, rather than written to a temporary file.  A 16MiB WAL
+# segment that did not compress at all would still fit.
+WAL_BUFFER_MAX_SZ = 24 * 1024 * 1024
+
+# Segments closed early by pg_switch_xlog or archive_timeout can end
+# in a long run of zeros.  Optionally, only the part before the zeros
+# is compressed and stored, along with the size of the whole segment
+# as metadata, and the zeros are restored with ftruncate().  Shorter
+# runs of zeros are not worth the trouble.
+ZERO_TAIL_MIN_SZ = 1024 * 1024
+SEGMENT_SIZE_METADATA = 'wale-segment-size'
+
+ZERO_SCAN_CHUNK_SZ = 1024 * 1024
+_ZEROS = '\0' * ZERO_SCAN_CHUNK_SZ
+
+# The MD5 of a WAL file, as it was before compression, is kept as
+# metadata, so that a WAL file pushed again can be recognized as
+# archived already.
+SEGMENT_MD5_METADATA = 'wale-segment-md5'
+
+# Backup details are fetched this many at a time, and each fetch is
+# attempted this many times, for up to this many seconds each, before
+# the details are reported as 'timeout'.
+DETAIL_POOL_SIZE = 16
+DETAIL_ATTEMPTS = 3
+DETAIL_TIMEOUT_SECONDS = 30
+
+# Keys are deleted in batches of up to this many, the most one S3
+# Multi-Object Delete request takes, with up to this many requests at
+# once.
+DELETE_BATCH_SIZE = 1000
+DELETE_POOL_SIZE = 8
+
 generic_weird_key_hint_message = ('This means an unexpected key was found in '
                                   'a WAL-E prefix.  It can be harmless, or '
                                   'the result a bug or misconfiguration.')
 
+# The patterns of the keys "delete before" classifies, compiled once
+# rather than for every key.
+_TIMELINE_RE = re.compile(r'[0-9A-F]{8}$')
+_COMPLETE_BASE_BACKUP_RE = re.compile(s3_storage.COMPLETE_BASE_BACKUP_REGEXP)
+_LISTED_BASE_BACKUP_RE = re.compile(s3_storage.LISTED_BASE_BACKUP_REGEXP + '$')
+_BASE_BACKUP_RE = re.compile(s3_storage.BASE_BACKUP_REGEXP)
+_WAL_SEGMENT_RE = re.compile(s3_storage.SEGMENT_REGEXP + r'\.lzo')
+_BACKUP_LABEL_RE = re.compile(s3_storage.SEGMENT_REGEXP +
+                              r'\.[A-F0-9]{8,8}.backup.lzo')
+_HISTORY_RE = re.compile(r'[A-F0-9]{8,8}\.history')
+
 # Set a timeout for boto HTTP operations should no timeout be set.
 # Yes, in the case the user *wanted* no timeouts, this would set one.
 # If that becomes a problem, someone should post a bug, although I am
@@ -162,12 +217,29 @@ except ImportError:
     pass
 
 
+# Bucket endpoints are remembered between invocations of WAL-E, as
+# looking one up takes two requests.  Should a bucket move, requests
+# to the remembered endpoint fail in a way forget_s3_endpoint is
+# called on, or the entry expires.
+_endpoint_cache = JsonCache('s3-endpoints', ttl=24 * 60 * 60)
+
+# S3 error codes that mean a request went to the wrong endpoint.
+_WRONG_ENDPOINT_ERROR_CODES = frozenset([
+    'PermanentRedirect', 'TemporaryRedirect',
+    'AuthorizationHeaderMalformed', 'IllegalLocationConstraintException'])
+
+
 def s3_endpoint_for_uri(s3_uri, c_args=None, c_kwargs=None, connection=None):
     # 'connection' argument is used for unit test dependency injection
     # Work around boto/443 (https://github.com/boto/boto/issues/443)
     bucket_name = urlparse(s3_uri).netloc
     default = 's3.amazonaws.com'
 
+    if bucket_name not in s3_endpoint_for_uri.cache:
+        remembered = _endpoint_cache.get(bucket_name)
+        if remembered is not None:
+            s3_endpoint_for_uri.cache[bucket_name] = remembered
+
     if bucket_name not in s3_endpoint_for_uri.cache:
         c_args = c_args or ()
         c_kwargs = c_kwargs or {}
@@ -197,11 +269,43 @@ def s3_endpoint_for_uri(s3_uri, c_args=None, c_kwargs=None, connection=None):
             conn = connection or S3Connection(*c_args, **c_kwargs)
             s3_endpoint_for_uri.cache[bucket_name] = _S3_REGIONS.get(
                 conn.get_bucket(bucket_name).get_location(), default)
+            _endpoint_cache.put(bucket_name,
+                                s3_endpoint_for_uri.cache[bucket_name])
 
     return s3_endpoint_for_uri.cache[bucket_name]
 s3_endpoint_for_uri.cache = {}
 
 
+def forget_s3_endpoint(s3_uri):
+    """Have the endpoint of the bucket of s3_uri looked up anew"""
+    from boto.storage_uri import StorageUri
+
+    bucket_name = urlparse(s3_uri).netloc
+    s3_endpoint_for_uri.cache.pop(bucket_name, None)
+    _endpoint_cache.discard(bucket_name)
+
+    # boto shares one connection among all s3:// URIs, whatever
+    # endpoint they were created with.
+    StorageUri.provider_pool.pop('s3', None)
+
+
+def is_wrong_endpoint_error(e):
+    return (isinstance(e, boto.exception.S3ResponseError) and
+            (e.status in (301, 307) or
+             e.error_code in _WRONG_ENDPOINT_ERROR_CODES))
+
+
+@contextlib.contextmanager
+def forgetting_wrong_endpoint(s3_uri):
+    """Forget the endpoint of s3_uri's bucket if it turns out wrong"""
+    try:
+        yield
+    except boto.exception.S3ResponseError, e:
+        if is_wrong_endpoint_error(e):
+            forget_s3_endpoint(s3_uri)
+        raise
+
+
 def s3_uri_wrap(s3_uri):
     """
     Thin wrapper around boto.storage_uri to work around boto warts.
@@ -217,7 +321,8 @@ def s3_uri_wrap(s3_uri):
     return suri
 
 
-def uri_put_file(s3_uri, fp, content_encoding=None):
+def uri_put_file(s3_uri, fp, content_encoding=None, md5=None,
+                 metadata=None):
     # Per Boto 2.2.2, which will only read from the current file
     # position to the end.  This manifests as successfully uploaded
     # *empty* keys in S3 instead of the intended data because of how
@@ -234,7 +339,14 @@ def uri_put_file(s3_uri, fp, content_encoding=None):
     if content_encoding is not None:
         k.content_type = content_encoding
 
-    k.set_contents_from_file(fp)
+    for name, value in (metadata or {}).iteritems():
+        k.set_metadata(name, value)
+
+    # Without an MD5, boto reads all of fp an extra time to compute
+    # one.
+    with forgetting_wrong_endpoint(s3_uri):
+        k.set_contents_from_file(fp, md5=md5)
+
     return k
 
 
@@ -246,10 +358,12 @@ def format_kib_per_second(start, finish, amount_in_bytes):
 
 
 class PartitionUploader(object):
-    def __init__(self, backup_s3_prefix, rate_limit, gpg_key):
+    def __init__(self, backup_s3_prefix, rate_limit, gpg_key,
+                 direct_io=False):
         self.backup_s3_prefix = backup_s3_prefix
         self.rate_limit = rate_limit
         self.gpg_key = gpg_key
+        self.direct_io = direct_io
 
     def __call__(self, tpart):
         """
@@ -265,7 +379,7 @@ class PartitionUploader(object):
                                            rate_limit=self.rate_limit,
                                            gpg_key=self.gpg_key)
 
-            tpart.tarfile_write(pipeline.stdin)
+            tpart.tarfile_write(pipeline.stdin, direct_io=self.direct_io)
             pipeline.stdin.flush()
             pipeline.stdin.close()
             pipeline.finish()
@@ -334,7 +448,135 @@ class PartitionUploader(object):
         return tpart
 
 
-def do_lzop_s3_put(s3_url, local_path, gpg_key):
+def trimmed_size(local_path):
+    """
+    Find how much of a file is left without the zeros it ends in
+
+    Returns that and the size of the whole file, or None if the zeros
+    are too few to be worth trimming.  The file is scanned from its
+    end, a chunk at a time, and each chunk compared with zeros as a
+    whole, so a segment that is mostly zeros is dealt with quickly.
+
+    """
+    with open(local_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        end = size
+
+        while end > 0:
+            n = min(end, ZERO_SCAN_CHUNK_SZ)
+            f.seek(end - n)
+            chunk = f.read(n)
+
+            if chunk != _ZEROS[:n]:
+                end = end - n + len(chunk.rstrip('\0'))
+                break
+
+            end -= n
+
+    if size - end < ZERO_TAIL_MIN_SZ:
+        return None
+
+    return end, size
+
+
+def file_md5(local_path):
+    """The MD5 of the contents of a file, in hexadecimal"""
+    md5 = hashlib.md5()
+
+    with open(local_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(ZERO_SCAN_CHUNK_SZ), ''):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+
+def _copy_and_close(f, stream, length):
+    try:
+        while length > 0:
+            chunk = f.read(min(length, ZERO_SCAN_CHUNK_SZ))
+            if not chunk:
+                raise UserException(
+                    msg='WAL file shrank while being compressed',
+                    detail=('"{0}" ended {1} bytes before the zeros it '
+                            'was found to end in.'.format(f.name, length)))
+            stream.write(chunk)
+            length -= len(chunk)
+    finally:
+        stream.close()
+
+
+def lzop_compress(local_path, fp, gpg_key, length=None):
+    """
+    Compress, and optionally encrypt, a given local path into fp
+
+    fp need not be a real file, as the output is copied into it, and
+    hashed along the way.  Returns the MD5 of the output as a pair of
+    its hexadecimal and base64 encodings, as boto expects.
+
+    With length, only that much of the start of the file is
+    compressed.
+
+    """
+    md5 = hashlib.md5()
+
+    with open(local_path, 'r') as f:
+        if length is None:
+            pipeline = get_upload_pipeline(f, PIPE, gpg_key=gpg_key)
+            feeder = None
+        else:
+            pipeline = get_upload_pipeline(PIPE, PIPE, gpg_key=gpg_key)
+            feeder = gevent.spawn(_copy_and_close, f, pipeline.stdin, length)
+
+        stdout = pipeline.stdout
+        buf = bytearray(stdout.chunk_size)
+
+        while True:
+            n = stdout.readinto(buf)
+            chunk = buffer(buf, 0, n)
+            md5.update(chunk)
+            fp.write(chunk)
+
+            if n < len(buf):
+                break
+
+        if feeder is not None:
+            feeder.get()
+
+        pipeline.finish()
+
+    fp.flush()
+    return md5.hexdigest(), base64.b64encode(md5.digest())
+
+
+def s3_put_compressed(s3_url, fp, md5=None, segment_size=None,
+                      segment_md5=None):
+    """
+    Upload the contents of fp, as produced by lzop_compress
+
+    segment_size is the size of the whole WAL segment, if only the
+    part of it before its zeros was compressed, and segment_md5 its
+    MD5 before compression, if known.  Returns the rate of the upload,
+    in KiB/s.
+
+    """
+    assert s3_url.endswith('.lzo')
+
+    metadata = {}
+    if segment_size is not None:
+        metadata[SEGMENT_SIZE_METADATA] = str(segment_size)
+    if segment_md5 is not None:
+        metadata[SEGMENT_MD5_METADATA] = segment_md5
+
+    clock_start = time.clock()
+    fp.seek(0)
+    k = uri_put_file(s3_url, fp, md5=md5, metadata=metadata)
+    clock_finish = time.clock()
+
+    return format_kib_per_second(clock_start, clock_finish, k.size)
+
+
+def do_lzop_s3_put(s3_url, local_path, gpg_key, trim_zero_tail=False,
+                   segment_md5=None):
     """
     Compress and upload a given local path.
 
@@ -344,27 +586,51 @@ def do_lzop_s3_put(s3_url, local_path, gpg_key):
     :type local_path: string
     :param local_path: a path to a file to be compressed
 
+    :type trim_zero_tail: bool
+    :param trim_zero_tail: whether to leave out zeros the file ends in
+
+    :type segment_md5: string
+    :param segment_md5: the MD5 of the file, to record along with it
+
     """
 
     assert not s3_url.endswith('.lzo')
     s3_url += '.lzo'
 
-    with tempfile.NamedTemporaryFile(mode='rwb') as tf:
-        pipeline = get_upload_pipeline(
-            open(local_path, 'r'), tf, gpg_key=gpg_key)
-        pipeline.finish()
+    length = segment_size = None
+    if trim_zero_tail:
+        length, segment_size = trimmed_size(local_path) or (None, None)
 
-        tf.flush()
+    # WAL files compress to well under WAL_BUFFER_MAX_SZ, so are
+    # kept in memory, off the disk and away from its fsync()s.
+    with tempfile.SpooledTemporaryFile(max_size=WAL_BUFFER_MAX_SZ,
+                                       mode='w+b') as tf:
+        md5 = lzop_compress(local_path, tf, gpg_key, length=length)
+        return s3_put_compressed(s3_url, tf, md5=md5,
+                                 segment_size=segment_size,
+                                 segment_md5=segment_md5)
 
-        clock_start = time.clock()
-        tf.seek(0)
-        k = uri_put_file(s3_url, tf)
-        clock_finish = time.clock()
 
-        kib_per_second = format_kib_per_second(clock_start, clock_finish,
-                                               k.size)
+@retry()
+def s3_archived_md5(s3_url):
+    """
+    Find the MD5 recorded of the WAL file archived at s3_url
+
+    Returns the MD5, an empty string if the file was archived without
+    one, as by older versions of WAL-E or without skipping files
+    archived already, or None if nothing is archived at s3_url.  Costs
+    one HEAD request.
+
+    """
+    bucket = s3_uri_wrap(s3_url).get_bucket()
 
-        return kib_per_second
+    with forgetting_wrong_endpoint(s3_url):
+        key = bucket.get_key(urlparse(s3_url).path.lstrip('/'))
+
+    if key is None:
+        return None
+
+    return key.get_metadata(SEGMENT_MD5_METADATA) or ''
 
 
 def write_and_close_thread(key, stream):
@@ -375,15 +641,27 @@ def write_and_close_thread(key, stream):
         stream.close()
 
 
-def do_lzop_s3_get(s3_url, path, decrypt):
+def do_lzop_s3_get(s3_url, path, decrypt, byte_range=None,
+                   segment_size=None):
     """
     Get and decompress a S3 URL
 
     This streams the content directly to lzop; the compressed version
     is never stored on disk.
 
+    With byte_range, a pair of the first and last byte, only that part
+    of the object is fetched, as of a WAL segment in a bundle, and
+    segment_size is the size to extend it to with zeros, if any.
+    Otherwise, that size is found in the object's metadata.
+
     """
-    assert s3_url.endswith('.lzo'), 'Expect an lzop-compressed file'
+    assert s3_url.endswith('.lzo') or byte_range is not None, (
+        'Expect an lzop-compressed file')
+
+    if byte_range is None:
+        headers = None
+    else:
+        headers = {'Range': 'bytes={0}-{1}'.format(*byte_range)}
 
     def log_wal_fetch_failures_on_error(exc_tup, exc_processor_cxt):
         def standard_detail_message(prefix=''):
@@ -422,14 +700,30 @@ def do_lzop_s3_get(s3_url, path, decrypt):
         # Help Python GC by resolving possible cycles
         del tb
 
+    # The bucket, and with it the connection to S3, is kept between
+    # attempts, unless its endpoint turns out to be wrong.
+    buckets = []
+
     @retry(retry_with_count(log_wal_fetch_failures_on_error))
     def download():
         with open(path, 'wb') as decomp_out:
-            suri = s3_uri_wrap(s3_url)
-            bucket = suri.get_bucket()
-            key = bucket.get_key(suri.object_name)
+            if not buckets:
+                buckets.append(s3_uri_wrap(s3_url).get_bucket())
+
+            # GET the object straight away, rather than first checking
+            # for it with a HEAD: S3 answers a GET of a missing object
+            # with a 404 just the same.
+            key = buckets[0].new_key(urlparse(s3_url).path.lstrip('/'))
+            try:
+                with forgetting_wrong_endpoint(s3_url):
+                    key.open_read(headers=headers)
+            except boto.exception.S3ResponseError, e:
+                if is_wrong_endpoint_error(e):
+                    del buckets[:]
+
+                if e.status != 404:
+                    raise
 
-            if key is None:
                 logger.info(
                     msg='could not locate object while performing wal restore',
                     detail=('The absolute URI that could not be located '
@@ -439,7 +733,13 @@ def do_lzop_s3_get(s3_url, path, decrypt):
                           'restoration.'))
                 return False
 
-            pipeline = get_download_pipeline(PIPE, decomp_out, decrypt)
+            try:
+                pipeline = get_download_pipeline(PIPE, decomp_out, decrypt)
+            except:
+                # Don't leave the response unread on the connection.
+                key.close(fast=True)
+                raise
+
             g = gevent.spawn(write_and_close_thread, key, pipeline.stdin)
 
             # Raise any exceptions from _write_and_close
@@ -447,6 +747,17 @@ def do_lzop_s3_get(s3_url, path, decrypt):
 
             pipeline.finish()
 
+            # Restore the zeros left out of the segment when uploaded.
+            if byte_range is None:
+                size = key.get_metadata(SEGMENT_SIZE_METADATA)
+            else:
+                size = segment_size
+
+            if size is not None:
+                fd = decomp_out.fileno()
+                if os.fstat(fd).st_size < int(size):
+                    os.ftruncate(fd, int(size))
+
             logger.info(
                 msg='completed download and decompression',
                 detail='Downloaded and decompressed "{s3_url}" to "{path}"'
@@ -456,6 +767,153 @@ def do_lzop_s3_get(s3_url, path, decrypt):
     return download()
 
 
+def s3_put_wal_bundle(s3_url, segments):
+    """
+    Upload a bundle of compressed WAL segments
+
+    segments is a list of the names of the segments, files of their
+    compressed contents, as produced by lzop_compress, and their sizes
+    and MD5s as for s3_put_compressed.  Returns the rate of the
+    upload, in KiB/s.
+
+    """
+    header = wal_bundle.header(
+        [(name, os.fstat(f.fileno()).st_size, segment_size, segment_md5)
+         for name, f, segment_size, segment_md5 in segments])
+    md5 = hashlib.md5(header)
+
+    with tempfile.SpooledTemporaryFile(max_size=WAL_BUFFER_MAX_SZ,
+                                       mode='w+b') as tf:
+        tf.write(header)
+        for name, f, segment_size, segment_md5 in segments:
+            for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                md5.update(chunk)
+                tf.write(chunk)
+
+        clock_start = time.clock()
+        tf.seek(0)
+        k = uri_put_file(s3_url, tf,
+                         md5=(md5.hexdigest(),
+                              base64.b64encode(md5.digest())))
+        clock_finish = time.clock()
+
+    return format_kib_per_second(clock_start, clock_finish, k.size)
+
+
+def s3_put_wal_index_deltas(wal_url, names):
+    """
+    Add the WAL segments in names to the WAL index
+
+    wal_url is the URL of the WAL directory.  A delta is added for
+    each run of consecutive segments, for "wal-e wal-index" to merge.
+
+    """
+    for run in wal_bundle.consecutive_runs(sorted(names)):
+        uri_put_file('{0}/{1}{2}'.format(
+            wal_url.rstrip('/'), wal_index.DELTA_DIRECTORY,
+            wal_index.delta_name(run[0], run[-1])), StringIO(''))
+
+
+def s3_put_listed_sentinel(layout, backup_info):
+    """
+    Add the empty sentinel that details a backup by its name alone
+
+    """
+    uri_put_file('s3://{0}/{1}'.format(
+        layout.bucket_name(), layout.basebackup_listed_sentinel(backup_info)),
+        StringIO(''))
+
+
+# Whether an archive holds any bundles is remembered between
+# invocations, so that a WAL segment that is missing costs a listing
+# of its bundles only in archives that have some.  That an archive has
+# none is forgotten sooner, as wal-push may start bundling at any time.
+_bundles_cache = JsonCache('wal-bundles', ttl=24 * 60 * 60)
+NO_BUNDLES_TTL = 10 * 60
+
+
+@retry()
+def _any_wal_bundle(wal_url):
+    bundles = s3_uri_wrap(wal_url.rstrip('/') + '/bundles/')
+
+    with forgetting_wrong_endpoint(wal_url):
+        keys = bundles.get_bucket().get_all_keys(
+            prefix=bundles.object_name, max_keys=1)
+
+    return bool(keys)
+
+
+def wal_bundles_used(wal_url):
+    """Whether the WAL directory at wal_url holds any bundles"""
+    used = _bundles_cache.get(wal_url)
+
+    if used is None:
+        used = _any_wal_bundle(wal_url)
+        _bundles_cache.put(wal_url, used,
+                           ttl=None if used else NO_BUNDLES_TTL)
+
+    return used
+
+
+def find_in_wal_bundle(wal_url, name):
+    """
+    Find the bundle, if any, holding the WAL segment name
+
+    wal_url is the URL of the WAL directory the bundles are kept in.
+    Returns the URL of the bundle, the first and last byte of the
+    segment in it, the segment's size as for do_lzop_s3_get and its
+    MD5 as recorded by s3_put_wal_bundle, or None.
+
+    """
+    found = _wal_bundle_header(wal_url, name)
+    if found is None:
+        return None
+
+    # The header is parsed outside of the retries, as a bundle that
+    # cannot be read will not get any better by being read again.
+    bundle_url, header = found
+    try:
+        byte_range = wal_bundle.segment_range(header, name)
+        segment_size = wal_bundle.segment_size(header, name)
+        segment_md5 = wal_bundle.segment_md5(header, name)
+    except (ValueError, KeyError, IndexError, TypeError), e:
+        raise UserException(
+            msg='could not read the header of a WAL bundle',
+            detail='The header of "{0}" is corrupt: {1}'.format(
+                bundle_url, e))
+
+    if byte_range is None:
+        return None
+
+    return bundle_url, byte_range, segment_size, segment_md5
+
+
+@retry()
+def _wal_bundle_header(wal_url, name):
+    """The URL and header of the only bundle that may hold name, or None"""
+    bundles = s3_uri_wrap(wal_url.rstrip('/') + '/bundles/')
+    prefix = bundles.object_name
+
+    # Bundles are named after their last segment, so the first one
+    # listed after name is the only one that can hold it.
+    with forgetting_wrong_endpoint(wal_url):
+        keys = bundles.get_bucket().get_all_keys(
+            prefix=prefix, marker=prefix + name, max_keys=1)
+
+    if not keys:
+        return None
+
+    key = keys[0]
+    bounds = wal_bundle.parse_bundle_name(key.name[len(prefix):])
+    if bounds is None or not bounds[0] <= name <= bounds[1]:
+        return None
+
+    header = key.get_contents_as_string(
+        headers={'Range': 'bytes=0-{0}'.format(wal_bundle.HEADER_SZ - 1)})
+
+    return 's3://{0}/{1}'.format(key.bucket.name, key.name), header
+
+
 class TarPartitionLister(object):
     def __init__(self, s3_conn, layout, backup_info):
         self.s3_conn = s3_conn
@@ -520,11 +978,24 @@ class BackupFetcher(object):
         pipeline.finish()
 
 
+def _backup_name(match):
+    """The name of a backup, from a match of its sentinel's name"""
+    return 'base_{filename}_{offset}'.format(**match.groupdict())
+
+
 class BackupList(object):
-    def __init__(self, s3_conn, layout, detail):
+    """Lists the base backups in a storage layout
+
+    Sentinels never change once written, so with a cache, their
+    contents are kept there, and only fetched for backups that are
+    new, or have been rewritten since, as told by their ETags.
+    """
+
+    def __init__(self, s3_conn, layout, detail, cache=None):
         self.s3_conn = s3_conn
         self.layout = layout
         self.detail = detail
+        self.cache = cache
 
     def find_all(self, query):
         """
@@ -540,22 +1011,27 @@ class BackupList(object):
         """
 
         match = re.match(s3_storage.BASE_BACKUP_REGEXP, query)
+        bucket = self.s3_conn.get_bucket(self.layout.bucket_name())
 
         if match is not None:
-            for backup in iter(self):
-                if backup.name == query:
-                    yield backup
+            for key, match in self._sentinels(bucket):
+                if _backup_name(match) == query:
+                    yield self._backup_info((key, match),
+                                            self._listed_details(bucket))
         elif query == 'LATEST':
-            all_backups = list(iter(self))
-
-            if not all_backups:
+            # Find the latest backup by its name alone, so that only
+            # its details need fetching.
+            latest = None
+            for key, match in self._sentinels(bucket):
+                if latest is None or (_backup_name(match) >
+                                      _backup_name(latest[1])):
+                    latest = key, match
+
+            if latest is None:
                 yield None
                 return
 
-            assert len(all_backups) > 0
-
-            all_backups.sort()
-            yield all_backups[-1]
+            yield self._backup_info(latest, self._listed_details(bucket))
         else:
             raise UserException(
                 msg='invalid backup query submitted',
@@ -565,60 +1041,245 @@ class BackupList(object):
     def _backup_detail(self, key):
         return key.get_contents_as_string()
 
+    def _fetch_backup_detail(self, key):
+        """Fetch the details of a backup, trying a few times
+
+        Only timeouts are retried, and once all attempts have timed
+        out, this raises gevent.Timeout.
+        """
+        url = 's3://{bucket}/{name}'.format(bucket=key.bucket.name,
+                                            name=key.name)
+        if self.cache is not None:
+            cached = self.cache.get(url, key.etag)
+            if cached is not None:
+                return json.loads(cached)
+
+        for attempt in xrange(DETAIL_ATTEMPTS):
+            try:
+                with gevent.Timeout(DETAIL_TIMEOUT_SECONDS):
+                    # This costs one web request
+                    contents = self._backup_detail(key)
+
+                if self.cache is not None:
+                    self.cache.put(url, key.etag, contents)
+
+                return json.loads(contents)
+            except (gevent.Timeout, socket.timeout):
+                logger.info(
+                    msg='timed out fetching the details of a backup',
+                    detail=('The key is "{0}", and there have been {1} '
+                            'attempts so far.'.format(key.name,
+                                                      attempt + 1)))
+
+        raise gevent.Timeout()
+
+    def _sentinels(self, bucket):
+        """Yield the sentinel keys of the backups, and their name matches"""
+        # Sentinels sit next to the directories of the backups, so
+        # listing with a delimiter finds them without listing each
+        # backup's volumes: the directories come back as one prefix
+        # each, which are skipped.
+        matcher = re.compile(
+            s3_storage.COMPLETE_BASE_BACKUP_REGEXP + '$').match
+
+        for key in bucket.list(prefix=self.layout.basebackups(),
+                               delimiter='/'):
+            if key.name.endswith('/'):
+                continue
+
+            backup_sentinel_name = key.name.rsplit('/', 1)[-1]
+            match = matcher(backup_sentinel_name)
+            if match:
+                yield key, match
+
+    def _listed_details(self, bucket):
+        """Map the names of backups to the details in their listing
+
+        Only backups pushed by versions of WAL-E that write
+        listing-only sentinels are listed.  Without detail, nothing
+        needs listing.
+        """
+        if not self.detail:
+            return {}
+
+        prefix = self.layout.basebackup_listed_sentinels()
+        matcher = re.compile(s3_storage.LISTED_BASE_BACKUP_REGEXP + '$').match
+
+        details = {}
+        for key in bucket.list(prefix=prefix):
+            match = matcher(key.name[len(prefix):])
+            if match is not None:
+                details[_backup_name(match)] = {
+                    'wal_segment_backup_stop':
+                    match.group('wal_segment_backup_stop'),
+                    'wal_segment_offset_backup_stop':
+                    match.group('wal_segment_offset_backup_stop'),
+                    'expanded_size_bytes':
+                    int(match.group('expanded_size_bytes'))}
+
+        return details
+
+    def _backup_info(self, sentinel, listed):
+        key, match = sentinel
+
+        # The beginning wal segment information is in the name of the
+        # sentinel, whereas the ending information is in the sentinel
+        # itself, and in the name of the listing-only sentinel, if
+        # any, so that S3 listing gets all commonly useful information
+        # without doing a request-per.
+        groups = match.groupdict()
+
+        detail_dict = {'wal_segment_backup_stop': None,
+                       'wal_segment_offset_backup_stop': None,
+                       'expanded_size_bytes': None}
+        if self.detail and _backup_name(match) in listed:
+            detail_dict.update(listed[_backup_name(match)])
+        elif self.detail:
+            try:
+                detail_dict.update(self._fetch_backup_detail(key))
+            except gevent.Timeout:
+                # NB: do *not* overwite "key" in this scope, which is
+                # being used to mean a "s3 key", as this will cause
+                # later code to blow up.
+                for k in detail_dict:
+                    detail_dict[k] = 'timeout'
+
+        return s3_storage.BackupInfo(
+            name=_backup_name(match),
+            last_modified=key.last_modified,
+            wal_segment_backup_start=groups['filename'],
+            wal_segment_offset_backup_start=groups['offset'],
+            **detail_dict)
+
+    def unlisted(self):
+        """Yield the backups that have no listing-only sentinel"""
+        assert self.detail
+
+        bucket = self.s3_conn.get_bucket(self.layout.bucket_name())
+        listed = self._listed_details(bucket)
+        sentinels = (sentinel for sentinel in self._sentinels(bucket)
+                     if _backup_name(sentinel[1]) not in listed)
+
+        pool = gevent.pool.Pool(DETAIL_POOL_SIZE)
+        return pool.imap(functools.partial(self._backup_info, listed=listed),
+                         sentinels)
+
     def __iter__(self):
         bucket = self.s3_conn.get_bucket(self.layout.bucket_name())
+        backup_info = functools.partial(self._backup_info,
+                                        listed=self._listed_details(bucket))
+        sentinels = self._sentinels(bucket)
 
-        # Try to identify the sentinel file.  This is sort of a drag, the
-        # storage format should be changed to put them in their own leaf
-        # directory.
-        #
-        # TODO: change storage format
-        sentinel_depth = self.layout.basebackups().count('/')
-        matcher = re.compile(s3_storage.COMPLETE_BASE_BACKUP_REGEXP).match
+        if not self.detail:
+            return itertools.imap(backup_info, sentinels)
+
+        # Details of backups pushed by older versions of WAL-E cost a
+        # request per backup, so fetch several at once, while still
+        # yielding backups in the order they are listed.
+        pool = gevent.pool.Pool(DETAIL_POOL_SIZE)
+        return pool.imap(backup_info, sentinels)
 
-        for key in bucket.list(prefix=self.layout.basebackups()):
-            # Use key depth vs. base and regexp matching to find
-            # sentinel files.
-            key_depth = key.name.count('/')
-
-            if key_depth == sentinel_depth:
-                backup_sentinel_name = key.name.rsplit('/', 1)[-1]
-                match = matcher(backup_sentinel_name)
-                if match:
-                    # TODO: It's necessary to use the name of the file to
-                    # get the beginning wal segment information, whereas
-                    # the ending information is encoded into the file
-                    # itself.  Perhaps later on it should all be encoded
-                    # into the name when the sentinel files are broken out
-                    # into their own directory, so that S3 listing gets
-                    # all commonly useful information without doing a
-                    # request-per.
-                    groups = match.groupdict()
-
-                    detail_dict = {'wal_segment_backup_stop': None,
-                                   'wal_segment_offset_backup_stop': None,
-                                   'expanded_size_bytes': None}
-                    if self.detail:
-                        try:
-                            # This costs one web request
-                            detail_dict.update(
-                                json.loads(self._backup_detail(key)))
-                        except gevent.Timeout:
-                            # NB: do *not* overwite "key" in this
-                            # scope, which is being used to mean a "s3
-                            # key", as this will cause later code to
-                            # blow up.
-                            for k in detail_dict:
-                                detail_dict[k] = 'timeout'
-
-                    info = s3_storage.BackupInfo(
-                        name='base_{filename}_{offset}'.format(**groups),
-                        last_modified=key.last_modified,
-                        wal_segment_backup_start=groups['filename'],
-                        wal_segment_offset_backup_start=groups['offset'],
-                        **detail_dict)
-
-                    yield info
+
+class WalIndexContext(object):
+    """Merges the deltas of a WAL index into its index objects
+
+    Merges must not run concurrently, as one could undo another.
+    """
+
+    def __init__(self, s3_conn, layout):
+        self.s3_conn = s3_conn
+        self.layout = layout
+
+    def _archived_runs(self, bucket):
+        """Yield the runs of segments in a listing of the WAL directory"""
+        wal_prefix = self.layout.wal_directory()
+        bundle_prefix = wal_prefix + 'bundles/'
+
+        for key in bucket.list(prefix=wal_prefix):
+            if key.name.startswith(bundle_prefix):
+                bounds = wal_bundle.parse_bundle_name(
+                    key.name[len(bundle_prefix):])
+                if bounds is not None:
+                    yield bounds
+            else:
+                match = re.match(s3_storage.SEGMENT_REGEXP + r'\.lzo$',
+                                 key.name[len(wal_prefix):])
+                if match is not None:
+                    yield match.group('filename'), match.group('filename')
+
+    def merge(self, rebuild=False):
+        """
+        Fold the deltas into the index objects
+
+        With rebuild, the index objects are instead made afresh from a
+        listing of the whole WAL directory, as is needed once to start
+        indexing an archive that holds WAL already.  Returns a dict of
+        timelines to their runs of segments, as pairs of the first
+        and last segment names.
+
+        """
+        bucket = self.s3_conn.get_bucket(self.layout.bucket_name())
+        index_prefix = self.layout.wal_directory() + wal_index.INDEX_DIRECTORY
+        delta_prefix = self.layout.wal_directory() + wal_index.DELTA_DIRECTORY
+
+        index_keys = {}
+        indexes = {}
+        deltas = []
+
+        # Deltas are listed before anything else is read, so that any
+        # added afterwards are left for the next merge.
+        for key in bucket.list(prefix=index_prefix):
+            url = 's3://{bucket}/{name}'.format(bucket=key.bucket.name,
+                                                name=key.name)
+            if key.name.startswith(delta_prefix):
+                bounds = wal_index.parse_delta_name(
+                    key.name[len(delta_prefix):])
+            else:
+                bounds = wal_index.parse_index_name(
+                    key.name[len(index_prefix):])
+
+            if bounds is None:
+                logger.warning(
+                    msg='skipping non-qualifying key in the WAL index',
+                    detail='The unexpected key is "{0}".'.format(url),
+                    hint=generic_weird_key_hint_message)
+            elif key.name.startswith(delta_prefix):
+                deltas.append((key, bounds))
+            else:
+                index_keys[bounds] = key
+                if not rebuild:
+                    indexes[bounds] = wal_index.loads(
+                        key.get_contents_as_string())
+
+        merged = dict((tli, [list(run) for run in runs])
+                      for tli, runs in indexes.iteritems())
+
+        added = [delta_bounds for key, delta_bounds in deltas]
+        if rebuild:
+            added.extend(self._archived_runs(bucket))
+
+        for first, last in added:
+            tli = first[:8]
+            merged[tli] = wal_index.add(merged.get(tli, []),
+                                        wal_index.position(first),
+                                        wal_index.position(last))
+
+        for tli, runs in merged.iteritems():
+            if runs != indexes.get(tli):
+                key = bucket.new_key(index_prefix + wal_index.index_name(tli))
+                key.set_contents_from_string(wal_index.dumps(tli, runs))
+
+        for tli, key in index_keys.iteritems():
+            if tli not in merged:
+                key.delete()
+
+        for key, delta_bounds in deltas:
+            key.delete()
+
+        return dict((tli, [(wal_index.segment_name(tli, first),
+                            wal_index.segment_name(tli, last))
+                           for first, last in runs])
+                    for tli, runs in merged.iteritems())
 
 
 class DeleteFromContext(object):
@@ -629,7 +1290,51 @@ class DeleteFromContext(object):
 
         assert self.dry_run in (True, False)
 
+        self._batch = []
+        self._pool = gevent.pool.Pool(DELETE_POOL_SIZE)
+        self._failed = []
+
     @retry()
+    def _send_delete_keys(self, bucket, keys):
+        return bucket.delete_keys([key.name for key in keys],
+                                  quiet=True).errors
+
+    def _delete_batch(self, bucket, keys):
+        # Only the errors of the last attempt count, so they are
+        # recorded once the retried request has returned.
+        for error in self._send_delete_keys(bucket, keys):
+            url = 's3://{bucket}/{name}'.format(bucket=bucket.name,
+                                                name=error.key)
+            logger.warning(
+                msg='could not delete a key',
+                detail=('Deleting {url} failed with {code}: {message}'
+                        .format(url=url, code=error.code,
+                                message=error.message)))
+            self._failed.append(url)
+
+    def _send_batch(self):
+        if self._batch:
+            # Blocks while DELETE_POOL_SIZE batches are being sent.
+            self._pool.spawn(self._delete_batch, self._batch[0].bucket,
+                             self._batch)
+            self._batch = []
+
+    def _finish_deleting(self):
+        """Wait for all the keys passed over so far to be deleted
+
+        Deletion is idempotent, so the keys that could not be deleted
+        can be deleted by running the same deletion again.
+        """
+        self._send_batch()
+        self._pool.join(raise_error=True)
+
+        if self._failed:
+            failed, self._failed = self._failed, []
+            raise UserException(
+                msg='could not delete some keys',
+                detail='{0} keys could not be deleted.'.format(len(failed)),
+                hint='Run the same deletion again to retry them.')
+
     def _maybe_delete_key(self, key, type_of_thing):
         url = 's3://{bucket}/{name}'.format(bucket=key.bucket.name,
                                             name=key.name)
@@ -639,7 +1344,36 @@ class DeleteFromContext(object):
 
         if self.dry_run is False:
             logger.info(**log_message)
-            key.delete()
+            self._batch.append(key)
+            if len(self._batch) >= DELETE_BATCH_SIZE:
+                self._send_batch()
+        elif self.dry_run is True:
+            log_message['hint'] = ('This is only a dry run -- no actual data '
+                                   'is being deleted')
+            logger.info(**log_message)
+        else:
+            assert False
+
+    @retry()
+    def _maybe_trim_index(self, key, tli, segment_info):
+        url = 's3://{bucket}/{name}'.format(bucket=key.bucket.name,
+                                            name=key.name)
+        runs = wal_index.loads(key.get_contents_as_string())
+        trimmed = wal_index.trim_before(
+            runs, wal_index.segment_position(segment_info))
+        if trimmed == runs:
+            return
+
+        log_message = dict(
+            msg='trimming a WAL index',
+            detail='The index being trimmed is {url}.'.format(url=url))
+
+        if self.dry_run is False:
+            logger.info(**log_message)
+            if trimmed:
+                key.set_contents_from_string(wal_index.dumps(tli, trimmed))
+            else:
+                key.delete()
         elif self.dry_run is True:
             log_message['hint'] = ('This is only a dry run -- no actual data '
                                    'is being deleted')
@@ -669,12 +1403,51 @@ class DeleteFromContext(object):
         for key in bucket.list(prefix=self.layout.wal_directory()):
             self._maybe_delete_key(key, 'part of wal logs')
 
+        self._finish_deleting()
+
+    def _list_before(self, bucket, prefix, segment_info, delimiter=None):
+        """
+        List the keys under prefix named for segments before segment_info
+
+        The names of the keys, after prefix, start with the name of a
+        segment, and so sort by timeline, then segment.  Only keys
+        before segment_info on each timeline are listed: on reaching
+        it, listing skips to the next timeline, and continues from
+        there.  Keys not named for a segment are listed too, and
+        directories rolled up by delimiter are not.
+
+        """
+        horizon = segment_info.log + segment_info.seg
+        marker = ''
+
+        while marker is not None:
+            next_marker = None
+
+            for key in bucket.list(prefix=prefix, delimiter=delimiter,
+                                   marker=marker):
+                if key.name.endswith('/'):
+                    continue
+
+                name = key.name[len(prefix):]
+                tli = name[:8]
+                if _TIMELINE_RE.match(tli) and name[8:24] >= horizon:
+                    if tli != 'FFFFFFFF':
+                        next_marker = '{0}{1:08X}'.format(prefix,
+                                                          int(tli, 16) + 1)
+                    break
+
+                yield key
+
+            marker = next_marker
+
     def delete_before(self, segment_info):
         """
         Delete all base backups and WAL before a given segment
 
         This is the most commonly-used deletion operator; to delete
-        old backups and WAL.
+        old backups and WAL.  Only the keys that may be deleted are
+        listed, so that it takes as long as there is to delete, rather
+        than as long as there is in the archive.
 
         """
         bucket = self.s3_conn.get_bucket(self.layout.bucket_name())
@@ -694,7 +1467,13 @@ class DeleteFromContext(object):
 
         # The base-backup sweep, deleting bulk data and metadata, but
         # not any wal files.
-        for key in bucket.list(prefix=self.layout.basebackups()):
+        base_backup_keys = itertools.chain(
+            self._list_before(bucket, self.layout.basebackups() + 'base_',
+                              segment_info),
+            self._list_before(bucket,
+                              self.layout.basebackup_listed_sentinels() +
+                              'base_', segment_info))
+        for key in base_backup_keys:
             url = 's3://{bucket}/{name}'.format(bucket=key.bucket.name,
                                                 name=key.name)
             key_parts = key.name.split('/')
@@ -715,8 +1494,7 @@ class DeleteFromContext(object):
             elif key_depth == base_backup_sentinel_depth:
                 # This is a key at the base-backup-sentinel file
                 # depth, so check to see if it matches the known form.
-                match = re.match(s3_storage.COMPLETE_BASE_BACKUP_REGEXP,
-                                 key_parts[-1])
+                match = _COMPLETE_BASE_BACKUP_RE.match(key_parts[-1])
                 if match is None:
                     # This key was at the level for a base backup
                     # sentinel, but doesn't match the known pattern.
@@ -737,9 +1515,22 @@ class DeleteFromContext(object):
                     scanned_sn = groupdict_to_segment_number(match.groupdict())
                     delete_if_qualifies(segment_info, scanned_sn, key,
                                         'a base backup sentinel file')
+            elif key_depth == version_depth and key_parts[-2] == 'sentinels':
+                match = _LISTED_BASE_BACKUP_RE.match(key_parts[-1])
+
+                if match is None:
+                    logger.warning(
+                        msg="skipping non-qualifying key in 'delete before'",
+                        detail=('The unexpected key is "{0}", and it appears '
+                                'not to match the listing-only sentinel '
+                                'pattern.'.format(url)),
+                        hint=generic_weird_key_hint_message)
+                else:
+                    scanned_sn = groupdict_to_segment_number(match.groupdict())
+                    delete_if_qualifies(segment_info, scanned_sn, key,
+                                        'a listing-only base backup sentinel')
             elif key_depth == version_depth:
-                match = re.match(
-                    s3_storage.BASE_BACKUP_REGEXP, key_parts[-2])
+                match = _BASE_BACKUP_RE.match(key_parts[-2])
 
                 if match is None or key_parts[-1] != 'extended_version.txt':
                     logger.warning(
@@ -761,8 +1552,7 @@ class DeleteFromContext(object):
                 assert len(key_parts) >= 2, ('must be a logical result of the '
                                              's3 storage layout')
 
-                match = re.match(
-                    s3_storage.BASE_BACKUP_REGEXP, key_parts[-3])
+                match = _BASE_BACKUP_RE.match(key_parts[-3])
 
                 if match is None or key_parts[-2] != 'tar_partitions':
                     logger.warning(
@@ -780,15 +1570,77 @@ class DeleteFromContext(object):
             else:
                 assert False
 
+        # Finish deleting base backups before the WAL they need, so
+        # that no backup is left listed without its WAL.
+        self._finish_deleting()
+
         # the WAL-file sweep, deleting only WAL files, and not any
         # base-backup information.
-        wal_key_depth = self.layout.wal_directory().count('/') + 1
-        for key in bucket.list(prefix=self.layout.wal_directory()):
+        wal_directory = self.layout.wal_directory()
+        wal_key_depth = wal_directory.count('/') + 1
+        wal_keys = itertools.chain(
+            self._list_before(bucket, wal_directory, segment_info,
+                              delimiter='/'),
+            self._list_before(bucket, wal_directory + 'bundles/',
+                              segment_info),
+            (key for key in bucket.list(
+                prefix=wal_directory + wal_index.INDEX_DIRECTORY,
+                delimiter='/') if not key.name.endswith('/')),
+            self._list_before(bucket,
+                              wal_directory + wal_index.DELTA_DIRECTORY,
+                              segment_info))
+        for key in wal_keys:
             url = 's3://{bucket}/{name}'.format(bucket=key.bucket.name,
                                                 name=key.name)
             key_parts = key.name.split('/')
             key_depth = len(key_parts)
-            if key_depth != wal_key_depth:
+            if key_depth == wal_key_depth + 1 and key_parts[-2] == 'bundles':
+                bounds = wal_bundle.parse_bundle_name(key_parts[-1])
+                if bounds is None:
+                    logger.warning(
+                        msg="skipping non-qualifying key in 'delete before'",
+                        detail=('The unexpected key is "{0}", and it appears '
+                                'not to match the WAL bundle naming pattern.'
+                                .format(url)),
+                        hint=generic_weird_key_hint_message)
+                else:
+                    # A bundle is only deleted once all of the WAL
+                    # segments in it qualify.
+                    last = bounds[1]
+                    scanned_sn = s3_storage.SegmentNumber(log=last[8:16],
+                                                          seg=last[16:24])
+                    delete_if_qualifies(segment_info, scanned_sn, key,
+                                        'a bundle of wal files')
+            elif (key_depth == wal_key_depth + 1 and
+                  key_parts[-2] + '/' == wal_index.INDEX_DIRECTORY):
+                tli = wal_index.parse_index_name(key_parts[-1])
+                if tli is None:
+                    logger.warning(
+                        msg="skipping non-qualifying key in 'delete before'",
+                        detail=('The unexpected key is "{0}", and it appears '
+                                'not to match the WAL index naming pattern.'
+                                .format(url)),
+                        hint=generic_weird_key_hint_message)
+                else:
+                    self._maybe_trim_index(key, tli, segment_info)
+            elif (key_depth == wal_key_depth + 2 and
+                  '/'.join(key_parts[-3:-1]) + '/' ==
+                  wal_index.DELTA_DIRECTORY):
+                bounds = wal_index.parse_delta_name(key_parts[-1])
+                if bounds is None:
+                    logger.warning(
+                        msg="skipping non-qualifying key in 'delete before'",
+                        detail=('The unexpected key is "{0}", and it appears '
+                                'not to match the WAL index delta naming '
+                                'pattern.'.format(url)),
+                        hint=generic_weird_key_hint_message)
+                else:
+                    last = bounds[1]
+                    scanned_sn = s3_storage.SegmentNumber(log=last[8:16],
+                                                          seg=last[16:24])
+                    delete_if_qualifies(segment_info, scanned_sn, key,
+                                        'a WAL index delta')
+            elif key_depth != wal_key_depth:
                 logger.warning(
                     msg="skipping non-qualifying key in 'delete before'",
                     detail=(
@@ -796,13 +1648,9 @@ class DeleteFromContext(object):
                         'at an unexpected depth.'.format(url)),
                     hint=generic_weird_key_hint_message)
             elif key_depth == wal_key_depth:
-                segment_match = (re.match(s3_storage.SEGMENT_REGEXP + r'\.lzo',
-                                          key_parts[-1]))
-                label_match = (re.match(s3_storage.SEGMENT_REGEXP +
-                                        r'\.[A-F0-9]{8,8}.backup.lzo',
-                                        key_parts[-1]))
-                history_match = re.match(r'[A-F0-9]{8,8}\.history',
-                                         key_parts[-1])
+                segment_match = _WAL_SEGMENT_RE.match(key_parts[-1])
+                label_match = _BACKUP_LABEL_RE.match(key_parts[-1])
+                history_match = _HISTORY_RE.match(key_parts[-1])
 
                 all_matches = [segment_match, label_match, history_match]
 
@@ -838,3 +1686,5 @@ class DeleteFromContext(object):
                     assert False
             else:
                 assert False
+
+        self._finish_deleting()
@@ -0,0 +1,222 @@
+"""
+A local spool of compressed WAL segments awaiting upload
+
+With a spool, wal-push only has to compress a segment to local disk
+before telling Postgres it is archived; uploading it to S3 is left to
+a drainer running in the background.  Compressed segments are stored
+as:
+
+    SPOOL_DIR/SEGMENT.lzo          durable, awaiting upload
+    SPOOL_DIR/SEGMENT.SIZE.lzo     likewise, of a segment of SIZE
+                                   bytes compressed without the zeros
+                                   it ends in
+    SPOOL_DIR/SEGMENT[.SIZE].MD5.lzo
+                                   likewise, of a segment whose MD5
+                                   before compression is MD5, to be
+                                   recorded along with it
+    SPOOL_DIR/.tmp-SEGMENT.*       being written
+    SPOOL_DIR/.drain.lock          held by the drainer, if any
+
+A segment is renamed to its final name only once it and its contents
+have been fsync()-ed, so whatever is found by that name is complete.
+
+Listing the spool is what finds the file a segment is spooled as, so
+the drainer lists it once for a whole batch of uploads, and refers to
+spooled segments by their file names from then on.
+
+"""
+import errno
+import fcntl
+import os
+import re
+import tempfile
+import time
+
+from wal_e.storage import s3_storage
+
+# Sizes are too short to be taken for MD5s, which are always 32
+# digits long.
+SPOOLED_REGEXP = (s3_storage.SEGMENT_REGEXP +
+                  r'(?:\.(?P<segment_size>[0-9]{1,20}))?'
+                  r'(?:\.(?P<segment_md5>[0-9a-f]{32}))?\.lzo$')
+
+# How old a temporary file can be before it is presumed to be left
+# over from a wal-push that died while writing it.
+STALE_TEMPORARY_SECONDS = 3600
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Spool(object):
+    """A spool directory, and how it is to be drained
+
+    With a bundle_size of more than one, the drainer uploads runs of
+    consecutive segments as bundles of up to that many, and waits for
+    a run to fill a bundle for up to bundle_max_age seconds.
+    """
+
+    def __init__(self, directory, max_bytes, bundle_size=1,
+                 bundle_max_age=0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.bundle_size = bundle_size
+        self.bundle_max_age = bundle_max_age
+
+    def spooled(self):
+        """Map the names of the spooled segments to their file names"""
+        try:
+            entries = os.listdir(self.directory)
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+
+        spooled = {}
+        for entry in entries:
+            match = re.match(SPOOLED_REGEXP, entry)
+            if match is not None:
+                spooled[match.group('filename')] = entry
+
+        return spooled
+
+    def create(self):
+        try:
+            os.makedirs(self.directory)
+        except EnvironmentError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def pending(self):
+        """List the names of the segments awaiting upload, oldest first"""
+        return sorted(self.spooled())
+
+    def usage(self):
+        """The number of bytes taken up by the spool's files"""
+        total = 0
+
+        try:
+            entries = os.listdir(self.directory)
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+
+        for entry in entries:
+            try:
+                total += os.path.getsize(os.path.join(self.directory, entry))
+            except EnvironmentError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+        return total
+
+    def remove_stale_temporary(self):
+        now = time.time()
+
+        try:
+            entries = os.listdir(self.directory)
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+
+        for entry in entries:
+            if not entry.startswith('.tmp-'):
+                continue
+
+            path = os.path.join(self.directory, entry)
+            try:
+                if now - os.stat(path).st_mtime > STALE_TEMPORARY_SECONDS:
+                    os.unlink(path)
+            except EnvironmentError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def has_room(self, nbytes):
+        return self.usage() + nbytes <= self.max_bytes
+
+    def add(self, name, write, segment_size=None, segment_md5=None):
+        """Durably store a segment, written to a file object by write
+
+        segment_size is the size of the whole segment, if only the part
+        of it before the zeros it ends in is written, and segment_md5
+        its MD5 in hexadecimal, if known.
+        """
+        self.create()
+
+        entry = name
+        if segment_size is not None:
+            entry += '.{0}'.format(segment_size)
+        if segment_md5 is not None:
+            entry += '.' + segment_md5
+        path = os.path.join(self.directory, entry + '.lzo')
+
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp-' + name + '.',
+                                        dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w+b') as f:
+                write(f)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.rename(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+        _fsync_dir(self.directory)
+
+    def path(self, entry):
+        """The path of a spooled file, by its name as in spooled()"""
+        return os.path.join(self.directory, entry)
+
+    def open(self, entry):
+        return open(self.path(entry), 'rb')
+
+    def segment_size(self, entry):
+        """The size of a segment, if spooled without its zeros, or None"""
+        match = re.match(SPOOLED_REGEXP, entry)
+        if match.group('segment_size') is None:
+            return None
+
+        return int(match.group('segment_size'))
+
+    def segment_md5(self, entry):
+        """The MD5 of a segment, if spooled with one, or None"""
+        return re.match(SPOOLED_REGEXP, entry).group('segment_md5')
+
+    def age(self, entry):
+        """The number of seconds since a file was spooled"""
+        return time.time() - os.stat(self.path(entry)).st_mtime
+
+    def remove(self, entry):
+        try:
+            os.unlink(self.path(entry))
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def try_lock_drain(self):
+        """Become the spool's drainer, if there is none yet
+
+        Returns a file object to close to stop being the drainer, or
+        None if another process is draining the spool.
+        """
+        self.create()
+        f = open(os.path.join(self.directory, '.drain.lock'), 'a')
+
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except EnvironmentError, e:
+            f.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+
+        return f
@@ -0,0 +1,144 @@
+"""
+Bundles of consecutive WAL segments, stored as one S3 object
+
+A quiet database with archive_timeout set archives many segments that
+compress to next to nothing, and uploading each to an object of its
+own costs a request apiece.  A bundle instead holds several compressed
+segments, as they would be stored on their own, one after the other,
+after a header of fixed size that lists them with their compressed
+lengths, the sizes of segments stored without the zeros they end in,
+and the MD5s of the segments before compression, if known:
+
+    {"segments": [["000000010000000000000001", 1033, null,
+                   "0cc175b9c0f1b6a831c399e269772661"], ...]}
+
+padded with newlines to HEADER_SZ bytes.  A segment can then be read
+with a ranged GET of the header, and another of the segment.
+
+Bundles are named after their last and first segments, in that order,
+so that the first bundle listed after a segment's name is the only one
+that can hold it:
+
+    wal_005/bundles/LAST_FIRST.bundle
+
+"""
+import json
+import re
+
+from wal_e.storage import s3_storage
+from wal_e.worker import wal_index
+
+HEADER_SZ = 4096
+
+# More segments than this would not fit in the header.
+MAX_BUNDLE_SEGMENTS = 32
+
+BUNDLE_REGEXP = (r'(?P<last>[0-9A-F]{24})_(?P<first>[0-9A-F]{24})'
+                 r'\.bundle$')
+
+
+def bundle_name(names):
+    return '{0}_{1}.bundle'.format(names[-1], names[0])
+
+
+def parse_bundle_name(name):
+    """Return the first and last segments of a bundle, or None"""
+    match = re.match(BUNDLE_REGEXP, name)
+    if match is None:
+        return None
+
+    return match.group('first'), match.group('last')
+
+
+def consecutive_runs(names):
+    """Split sorted segment names into runs of consecutive segments
+
+    >>> consecutive_runs(['000000010000000000000001',
+    ...                   '000000010000000000000002',
+    ...                   '000000010000000000000004',
+    ...                   '000000020000000000000005'])
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [['000000010000000000000001', '000000010000000000000002'],
+     ['000000010000000000000004'],
+     ['000000020000000000000005']]
+
+    Before PostgreSQL 9.3, ...FE is followed by the next log's first
+    segment.
+
+    >>> consecutive_runs(['0000000100000000000000FE',
+    ...                   '000000010000000100000000'])
+    [['0000000100000000000000FE', '000000010000000100000000']]
+    """
+    runs = []
+    previous = None
+
+    for name in names:
+        assert re.match(s3_storage.SEGMENT_REGEXP + '$', name)
+
+        if (previous is not None and name[:8] == previous[:8] and
+                wal_index.follows(wal_index.position(name),
+                                  wal_index.position(previous))):
+            runs[-1].append(name)
+        else:
+            runs.append([name])
+
+        previous = name
+
+    return runs
+
+
+def header(segments):
+    """Make the header of a bundle of (name, length, size, md5) tuples"""
+    assert 0 < len(segments) <= MAX_BUNDLE_SEGMENTS
+    assert all(length > 0 for name, length, size, md5 in segments)
+
+    text = json.dumps({'segments': [list(s) for s in segments]},
+                      separators=(',', ':'))
+    assert len(text) < HEADER_SZ
+
+    return text + '\n' * (HEADER_SZ - len(text))
+
+
+def _entry(header_text, name):
+    """The offset of name in a bundle and its entry, or None if absent
+
+    Bundles written before MD5s were recorded have entries of three
+    fields rather than four.
+    """
+    start = HEADER_SZ
+
+    for entry in json.loads(header_text)['segments']:
+        if entry[0] == name:
+            return start, entry
+
+        start += entry[1]
+
+    return None
+
+
+def segment_range(header_text, name):
+    """The first and last byte of name in a bundle, or None if absent"""
+    found = _entry(header_text, name)
+    if found is None:
+        return None
+
+    start, entry = found
+    return start, start + entry[1] - 1
+
+
+def segment_size(header_text, name):
+    """The size to extend name to with zeros, or None"""
+    found = _entry(header_text, name)
+    if found is None:
+        return None
+
+    return found[1][2]
+
+
+def segment_md5(header_text, name):
+    """The MD5 of name before compression, or None if not recorded"""
+    found = _entry(header_text, name)
+    if found is None or len(found[1]) < 4:
+        return None
+
+    return found[1][3]
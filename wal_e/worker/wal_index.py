@@ -0,0 +1,163 @@
+"""
+Index objects listing the WAL segments in an archive
+
+Finding out which WAL segments an archive holds otherwise takes
+listing every one of them.  Instead, an index object per timeline
+lists the runs of consecutive segments archived on it:
+
+    wal_005/index/TIMELINE.json
+    {"runs": [["000000010000000000000001", "00000001000000030000001F"]]}
+
+Index objects are never written by wal-push, which may run many times
+at once, but only merged by "wal-e wal-index".  wal-push only adds a
+delta, an empty object named after the first and last segments of
+each run it has archived:
+
+    wal_005/index/deltas/FIRST_LAST
+
+and merging folds the deltas into the index objects, then deletes
+them.
+
+"""
+import json
+import re
+
+from wal_e.storage import s3_storage
+
+INDEX_DIRECTORY = 'index/'
+DELTA_DIRECTORY = INDEX_DIRECTORY + 'deltas/'
+
+INDEX_REGEXP = r'(?P<tli>[0-9A-F]{8})\.json$'
+DELTA_REGEXP = (r'(?P<first>[0-9A-F]{24})_(?P<last>[0-9A-F]{24})$')
+
+# Each log holds this many segments, as of 16MB segments.  Before
+# PostgreSQL 9.3, the last of them, ...FF, is never used, and ...FE is
+# followed by the next log's first segment.  Positions leave room for
+# it either way, and a gap of just that segment is not taken for one.
+SEGMENTS_PER_LOG = 0x100
+
+
+def position(name):
+    """The position of a segment on its timeline
+
+    >>> position('000000010000000200000003')
+    515
+    """
+    match = re.match(s3_storage.SEGMENT_REGEXP + '$', name)
+    assert match is not None
+
+    return (int(match.group('log'), 16) * SEGMENTS_PER_LOG +
+            int(match.group('seg'), 16))
+
+
+def segment_position(segment_number):
+    """The position of a SegmentNumber on any timeline"""
+    return (int(segment_number.log, 16) * SEGMENTS_PER_LOG +
+            int(segment_number.seg, 16))
+
+
+def segment_name(tli, pos):
+    """
+    >>> segment_name('00000001', 515)
+    '000000010000000200000003'
+    """
+    log, seg = divmod(pos, SEGMENTS_PER_LOG)
+    return '{0}{1:08X}{2:08X}'.format(tli, log, seg)
+
+
+def follows(pos, previous):
+    """Whether the segment at pos comes right after the one at previous
+
+    >>> follows(0x1FF, 0x1FE)
+    True
+    >>> follows(0x200, 0x1FE)
+    True
+    >>> follows(0x101, 0x1FE)
+    False
+    """
+    return (pos == previous + 1 or
+            (pos == previous + 2 and
+             previous % SEGMENTS_PER_LOG == SEGMENTS_PER_LOG - 2))
+
+
+def index_name(tli):
+    return tli + '.json'
+
+
+def parse_index_name(name):
+    """Return the timeline an index object is of, or None"""
+    match = re.match(INDEX_REGEXP, name)
+    if match is None:
+        return None
+
+    return match.group('tli')
+
+
+def delta_name(first, last):
+    return '{0}_{1}'.format(first, last)
+
+
+def parse_delta_name(name):
+    """Return the first and last segments of a delta, or None
+
+    Deltas only ever span one timeline.
+
+    >>> parse_delta_name('000000010000000000000001_000000010000000000000003')
+    ('000000010000000000000001', '000000010000000000000003')
+    >>> parse_delta_name('000000010000000000000001_000000020000000000000003')
+    """
+    match = re.match(DELTA_REGEXP, name)
+    if match is None:
+        return None
+
+    first, last = match.group('first'), match.group('last')
+    if first[:8] != last[:8] or first > last:
+        return None
+
+    return first, last
+
+
+def add(runs, first, last):
+    """Add the segments from first to last positions to runs
+
+    runs is a sorted list of [first, last] positions, as is the
+    result, in which adjacent runs are joined.
+
+    >>> add([[1, 3], [8, 9]], 4, 6)
+    [[1, 6], [8, 9]]
+    >>> add([[1, 3], [8, 9]], 5, 7)
+    [[1, 3], [5, 9]]
+    >>> add([[0x1F0, 0x1FE]], 0x200, 0x201)
+    [[496, 513]]
+    """
+    merged = []
+
+    for run in sorted(runs + [[first, last]]):
+        if merged and (run[0] <= merged[-1][1] or
+                       follows(run[0], merged[-1][1])):
+            merged[-1][1] = max(merged[-1][1], run[1])
+        else:
+            merged.append(list(run))
+
+    return merged
+
+
+def trim_before(runs, pos):
+    """Remove the segments before position pos from runs
+
+    >>> trim_before([[1, 3], [5, 9]], 6)
+    [[6, 9]]
+    """
+    return [[max(first, pos), last] for first, last in runs if last >= pos]
+
+
+def dumps(tli, runs):
+    return json.dumps({'runs': [[segment_name(tli, first),
+                                 segment_name(tli, last)]
+                                for first, last in runs]})
+
+
+def loads(text):
+    """Parse the runs of an index object, as positions"""
+    return [[position(first), position(last)]
+            for first, last in json.loads(text)['runs']]
@@ -0,0 +1,139 @@
+import errno
+import gevent
+import gevent.pool
+import logging
+import os
+import re
+import sys
+import traceback
+
+import wal_e.log_help as log_help
+
+from wal_e.exception import UserCritical, UserException
+from wal_e.storage import s3_storage
+
+logger = log_help.WalELogger(__name__, level=logging.INFO)
+
+SEGMENT_READY_REGEXP = s3_storage.SEGMENT_REGEXP + r'\.ready$'
+
+
+class WalSegment(object):
+    """A WAL segment in pg_xlog, and its archive status
+
+    "explicit" segments are the ones Postgres asked to be archived,
+    and so Postgres marks them archived itself.  Others were found by
+    scanning archive_status, and have to be marked here, so Postgres
+    knows not to ask for them.
+    """
+
+    def __init__(self, seg_path, explicit=False):
+        self.path = seg_path
+        self.explicit = explicit
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    def _status_path(self, status):
+        return os.path.join(os.path.dirname(self.path), 'archive_status',
+                            '{0}.{1}'.format(self.name, status))
+
+    def is_done(self):
+        """Check if the segment is known to be archived already"""
+        return os.path.exists(self._status_path('done'))
+
+    def mark_done(self):
+        """Mark the segment archived, as Postgres would
+
+        Postgres then skips the segment, rather than calling
+        archive_command for it.
+        """
+        if self.explicit:
+            raise UserCritical(
+                msg='unexpected attempt to modify wal metadata detected',
+                detail=('Segments explicitly passed from postgres should '
+                        'not engage in archiver metadata manipulation: {0}'
+                        .format(self.path)),
+                hint='report a bug')
+
+        try:
+            os.rename(self._status_path('ready'), self._status_path('done'))
+        except EnvironmentError, e:
+            # Another wal-push got to it first.
+            if e.errno != errno.ENOENT:
+                raise
+
+    @staticmethod
+    def from_ready_archive_status(xlog_dir):
+        """Yield the segments awaiting archiving, oldest first
+
+        Only WAL segments are considered, and not timeline history or
+        backup label files: those are rare and small, and Postgres is
+        left to archive them in order.
+        """
+        status_dir = os.path.join(xlog_dir, 'archive_status')
+
+        try:
+            statuses = os.listdir(status_dir)
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            statuses = []
+
+        for status in sorted(statuses):
+            match = re.match(SEGMENT_READY_REGEXP, status)
+            if match:
+                yield WalSegment(
+                    os.path.join(xlog_dir, match.group('filename')))
+
+
+class WalTransferGroup(object):
+    """Transfer WAL segments concurrently
+
+    The explicit segment's failure is the group's failure.  Other
+    segments are marked done when they are transferred, and merely
+    have their failures logged: they are still awaiting archiving,
+    and Postgres will get to them.
+    """
+
+    def __init__(self, transferer):
+        # Injected transfer mechanism, called with a WalSegment
+        self.transferer = transferer
+
+        self.group = gevent.pool.Group()
+        self.explicit_greenlet = None
+
+    def _transfer(self, segment):
+        if segment.explicit:
+            self.transferer(segment)
+            return
+
+        try:
+            self.transferer(segment)
+        except UserException, e:
+            detail = log_help.WalELogger.fmt_logline(e.msg, e.detail, e.hint)
+        except Exception:
+            detail = ''.join(traceback.format_exception(*sys.exc_info()))
+        else:
+            segment.mark_done()
+            return
+
+        logger.warning(
+            msg='could not archive a WAL segment ahead of postgres',
+            detail=('The segment "{0}" will be archived when postgres '
+                    'asks for it.  The error was:\n{1}'
+                    .format(segment.path, detail)))
+
+    def start(self, segment):
+        g = self.group.spawn(self._transfer, segment)
+
+        if segment.explicit:
+            assert self.explicit_greenlet is None
+            self.explicit_greenlet = g
+
+    def join(self):
+        """Wait for all transfers, raising the explicit one's error"""
+        self.group.join()
+
+        if self.explicit_greenlet is not None:
+            self.explicit_greenlet.get()